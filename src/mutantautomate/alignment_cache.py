@@ -0,0 +1,119 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from http_cache import CACHE_DIR
+
+# Alignment scores keyed by the digests of the two sequences, so identical
+# sequences under different accessions (and repeat requests) share entries.
+# The key also names the method and its scoring parameters, so scores saved
+# before the scoring changes are never served after it.
+ALIGNMENT_CACHE_ENABLED = os.environ.get("MUTANTAUTOMATE_ALIGNMENT_CACHE", "1") != "0"
+ALIGNMENT_CACHE_MAX_ENTRIES = int(
+    os.environ.get("MUTANTAUTOMATE_ALIGNMENT_CACHE_MAX_ENTRIES", "1000000")
+)
+# Check the size bound every this many writes rather than on each one
+EVICT_EVERY = 256
+
+
+def sequence_digest(sequence):
+    return hashlib.sha256(sequence.encode("ascii")).hexdigest()
+
+
+def pair_key(sequence1, sequence2, method, scoring=""):
+    # Order-independent: score(a, b) and score(b, a) share one entry
+    digest1, digest2 = sorted((sequence_digest(sequence1), sequence_digest(sequence2)))
+    return f"{method}[{scoring}]:{digest1}:{digest2}"
+
+
+class AlignmentCache:
+    def __init__(self, path, max_entries=ALIGNMENT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS scores "
+                "(key TEXT PRIMARY KEY, score REAL, last_access REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS scores_last_access ON scores (last_access)"
+            )
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        db = self._connect()
+        row = db.execute("SELECT score FROM scores WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute(
+                "UPDATE scores SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0]
+
+    def put(self, key, score):
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                (key, score, time.time()),
+            )
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used scores beyond the bound
+        db = self._connect()
+        count = db.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        with db:
+            db.execute(
+                "DELETE FROM scores WHERE key IN "
+                "(SELECT key FROM scores ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AlignmentCache(os.path.join(CACHE_DIR, "alignment_cache.sqlite"))
+        return _cache
+
+
+def cached_score(
+    sequence1, sequence2, compute, method="global", scoring="", self_score=None
+):
+    # Read-through cache around compute(sequence1, sequence2). When the
+    # sequences are identical and the self-score is known, skip aligning.
+    if self_score is not None and sequence1 == sequence2:
+        return self_score(sequence1)
+    if not ALIGNMENT_CACHE_ENABLED:
+        return compute(sequence1, sequence2)
+    cache = get_cache()
+    key = pair_key(sequence1, sequence2, method, scoring)
+    score = cache.get(key)
+    if score is None:
+        score = compute(sequence1, sequence2)
+        cache.put(key, score)
+    return score
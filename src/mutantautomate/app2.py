@@ -1,3 +1,5 @@
+import io
+import csv
 import json
 import re
 import time
@@ -9,18 +11,31 @@ from flask import (
     render_template,
     request,
     jsonify,
+    make_response,
     Response,
+    send_file,
     stream_with_context,
 )
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
 # Import process from process.py
-from process import process
-from pdb_helpers import mutate_residue, trim_pdb, get_dssp
+from process import process, process_batch, SEARCH_MODE, inflight
+from scan import scan
+from jobs import get_queue
+import http_client
+import rate_limit
+import structure_cache
+import structure_sessions
+from pdb_stream import open_text_stream, trim_lines
+from structure_formats import FORMATS, MIMETYPES, decode_structure, structure_format
 
 app = Flask(__name__)
 
+# Start this worker's job threads now, so jobs left queued or running by a
+# restart are picked up without waiting for the first request
+get_queue()
+
 
 def stream_data(data):
     return f"data: {json.dumps(data)}\n\n"
@@ -37,51 +52,303 @@ def index():
 
 @app.route("/process", methods=["GET", "POST"])
 def process_route():
+    # Reattach to a submitted job, resuming after the last event received
+    job_id = request.args.get("job_id")
+    after = request.headers.get("Last-Event-ID") or request.args.get("after") or 0
+    try:
+        after = int(after)
+    except ValueError:
+        return "Last event ID must be an integer", 400
+
+    if job_id:
+        if get_queue().store.get(job_id) is None:
+            return "Job not found", 404
+    else:
+        gene_name = request.args.get("gene_name")
+        residue1 = request.args.get("residue1")
+        position = request.args.get("position", type=int)
+        residue2 = request.args.get("residue2")
+        search_mode = request.args.get("search_mode", SEARCH_MODE)
+
+        # Validate input
+        if not gene_name:
+            return "Gene name is required", 400
+        if not residue1:
+            return "Residue 1 is required", 400
+        if not position:
+            return "Position is required", 400
+        if not residue2:
+            return "Residue 2 is required", 400
+        if search_mode not in ("list", "projected"):
+            return "Search mode must be 'list' or 'projected'", 400
+
+        # The pipeline runs on the job workers; this request only tails it
+        job_id = get_queue().submit(
+            "process",
+            {
+                "gene_name": gene_name,
+                "residue1": residue1,
+                "position": position,
+                "residue2": residue2,
+                "search_mode": search_mode,
+            },
+        )
+
+    def generate():
+        yield stream_data({"message": "Processing request.", "job_id": job_id})
+        for seq, data in get_queue().tail(job_id, after):
+            yield f"id: {seq}\n" + stream_data(data)
+
+    return Response(stream_with_context(generate()), content_type="text/event-stream")
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_route(job_id):
+    job = get_queue().store.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    after = request.args.get("after", 0, type=int)
+    job["events"] = [data for _, data in get_queue().store.events(job_id, after)]
+    return jsonify(job)
+
+@app.route("/scan", methods=["GET"])
+def scan_route():
     gene_name = request.args.get("gene_name")
-    residue1 = request.args.get("residue1")
-    position = int(request.args.get("position"))
-    residue2 = request.args.get("residue2")
+    start = request.args.get("start", type=int)
+    end = request.args.get("end", type=int)
+    search_mode = request.args.get("search_mode", SEARCH_MODE)
 
     # Validate input
     if not gene_name:
         return "Gene name is required", 400
-    if not residue1:
-        return "Residue 1 is required", 400
-    if not position:
-        return "Position is required", 400
-    if not residue2:
-        return "Residue 2 is required", 400
+    if not start or not end:
+        return "Start and end positions are required", 400
+    if end < start:
+        return "End position must not be before start position", 400
+    if search_mode not in ("list", "projected"):
+        return "Search mode must be 'list' or 'projected'", 400
 
     def generate():
         yield stream_data({"message": "Processing request."})
-        for data in process(gene_name, residue1, position, residue2):
-            print(data)
+        for data in scan(gene_name, start, end, search_mode=search_mode):
             yield stream_data(data)
         yield stream_data({"type": "done", "message": "Done processing."})
 
     return Response(stream_with_context(generate()), content_type="text/event-stream")
 
+@app.route("/process_batch", methods=["POST"])
+def process_batch_route():
+    # Variants as JSON (a list, or {"variants": [...]}) or as CSV text with
+    # gene_name,residue1,position,residue2 columns
+    search_mode = request.args.get("search_mode", SEARCH_MODE)
+    if search_mode not in ("list", "projected"):
+        return "Search mode must be 'list' or 'projected'", 400
+    if request.is_json:
+        variants = request.get_json()
+        if isinstance(variants, dict):
+            variants = variants.get("variants")
+    else:
+        variants = list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    if not isinstance(variants, list) or not variants:
+        return "A list of variants is required", 400
+
+    # One JSON result per line, in the order genes finish
+    def generate():
+        for result in process_batch(variants, search_mode=search_mode):
+            yield json.dumps(result) + "\n"
+
+    return Response(
+        stream_with_context(generate()), content_type="application/x-ndjson"
+    )
+
+def chains_arg(value):
+    # ?chains=A,B or a JSON list
+    if isinstance(value, str):
+        value = value.split(",")
+    return [chain for chain in value or () if chain]
+
+
+def structure_error(err):
+    if isinstance(err, KeyError):
+        return "Structure handle not found", 404
+    if isinstance(err, ValueError):
+        return str(err), 400
+    status = err.response.status_code if err.response is not None else None
+    if status == 404:
+        return "Structure not found", 404
+    return f"Fetching structure failed: {err}", 502
+
+
+STRUCTURE_ERRORS = (KeyError, ValueError, requests.RequestException)
+
+# Accept header types for each output format
+ACCEPT_FORMATS = {
+    "chemical/x-pdb": "pdb",
+    MIMETYPES["mmcif"]: "mmcif",
+    MIMETYPES["bcif"]: "bcif",
+}
+
+
+def format_arg(data=None):
+    # The output format asked for with "format" (JSON or query string) or
+    # the Accept header; None keeps the structure's own format
+    format = (data or {}).get("format") or request.args.get("format")
+    if format is None:
+        for mimetype, _ in request.accept_mimetypes:
+            if mimetype in ACCEPT_FORMATS:
+                return ACCEPT_FORMATS[mimetype]
+        return None
+    if format not in FORMATS:
+        raise ValueError(f"Unknown structure format: {format}")
+    return format
+
+
+def session_from_request(data, text_key):
+    # The parsed structure for a "handle" from an earlier call, for
+    # {"source", "structure_id", "chains"} naming a structure in the
+    # server-side cache, or for the PDB text itself. Parsing happens once per
+    # structure, whichever of these the client sends.
+    sessions = structure_sessions.get_sessions()
+    if data.get("handle"):
+        return sessions.get(data["handle"])
+    if data.get("structure_id"):
+        return sessions.open_cached(
+            data.get("source", "rcsb"),
+            data["structure_id"],
+            chains_arg(data.get("chains")),
+        )
+    return sessions.open_text(data.get(text_key))
+
+
+def with_handle(body, session, format=None):
+    response = make_response(body)
+    response.headers["X-Structure-Handle"] = session.handle
+    if format:
+        response.mimetype = MIMETYPES[format]
+    return response
+
+
+def send_structure(digest, f):
+    # Content-addressed, so the digest is a strong ETag and the handle for
+    # /trim_pdb, /dssp and /mutate. send_file streams the blob from the file
+    # already open, so evicting it meanwhile can't cut the response short.
+    stat = os.fstat(f.fileno())
+    format = structure_format(f.read(4096))
+    f.seek(0)
+    response = send_file(
+        f,
+        mimetype=MIMETYPES[format],
+        etag=digest,
+        conditional=True,
+        max_age=86400,
+        last_modified=stat.st_mtime,
+    )
+    if response.status_code == 200:
+        response.content_length = stat.st_size
+    response.headers["X-Structure-Handle"] = digest
+    return response
+
+
+@app.route("/structure/<source>/<structure_id>", methods=["GET"])
+def structure_route(source, structure_id):
+    chains = chains_arg(request.args.get("chains"))
+    try:
+        digest, f = structure_cache.get_cache().open(
+            source, structure_id, chains, format_arg()
+        )
+    except STRUCTURE_ERRORS as err:
+        return structure_error(err)
+    return send_structure(digest, f)
+
+
+@app.route("/structures", methods=["POST"])
+def open_structure_route():
+    try:
+        if not request.is_json:
+            # The file itself as the body; BinaryCIF can only come this way
+            raw = request.get_data()
+            session = structure_sessions.get_sessions().open_text(
+                decode_structure(raw)
+            )
+            return jsonify({"handle": session.handle, "format": session.format})
+        data = request.get_json()
+        session = session_from_request(data, "pdb_string")
+    except STRUCTURE_ERRORS as err:
+        return structure_error(err)
+    return jsonify({"handle": session.handle, "format": session.format})
+
+
 @app.route("/mutate", methods=["POST"])
 def mutate_route_route():
     data = request.get_json()  # Get JSON payload
-    pdb_string = data.get("pdb_string")
+    try:
+        session = session_from_request(data, "pdb_string")
+        format = format_arg(data) or session.format
+    except STRUCTURE_ERRORS as err:
+        return structure_error(err)
     chain_id = data.get("chain_id", "A") or "A"
     position = int(data.get("position"))
     to_residue = data.get("to_residue")
-    mutated = mutate_residue(pdb_string, chain_id, position, to_residue)
-    return mutated
+    try:
+        mutated = session.mutate(chain_id, position, to_residue, format)
+    except ValueError as err:
+        # e.g. PDB output asked for with chain IDs PDB can't hold
+        return structure_error(err)
+    response = make_response(mutated)
+    response.mimetype = MIMETYPES[format]
+    return response
 
 @app.route("/trim_pdb", methods=["POST"])
 def trim_pdb_route():
+    if not request.is_json:
+        # A PDB file (gzip-compressed or not) as the request body, with
+        # ?chains=A,B: filtered line by line as it arrives and streamed back,
+        # never held in memory whole
+        chains = chains_arg(request.args.get("chains"))
+        try:
+            lines = trim_lines(open_text_stream(request.stream), chains)
+        except ValueError as err:
+            return structure_error(err)
+        return Response(stream_with_context(lines), mimetype="text/plain")
     data = request.get_json()
-    pdb_data = data.get("pdb_data")
     chains = data.get("chains")
-    pdb_string = trim_pdb(pdb_data, chains)
-    return pdb_string
+    try:
+        format = format_arg(data)
+        if data.get("structure_id"):
+            # The structure cache trims, keeps the trimmed copy, and sends it
+            # from disk
+            digest, f = structure_cache.get_cache().open(
+                data.get("source", "rcsb"),
+                data["structure_id"],
+                chains_arg(chains),
+                format,
+            )
+            return send_structure(digest, f)
+        trimmed = session_from_request(data, "pdb_data").trim(chains)
+        body = trimmed.export(format)
+    except STRUCTURE_ERRORS as err:
+        return structure_error(err)
+    return with_handle(body, trimmed, format or trimmed.format)
 
 @app.route("/dssp", methods=["POST"])
 def dssp_route():
     data = request.get_json()
-    pdb_string = data.get("pdb_string")
-    dssp_data = get_dssp(pdb_string)
-    return jsonify(dssp_data)
\ No newline at end of file
+    try:
+        session = session_from_request(data, "pdb_string")
+    except STRUCTURE_ERRORS as err:
+        return structure_error(err)
+    dssp_data = session.dssp()
+    return with_handle(jsonify(dssp_data), session)
+
+
+@app.route("/stats", methods=["GET"])
+def stats_route():
+    return jsonify(
+        {
+            "singleflight": inflight.stats(),
+            "http": http_client.stats(),
+            "rate_limits": rate_limit.stats(),
+            "structures": structure_cache.get_cache().stats(),
+            "structure_sessions": structure_sessions.get_sessions().stats(),
+        }
+    )
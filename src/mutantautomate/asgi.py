@@ -0,0 +1,130 @@
+import asyncio
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app2 import app as flask_app, stream_data
+from process import SEARCH_MODE
+from async_process import close_client, process
+
+# ASGI entry point: /process streams from the asyncio pipeline, so one
+# worker process holds many concurrent EventSources; every other route
+# (and /process?job_id=... reattaching to a background job) is the Flask app.
+#
+#   uvicorn asgi:app --app-dir src/mutantautomate --host 0.0.0.0 --port 5000
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def send_text(send, status, text):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+        }
+    )
+    await send({"type": "http.response.body", "body": text.encode()})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def process_route(scope, receive, send):
+    args = {
+        key: values[-1]
+        for key, values in parse_qs(scope["query_string"].decode()).items()
+    }
+    gene_name = args.get("gene_name")
+    residue1 = args.get("residue1")
+    residue2 = args.get("residue2")
+    search_mode = args.get("search_mode", SEARCH_MODE)
+    try:
+        position = int(args.get("position", ""))
+    except ValueError:
+        position = None
+
+    # Validate input
+    if not gene_name:
+        return await send_text(send, 400, "Gene name is required")
+    if not residue1:
+        return await send_text(send, 400, "Residue 1 is required")
+    if not position:
+        return await send_text(send, 400, "Position is required")
+    if not residue2:
+        return await send_text(send, 400, "Residue 2 is required")
+    if search_mode not in ("list", "projected"):
+        return await send_text(send, 400, "Search mode must be 'list' or 'projected'")
+
+    async def generate():
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                ],
+            }
+        )
+
+        async def emit(data):
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": stream_data(data).encode(),
+                    "more_body": True,
+                }
+            )
+
+        await emit({"message": "Processing request."})
+        try:
+            async for data in process(
+                gene_name, residue1, position, residue2, search_mode=search_mode
+            ):
+                await emit(data)
+            await emit({"type": "done", "message": "Done processing."})
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+            print(f"Processing {gene_name} failed: {error}")
+            await emit({"type": "done", "message": f"Failed: {error}", "error": error})
+        await send({"type": "http.response.body", "body": b""})
+
+    # Stop the pipeline (and its fetches) as soon as the client goes away
+    stream = asyncio.ensure_future(generate())
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    done, pending = await asyncio.wait(
+        {stream, disconnect}, return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    if stream in done:
+        stream.result()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if (
+        scope["type"] == "http"
+        and scope["path"] == "/process"
+        and scope["method"] == "GET"
+        and b"job_id=" not in scope["query_string"]
+    ):
+        return await process_route(scope, receive, send)
+    return await wsgi_app(scope, receive, send)
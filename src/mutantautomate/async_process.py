@@ -0,0 +1,547 @@
+import os
+import time
+import asyncio
+
+import httpx
+
+from http_client import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, host_stats
+from rate_limit import (
+    RATE_LIMIT_ENABLED,
+    THROTTLE_STATUSES,
+    get_limiter,
+    parse_retry_after,
+)
+from http_cache import HTTP_CACHE_ENABLED, HTTP_CACHE_STALE, HTTP_CACHE_TTL, get_cache
+from uniprot_mirror import get_mirror
+from residue_matcher import PackedSequences
+from similarity import (
+    LONG_SEQUENCE_THRESHOLD,
+    alignment_method,
+    alignment_methods,
+    similarity_rows,
+)
+from process import (
+    FETCH_WORKERS,
+    PROJECTED_FIELDS,
+    SEARCH_MODE,
+    SEARCH_PAGE_SIZE,
+    UNIPROT_BACKEND,
+    gene_name_from_entry,
+    get_charge_statement,
+    get_grantham_score_with_statement,
+    get_next_link,
+    pdb_ids_from_entry,
+    projected_entry,
+)
+
+# asyncio version of process.process: the same stages and the same events,
+# but UniProt is fetched over one pooled httpx.AsyncClient, so a single
+# event loop can hold hundreds of open /process streams (see asgi.py)
+
+# Connections kept open to UniProt across every stream on the loop
+ASYNC_MAX_CONNECTIONS = int(
+    os.environ.get("MUTANTAUTOMATE_ASYNC_MAX_CONNECTIONS", "100")
+)
+
+# Same retry policy as the shared requests session in http_client.py; 429
+# and 503 wait on the rate limiter instead
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.25
+RETRY_STATUSES = (500, 502, 504)
+
+# Per event loop, like the clients: a task can only be awaited on the loop
+# that runs it
+_clients = {}
+_inflight = {}
+_revalidating = {}
+
+
+def loop_tasks(tasks):
+    return tasks.setdefault(asyncio.get_running_loop(), {})
+
+
+def get_client():
+    # One client per event loop; a client can't be shared between loops
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+            transport=httpx.AsyncHTTPTransport(retries=RETRY_TOTAL),
+        )
+        _clients[loop] = client
+    return client
+
+
+async def close_client():
+    loop = asyncio.get_running_loop()
+    _inflight.pop(loop, None)
+    _revalidating.pop(loop, None)
+    client = _clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def cached_response(url, entry):
+    response = httpx.Response(
+        entry["status"],
+        headers=entry["headers"],
+        content=entry["body"],
+        request=httpx.Request("GET", url),
+    )
+    response.from_cache = True
+    return response
+
+
+async def send(url, headers=None):
+    # GET through the host's shared rate limiter, retrying throttled
+    # responses after Retry-After and backing off on other 5xx responses
+    host = httpx.URL(url).host
+    limiter = get_limiter(host)
+    for attempt in range(RETRY_TOTAL + 1):
+        if RATE_LIMIT_ENABLED:
+            while delay := limiter.try_acquire():
+                await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            response = await get_client().get(url, headers=headers)
+        except BaseException:
+            host_stats.record(host, time.perf_counter() - start)
+            if RATE_LIMIT_ENABLED:
+                limiter.release()
+            raise
+        latency = time.perf_counter() - start
+        host_stats.record(host, latency, response.status_code)
+        if RATE_LIMIT_ENABLED:
+            limiter.release(
+                response.status_code,
+                latency,
+                parse_retry_after(response.headers.get("Retry-After")),
+            )
+        if attempt == RETRY_TOTAL or (
+            response.status_code not in RETRY_STATUSES
+            and response.status_code not in THROTTLE_STATUSES
+        ):
+            return response
+        if response.status_code in RETRY_STATUSES or not RATE_LIMIT_ENABLED:
+            await asyncio.sleep(RETRY_BACKOFF * (2**attempt))
+
+
+async def revalidate(url, entry):
+    # Conditional GET for a stored response, refreshing the on-disk cache
+    cache = get_cache()
+    headers = {}
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    response = await send(url, headers)
+    if response.status_code == 304:
+        await asyncio.to_thread(cache.touch, url)
+        return cached_response(url, entry)
+    if response.status_code == 200:
+        await asyncio.to_thread(
+            cache.put, url, response.status_code, response.headers, response.content
+        )
+    return response
+
+
+async def fetch(url):
+    # The same on-disk cache and freshness rules as CachingHTTPAdapter
+    if not HTTP_CACHE_ENABLED:
+        return await send(url)
+    cache = get_cache()
+    entry = await asyncio.to_thread(cache.get, url)
+    if entry is None:
+        response = await send(url)
+        if response.status_code == 200:
+            await asyncio.to_thread(
+                cache.put, url, response.status_code, response.headers, response.content
+            )
+        return response
+    age = time.time() - entry["stored_at"]
+    if age < HTTP_CACHE_TTL:
+        return cached_response(url, entry)
+    if age < HTTP_CACHE_TTL + HTTP_CACHE_STALE:
+        # Serve what we have and refresh it for the next caller
+        revalidate_in_background(url, entry)
+        return cached_response(url, entry)
+    return await revalidate(url, entry)
+
+
+def revalidate_in_background(url, entry):
+    revalidating = loop_tasks(_revalidating)
+    if url in revalidating:
+        return
+
+    async def run():
+        try:
+            await revalidate(url, entry)
+        except httpx.HTTPError as err:
+            print(f"Revalidating {url} failed: {err}")
+
+    # Held here so the task isn't garbage collected before it finishes
+    task = asyncio.ensure_future(run())
+    revalidating[url] = task
+    task.add_done_callback(lambda _: revalidating.pop(url, None))
+
+
+async def uniprot_get(url):
+    # Identical GETs in flight on this loop share one fetch
+    inflight = loop_tasks(_inflight)
+    task = inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(fetch(url))
+        inflight[url] = task
+        task.add_done_callback(lambda _: inflight.pop(url, None))
+    # Shielded so one stream going away doesn't cancel the others' fetch
+    response = await asyncio.shield(task)
+    response.raise_for_status()
+    return response
+
+
+async def prefetch_pages(search, url):
+    # Async twin of process.prefetch_pages
+    task = asyncio.ensure_future(search(url))
+    try:
+        while task is not None:
+            result = await task
+            next_link = result["next_link"]
+            task = None
+            if next_link:
+                task = asyncio.ensure_future(search(next_link))
+            yield result
+    finally:
+        if task is not None:
+            task.cancel()
+
+
+async def search_uniprot(url):
+    print(f"Searching Uniprot: {url}")
+    response = await uniprot_get(url)
+    return {
+        "isoforms": response.text.strip().split("\n"),
+        "next_link": get_next_link(response.headers),
+    }
+
+
+async def search_uniprot_generator(gene_name):
+    if UNIPROT_BACKEND == "mirror":
+        isoforms = await asyncio.to_thread(get_mirror().search, gene_name)
+        yield {"isoforms": isoforms, "next_link": None}
+        return
+    url = f"https://rest.uniprot.org/uniprotkb/search?query=(reviewed:true)+AND+(taxonomy_id:9606)+AND+{gene_name}&includeIsoform=true&format=list&size={SEARCH_PAGE_SIZE}"
+    async for result in prefetch_pages(search_uniprot, url):
+        yield result
+
+
+async def search_uniprot_projected(url):
+    print(f"Searching Uniprot: {url}")
+    response = await uniprot_get(url)
+    return {
+        "entries": [
+            projected_entry(data) for data in response.json().get("results", [])
+        ],
+        "next_link": get_next_link(response.headers),
+    }
+
+
+async def search_uniprot_projected_generator(gene_name):
+    if UNIPROT_BACKEND == "mirror":
+
+        def search():
+            mirror = get_mirror()
+            return [
+                projected_entry(mirror.get_entry(isoform))
+                for isoform in mirror.search(gene_name)
+            ]
+
+        yield {"entries": await asyncio.to_thread(search), "next_link": None}
+        return
+    url = f"https://rest.uniprot.org/uniprotkb/search?query=(reviewed:true)+AND+(taxonomy_id:9606)+AND+{gene_name}&includeIsoform=true&format=json&fields={PROJECTED_FIELDS}&size={SEARCH_PAGE_SIZE}"
+    async for result in prefetch_pages(search_uniprot_projected, url):
+        yield result
+
+
+async def get_sequence(isoform):
+    if UNIPROT_BACKEND == "mirror":
+        return await asyncio.to_thread(get_mirror().get_sequence, isoform)
+    response = await uniprot_get(f"https://www.uniprot.org/uniprot/{isoform}.fasta")
+    return "".join(response.text.strip().split("\n")[1:])
+
+
+async def get_entry(uniprot_id):
+    if UNIPROT_BACKEND == "mirror":
+        return await asyncio.to_thread(get_mirror().get_entry, uniprot_id)
+    response = await uniprot_get(f"https://www.uniprot.org/uniprot/{uniprot_id}.json")
+    return response.json()
+
+
+class ConcurrentFetches:
+    # Async twin of process.ConcurrentFetches: at most max_workers fetches
+    # at a time, items submitted as they become known
+    def __init__(self, fetch, max_workers=FETCH_WORKERS):
+        self.fetch = fetch
+        self.semaphore = asyncio.Semaphore(max(1, max_workers))
+        self.tasks = []
+
+    async def bounded(self, item):
+        async with self.semaphore:
+            return item, await self.fetch(item)
+
+    def submit(self, items):
+        self.tasks.extend(asyncio.ensure_future(self.bounded(item)) for item in items)
+
+    async def results(self):
+        for next_done in asyncio.as_completed(self.tasks):
+            yield await next_done
+
+    def close(self):
+        # Don't keep fetching if the client went away
+        for task in self.tasks:
+            task.cancel()
+
+
+async def fetch_concurrently(fetch, items, max_workers=FETCH_WORKERS):
+    fetches = ConcurrentFetches(fetch, max_workers)
+    try:
+        fetches.submit(items)
+        async for result in fetches.results():
+            yield result
+    finally:
+        fetches.close()
+
+
+async def iterate_in_thread(iterator):
+    # Step a blocking iterator (the similarity matrix) off the event loop
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
+class EntryRecords:
+    # Async twin of process.EntryRecords
+    def __init__(self, max_workers=FETCH_WORKERS):
+        self.max_workers = max_workers
+        self.records = {}
+
+    async def fetch_generator(self, isoforms):
+        missing = []
+        for isoform in isoforms:
+            if isoform in self.records:
+                yield isoform, self.records[isoform]
+            else:
+                missing.append(isoform)
+        async for isoform, data in fetch_concurrently(
+            get_entry, missing, self.max_workers
+        ):
+            self.records[isoform] = data
+            yield isoform, data
+
+    async def get(self, isoform):
+        if isoform not in self.records:
+            self.records[isoform] = await get_entry(isoform)
+        return self.records[isoform]
+
+
+async def collect_isoforms(
+    gene_name, all_isoforms, max_workers=FETCH_WORKERS, search_mode=SEARCH_MODE
+):
+    if search_mode == "projected":
+        async for result in search_uniprot_projected_generator(gene_name):
+            for entry in result["entries"]:
+                all_isoforms[entry["isoform"]] = {
+                    "sequence": entry["sequence"],
+                    "gene_name": entry["gene_name"],
+                    "pdb_ids": entry["pdb_ids"],
+                }
+            yield {"message": f"got {len(all_isoforms)} isoforms"}
+        yield {"all_isoforms": list(all_isoforms.keys())}
+        for sequences_found, isoform in enumerate(all_isoforms, start=1):
+            yield {
+                "message": f"got sequence for {isoform}",
+                "type": "sequence",
+                "isoform": isoform,
+            }
+            yield {"message": f"got {sequences_found} / {len(all_isoforms)} sequences"}
+    else:
+        sequences = ConcurrentFetches(get_sequence, max_workers)
+        try:
+            async for result in search_uniprot_generator(gene_name):
+                isoforms = [
+                    isoform
+                    for isoform in result["isoforms"]
+                    if isoform not in all_isoforms
+                ]
+                for isoform in isoforms:
+                    all_isoforms[isoform] = {
+                        "sequence": None,
+                        "gene_name": None,
+                        "pdb_ids": None,
+                    }
+                sequences.submit(isoforms)
+                yield {"message": f"got {len(all_isoforms)} isoforms"}
+            yield {"all_isoforms": list(all_isoforms.keys())}
+
+            sequences_found = 0
+            async for isoform, sequence in sequences.results():
+                all_isoforms[isoform]["sequence"] = sequence
+                sequences_found += 1
+                yield {
+                    "message": f"got sequence for {isoform}",
+                    "type": "sequence",
+                    "isoform": isoform,
+                }
+                yield {
+                    "message": f"got {sequences_found} / {len(all_isoforms)} sequences"
+                }
+        finally:
+            sequences.close()
+
+
+async def collect_gene_names(isoforms, all_isoforms, entries, search_mode=SEARCH_MODE):
+    if search_mode == "projected":
+        for isoform in isoforms:
+            this_gene_name = all_isoforms[isoform]["gene_name"]
+            yield {
+                "message": f"got gene name for {isoform}: {this_gene_name}",
+                "gene_name": this_gene_name,
+            }
+        return
+    async for isoform, data in entries.fetch_generator(isoforms):
+        this_gene_name = gene_name_from_entry(data)
+        all_isoforms[isoform]["gene_name"] = this_gene_name
+        yield {
+            "message": f"got gene name for {isoform}: {this_gene_name}",
+            "gene_name": this_gene_name,
+        }
+
+
+async def process(
+    gene_name,
+    residue1,
+    position,
+    residue2,
+    max_workers=FETCH_WORKERS,
+    search_mode=SEARCH_MODE,
+):
+    print("Gene Name:", gene_name)
+    print("Residue 1:", residue1)
+    print("Position:", position)
+    print("Residue 2:", residue2)
+
+    # Grantham Score
+    grantham_score_with_statement = get_grantham_score_with_statement(
+        residue1, residue2
+    )
+    yield {
+        "type": "grantham_score",
+        "message": grantham_score_with_statement["grantham_statement"],
+        **grantham_score_with_statement,
+    }
+
+    # Charge Statement
+    charge_statement = get_charge_statement(residue1, residue2, position)
+    yield {
+        "type": "charge_statement",
+        "charge_statement": charge_statement,
+        "message": charge_statement,
+    }
+
+    # Collect all isoforms
+    all_isoforms = {}
+    entries = EntryRecords(max_workers)
+    async for event in collect_isoforms(
+        gene_name, all_isoforms, max_workers, search_mode
+    ):
+        yield event
+
+    # Find isoforms with residue1 at position
+    packed = PackedSequences(
+        all_isoforms, [data["sequence"] for data in all_isoforms.values()]
+    )
+    found = packed.match([(position, residue1)])
+    matching_isoforms = {}
+    for isoform in packed.matching(found[:, 0]):
+        matching_isoforms[isoform] = all_isoforms[isoform]
+        yield {"message": f"found {isoform} with {residue1} at position {position}"}
+    yield {
+        "message": f"found {len(matching_isoforms)} matching isoforms",
+        "matching_isoforms": list(matching_isoforms.keys()),
+    }
+
+    # Get gene names for matching isoforms
+    async for event in collect_gene_names(
+        matching_isoforms, all_isoforms, entries, search_mode
+    ):
+        yield event
+
+    # Filter isforms that match the input gene name
+    filtered_isoforms = {}
+    for isoform in matching_isoforms:
+        this_gene_name = matching_isoforms[isoform]["gene_name"]
+        yield {"message": f"gene names for {isoform}: {this_gene_name} and {gene_name}"}
+        if this_gene_name == gene_name:
+            filtered_isoforms[isoform] = matching_isoforms[isoform]
+    yield {
+        "message": f"filtered isoforms: {filtered_isoforms.keys()}",
+        "filtered_isoforms": list(filtered_isoforms.keys()),
+    }
+
+    # Pairwise similary scores, computed off the event loop
+    isoform_names = list(filtered_isoforms)
+    sequences = [filtered_isoforms[isoform]["sequence"] for isoform in isoform_names]
+    methods = alignment_methods(sequences)
+    methods_message = ", ".join(
+        f"{count} {method}" for method, count in methods.items()
+    )
+    if "banded" in methods:
+        methods_message += f" (banded above {LONG_SEQUENCE_THRESHOLD} residues)"
+    yield {
+        "type": "alignment_method",
+        "message": f"aligning isoform pairs: {methods_message}",
+        "alignment_methods": methods,
+    }
+    scores = {}
+    async for i, row in iterate_in_thread(similarity_rows(sequences)):
+        isoform1 = isoform_names[i]
+        for k, alignment_score in enumerate(row):
+            isoform2 = isoform_names[i + k]
+            scores[(isoform1, isoform2)] = alignment_score
+            scores[(isoform2, isoform1)] = alignment_score
+            method = alignment_method(sequences[i], sequences[i + k])
+            yield {
+                "message": f"similarity for {isoform1} and {isoform2}: {alignment_score} ({method})"
+            }
+    yield {
+        "pairwise_scores": [
+            {
+                "isoform1": isoform1,
+                "isoform2": isoform2,
+                "score": scores[(isoform1, isoform2)],
+            }
+            for isoform1 in filtered_isoforms
+            for isoform2 in filtered_isoforms
+        ],
+    }
+
+    # PDB IDs
+    missing = [
+        isoform
+        for isoform in filtered_isoforms
+        if filtered_isoforms[isoform]["pdb_ids"] is None
+    ]
+    async for isoform, data in entries.fetch_generator(missing):
+        filtered_isoforms[isoform]["pdb_ids"] = pdb_ids_from_entry(data)
+    pdb_ids = {
+        isoform: filtered_isoforms[isoform]["pdb_ids"] for isoform in filtered_isoforms
+    }
+    yield {"type": "pdb_ids", "pdb_ids": pdb_ids}
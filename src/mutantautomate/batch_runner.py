@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import argparse
+
+import pandas as pd
+
+from process import BATCH_GENE_WORKERS, FETCH_WORKERS, SEARCH_MODE, process_batch
+
+# Run a spreadsheet of variants through the /process pipeline, grouped by
+# gene, appending each finished row to a JSONL checkpoint:
+#
+#   python batch_runner.py variants.xlsx --checkpoint variants.jsonl
+#
+# Rerunning the same command skips every row already in the checkpoint, so an
+# interrupted run picks up where it stopped. Rows that failed are retried.
+
+
+def read_variants(path):
+    # gene_name / residue_name / residue_position columns, as in
+    # getPDBforXLSX.py, with an optional residue2 column
+    if path.endswith((".xlsx", ".xls")):
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path)
+    variants = []
+    # Numbered as in the spreadsheet, below its header row
+    for number, row in enumerate(df.to_dict("records"), start=2):
+        try:
+            position = int(row["residue_position"])
+        except (TypeError, ValueError):
+            # Blank (NaN) or non-numeric; the rest of the sheet still runs
+            print(
+                f"skipping row {number}: residue_position "
+                f"{row['residue_position']!r} is not a number",
+                file=sys.stderr,
+            )
+            continue
+        residue2 = row.get("residue2")
+        variants.append(
+            {
+                "gene_name": str(row["gene_name"]).strip(),
+                "residue1": str(row["residue_name"]).strip().upper(),
+                "position": position,
+                "residue2": (
+                    None if pd.isna(residue2) else str(residue2).strip().upper()
+                ),
+            }
+        )
+    return variants
+
+
+def variant_key(variant):
+    return "{gene_name}:{residue1}{position}{residue2}".format(
+        **{**variant, "residue2": variant.get("residue2") or ""}
+    )
+
+
+def read_checkpoint(path):
+    # Keys of the rows that finished without an error
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short when the last run was killed
+                continue
+            if "error" not in result:
+                done.add(result["key"])
+    return done
+
+
+def run(
+    path,
+    checkpoint,
+    gene_workers=BATCH_GENE_WORKERS,
+    max_workers=FETCH_WORKERS,
+    search_mode=SEARCH_MODE,
+):
+    variants = list({variant_key(v): v for v in read_variants(path)}.values())
+    done = read_checkpoint(checkpoint)
+    pending = [variant for variant in variants if variant_key(variant) not in done]
+    print(
+        f"{len(variants)} unique variants, {len(variants) - len(pending)} already "
+        f"in {checkpoint}, {len(pending)} to run",
+        file=sys.stderr,
+    )
+    failed = 0
+    with open(checkpoint, "a") as f:
+        for result in process_batch(pending, max_workers, gene_workers, search_mode):
+            result["key"] = variant_key(pending[result.pop("index")])
+            if "error" in result:
+                failed += 1
+            f.write(json.dumps(result) + "\n")
+            # Each row is on disk before the next one is reported
+            f.flush()
+            os.fsync(f.fileno())
+            print(f"finished {result['key']}", file=sys.stderr)
+    print(f"{len(pending) - failed} rows done, {failed} failed", file=sys.stderr)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a spreadsheet of variants with a resumable checkpoint"
+    )
+    parser.add_argument("input", help="Variants as .xlsx or .csv")
+    parser.add_argument(
+        "--checkpoint",
+        help="JSONL file results are appended to (default: input name + .jsonl)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=BATCH_GENE_WORKERS,
+        help="Genes processed at once",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=FETCH_WORKERS,
+        help="Concurrent UniProt fetches per gene",
+    )
+    parser.add_argument(
+        "--search-mode", choices=["list", "projected"], default=SEARCH_MODE
+    )
+    args = parser.parse_args()
+    checkpoint = args.checkpoint or os.path.splitext(args.input)[0] + ".jsonl"
+
+    failed = run(
+        args.input, checkpoint, args.workers, args.fetch_workers, args.search_mode
+    )
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+from pdb_arrays import read_pdb
+from pdb_stream import trim_text
+from pdb_helpers import (
+    mutate_arrays,
+    mutate_structure,
+    parse_pdb,
+    trim_structure,
+    write_pdb,
+)
+from structure_cache import structure_path
+
+# Times trim_pdb and mutate_residue on the Bio.PDB path (parse, walk, write
+# every atom) against the columnar path in pdb_arrays.py, and trimming
+# against the line filter in pdb_stream.py:
+#
+#   python benchmark_pdb.py 1CRN 4HHB 1AON
+#
+# Arguments are PDB IDs (fetched into the structure cache) or file paths.
+# Mutations are to glycine, which needs no rotamer library.
+
+DEFAULT_STRUCTURES = ["1CRN", "4HHB", "1AON"]
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def middle_residue(arrays):
+    # A standard residue halfway along the first chain
+    chain = arrays.chain[0]
+    positions = arrays.resseq[
+        (arrays.model == 0) & (arrays.chain == chain) & (arrays.record == b"ATOM  ")
+    ]
+    return chain.decode(), int(positions[len(positions) // 2])
+
+
+def benchmark(pdb_string, repeat):
+    arrays = read_pdb(pdb_string)
+    chain, position = middle_residue(arrays)
+    timings = {
+        "trim_biopdb": lambda: write_pdb(
+            trim_structure(parse_pdb(pdb_string), [chain], copy=False)
+        ),
+        "trim_arrays": lambda: read_pdb(pdb_string).trim([chain]).write(),
+        "trim_stream": lambda: trim_text(pdb_string, [chain]),
+        "mutate_biopdb": lambda: write_pdb(
+            mutate_structure(parse_pdb(pdb_string), chain, position, "G", copy=False)
+        ),
+        "mutate_arrays": lambda: mutate_arrays(
+            read_pdb(pdb_string), chain, position, "G"
+        ).write(),
+    }
+    return len(arrays), {name: best_time(fn, repeat) for name, fn in timings.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the Bio.PDB and columnar PDB paths for trim and mutate"
+    )
+    parser.add_argument(
+        "structures",
+        nargs="*",
+        default=DEFAULT_STRUCTURES,
+        help="PDB IDs or PDB file paths",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per timing")
+    args = parser.parse_args()
+
+    output = sys.stdout
+    print(
+        "structure\tatoms\ttrim_biopdb\ttrim_arrays\ttrim_stream"
+        "\tmutate_biopdb\tmutate_arrays",
+        file=output,
+    )
+    for structure in args.structures:
+        # Progress goes to stderr so the table can be piped
+        with contextlib.redirect_stdout(sys.stderr):
+            path = structure
+            if not os.path.exists(path):
+                path = structure_path("rcsb", structure, format="pdb")
+            with open(path) as f:
+                atoms, timings = benchmark(f.read(), args.repeat)
+        row = [structure, atoms] + [f"{seconds:.4f}" for seconds in timings.values()]
+        print("\t".join(str(value) for value in row), file=output)
@@ -31,7 +31,6 @@ import requests
 from bs4 import BeautifulSoup
 import urllib.parse
 import json
-from requests.adapters import HTTPAdapter, Retry
 import re
 import ast
 from io import StringIO
@@ -65,6 +64,11 @@ import warnings
 
 from Bio.Align import PairwiseAligner
 
+from http_client import session
+from structure_cache import structure_path
+from alignment_cache import cached_score
+from substitution import aa_charge_dict, grantham_score
+
 # Suppress warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=BiopythonDeprecationWarning)
@@ -73,13 +77,6 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 # Define regular expression pattern for retrieving next link
 re_next_link = re.compile(r'<(.+)>; rel="next"')
 
-# Define retry settings for HTTP requests
-retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
-
-# Create a session with retry settings
-session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
-
 
 # Function to retrieve the next link from HTTP response headers
 def get_next_link(headers):
@@ -170,7 +167,7 @@ matching_isoforms = search_residue(residue1, position, gene_name)
 
 def get_gene_name(uniprot_id):
     url = f"https://www.uniprot.org/uniprot/{uniprot_id}.txt"
-    response = requests.get(url)
+    response = session.get(url)
     lines = response.text.split("\n")
     for line in lines:
         if line.startswith("GN   Name="):
@@ -205,6 +202,18 @@ else:
 
 # Function to calculate similarity between two sequences using PairwiseAligner
 def calculate_similarity(sequence1, sequence2):
+    # Identical sequences are 100% similar without aligning
+    return cached_score(
+        sequence1,
+        sequence2,
+        align_similarity,
+        method="global-similarity",
+        scoring="match=1,mismatch=-1,gap=-1",
+        self_score=lambda sequence: 100.0,
+    )
+
+
+def align_similarity(sequence1, sequence2):
     aligner = PairwiseAligner()
     aligner.mode = 'global'
     aligner.match_score = 1
@@ -248,7 +257,7 @@ uniprot_id = only_element[0:6]
 url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}"
 
 # Make an HTTP GET request to the URL
-response = requests.get(url)
+response = session.get(url)
 # Rest of the code...
 
 # Check if the request was successful (status code 200)
@@ -276,16 +285,13 @@ else:
     print(f"Error: Failed to retrieve data. Status code: {response.status_code}")
 
 # Function to download a PDB file from the Internet
-def download_pdb(pdbcode, datadir, downloadurl="https://files.rcsb.org/download/"):
-    pdbfn = pdbcode + ".pdb"
-    url = downloadurl + pdbfn
-    outfnm = os.path.join(datadir, pdbfn)
+def download_pdb(pdbcode):
+    # Fetched into (or found in) the shared structure cache
     try:
-        urllib.request.urlretrieve(url, outfnm)
-        return outfnm
+        return structure_path("rcsb", pdbcode, format="pdb")
     except Exception as err:
         print("ERROR")
-        return outfnm
+        return None
 
 
 # Get the directory of the current file
@@ -293,18 +299,14 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
 # Function to download a PDB file using the new method for AlphaFold
-def new_method_for_alphafold(pdbcode, datadir):
-    new_url = "https://alphafold.ebi.ac.uk/files/AF-" + uniprot_id + "-F1-model_v4.pdb"
-    pdbfn2 = pdbcode + ".pdb"
-    outfnm2 = os.path.join(datadir, pdbfn2)
+def new_method_for_alphafold(pdbcode):
     try:
-        urllib.request.urlretrieve(new_url, outfnm2)
-        return outfnm2
+        return structure_path("alphafold", uniprot_id)
     except Exception as err:
         print("ERROR")
-        return outfnm2
+        return None
 
-pdbpath = download_pdb(pdb_ids[0], current_dir)
+pdbpath = download_pdb(pdb_ids[0])
 
 
       
@@ -334,43 +336,6 @@ amino_acids = {
 
 # Function to determine the charge change between two residues
 def charge_statement(residue1, residue2):
-    aa_charge_dict = {
-        "A": "non-polar",
-        "C": "polar",
-        "D": "negative",
-        "E": "negative",
-        "F": "bulky",  # "non-polar",
-        "G": "non-polar",
-        "H": "positive",
-        "I": "non-polar",
-        "K": "positive",
-        "L": "non-polar",
-        "M": "non-polar",
-        "N": "polar",
-        "P": "non-polar",
-        "Q": "polar",
-        "R": "positive",
-        "S": "polar",
-        "T": "polar",
-        "V": "non-polar",
-        "W": "bulky",  # "non-polar",
-        "Y": "bulky"  # "polar"
-    }
-
-    aa_charge_categories = {
-        "positive-to-negative": ["K", "R", "H"],
-        "positive-to-hydrophobic": ["K", "R", "H"],
-        "negative-to-positive": ["D", "E"],
-        "negative-to-hydrophobic": ["D", "E"],
-        "hydrophobic-to-positive": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "hydrophobic-to-negative": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "hydrophobic-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "polar-to-hydrophobic": ["C", "N", "Q", "S", "T", "Y"],
-        "polar-to-positive": ["C", "N", "Q", "S", "T", "Y"],
-        "polar-to-negative": ["C", "N", "Q", "S", "T", "Y"],
-        "non-polar-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"]
-    }
-
     residue1_charge = aa_charge_dict[residue1]
     residue2_charge = aa_charge_dict[residue2]
 
@@ -483,25 +448,18 @@ output_message = (
     
 )
 
-def calculate_grantham_score(grantham_dict, aa1, aa2):
-    key = (aa1, aa2)
-    if key in grantham_dict:
-        return grantham_dict[key]
-    else:
+def calculate_grantham_score(aa1, aa2):
+    score = grantham_score(aa1, aa2)
+    if score is None:
         print(f"Grantham score not available for ({aa1}, {aa2})")
-        return None
+    return score
 
 if __name__ == "__main__":
-    # Load the Grantham dictionary from the output file
-    output_file = "grantham_output.txt"
-    with open(output_file, "r") as f:
-        grantham_dict = ast.literal_eval(f.read())
-
     # Take user input for amino acids
     amino_acid1 = residue1 #input("Enter the first amino acid: ").upper()
     amino_acid2 = residue2 #input("Enter the second amino acid: ").upper()
 
-    score = calculate_grantham_score(grantham_dict, amino_acid1, amino_acid2)
+    score = calculate_grantham_score(amino_acid1, amino_acid2)
 
     threshold = 100  # Define the threshold value for high Grantham score
 
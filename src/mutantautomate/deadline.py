@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from http_client import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, host_stats
+
+# Time budgets for a /process run and hedged UniProt requests.
+#
+# A Deadline is created once per run and handed to every stage; requests get
+# at most the time that is left, and stages stop waiting when it runs out so
+# the stream finishes with partial results instead of hanging on one slow
+# response. A hedged request sends a duplicate to the alternate UniProt host
+# when the first hasn't answered within that host's usual (percentile)
+# latency, and takes whichever answers first.
+
+DEADLINE_SECONDS = float(os.environ.get("MUTANTAUTOMATE_DEADLINE_SECONDS", "100"))
+
+HEDGE_ENABLED = os.environ.get("MUTANTAUTOMATE_HEDGE", "0") == "1"
+# Hedge once a request has taken longer than this percentile of the host's
+# recent latencies
+HEDGE_PERCENTILE = float(os.environ.get("MUTANTAUTOMATE_HEDGE_PERCENTILE", "95"))
+# Until enough latencies have been seen, and as a floor, hedge after this
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 20
+
+# Hedged requests and their duplicates run here, so a slow loser never
+# holds up the caller
+_hedge_executor = ThreadPoolExecutor(max_workers=32)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class RequestTimeout(tuple):
+    # A (connect, read) timeout that carries its deadline, so the adapters
+    # can give each retry what is left of it and stop waiting when it runs
+    # out (see rate_limit.RateLimitedAdapter)
+    def __new__(cls, connect, read, deadline):
+        timeout = super().__new__(cls, (connect, read))
+        timeout.deadline = deadline
+        return timeout
+
+
+class Deadline:
+    def __init__(self, seconds=DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, what="request"):
+        if self.expired():
+            raise DeadlineExceeded(what)
+
+    def timeout(self):
+        # (connect, read) timeout for a request made now
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("request")
+        return RequestTimeout(
+            min(HTTP_CONNECT_TIMEOUT, remaining),
+            min(HTTP_READ_TIMEOUT, remaining),
+            self,
+        )
+
+
+def request_timeout(deadline):
+    if deadline is None:
+        return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return deadline.timeout()
+
+
+def hedge_delay(host):
+    delay = host_stats.percentile(host, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    return max(HEDGE_MIN_DELAY, delay or 0.0)
+
+
+def hedged(fetch, url, alternate_url, delay, deadline=None):
+    # fetch(url) now, fetch(alternate_url) if url hasn't answered after
+    # delay; the first success wins, and an error only counts once both fail
+    started = threading.Event()
+
+    def primary():
+        started.set()
+        return fetch(url)
+
+    pending = {_hedge_executor.submit(primary)}
+    # The delay counts from when the request starts, not from when it was
+    # queued: time spent waiting for a free thread says nothing about the
+    # host, and hedging on it would only add load
+    if not started.wait(deadline.remaining() if deadline else None):
+        for future in pending:
+            future.cancel()
+        raise DeadlineExceeded(url)
+    remaining = deadline.remaining() if deadline else None
+    done, pending = wait(
+        pending, timeout=delay if remaining is None else min(delay, remaining)
+    )
+    if not done:
+        print(f"Hedging {url} with {alternate_url} after {delay:.2f}s")
+        pending.add(_hedge_executor.submit(fetch, alternate_url))
+    error = None
+    while done or pending:
+        for future in done:
+            try:
+                return future.result()
+            except Exception as err:
+                error = err
+        if not pending:
+            break
+        done, pending = wait(
+            pending,
+            timeout=deadline.remaining() if deadline else None,
+            return_when=FIRST_COMPLETED,
+        )
+        if not done:
+            raise DeadlineExceeded(url)
+    raise error
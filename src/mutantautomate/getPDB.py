@@ -1,6 +1,5 @@
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
 import re
 from pypdb import *
 from bioservices import *
@@ -13,15 +12,15 @@ import urllib.request
 from pathlib import Path
 import warnings
 
+from http_client import session
+from structure_cache import structure_path
+
 warnings.filterwarnings("ignore", category=UserWarning)
 
 #user input gene name
 gene_name = input("Enter the gene you want to search for (e.g., SHANK3): ")
 
 re_next_link = re.compile(r'<(.+)>; rel="next"')
-retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
-session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
 
 def get_next_link(headers):
     if "Link" in headers:
@@ -111,44 +110,26 @@ else:
 
 
 
-def download_pdb(pdbcode, datadir, downloadurl="https://files.rcsb.org/download/"):
+def download_pdb(pdbcode):
     """
-    Downloads a PDB file from the Internet and saves it in a data directory.
+    Downloads a PDB file from the Internet into the shared structure cache.
     :param pdbcode: The standard PDB ID e.g. '3ICB' or '3icb'
-    :param datadir: The directory where the downloaded file will be saved
-    :param downloadurl: The base PDB download URL, cf.
-        `https://www.rcsb.org/pages/download/http#structures` for details
-    :return: the full path to the downloaded PDB file or None if something went wrong
+    :return: the full path to the cached PDB file or None if something went wrong
     """
-    pdbfn = pdbcode + ".pdb"
-    url = downloadurl + pdbfn
-    outfnm = os.path.join(datadir, pdbfn)
     try:
-        urllib.request.urlretrieve(url, outfnm)
-        #print(url)
-        #print(outfnm)
-        return outfnm
+        return structure_path("rcsb", pdbcode, format="pdb")
     except Exception as err:
         print("ERROR")
-        return  outfnm
-
-# Get the directory of the current file
-current_dir = os.path.dirname(os.path.abspath(__file__))
-
-def new_method_for_alphafold(pdbcode, datadir):
-    new_url = "https://alphafold.ebi.ac.uk/files/AF-" + matching_isoforms[0] + "-F1-model_v4.pdb"
-    pdbfn2 = pdbcode + ".pdb"
-    outfnm2 = os.path.join(datadir, pdbfn2)
-    #print(new_url)
-    try: 
-        urllib.request.urlretrieve(new_url, outfnm2)
-        #print(outfnm2)
-        return outfnm2
+        return None
+
+def new_method_for_alphafold(pdbcode):
+    try:
+        return structure_path("alphafold", pdbcode)
     except Exception as err:
         print("ERROR")
-        return outfnm2
+        return None
 
 if result is None or result is None:
-    pdbpath = new_method_for_alphafold(matching_isoforms[0], current_dir) #relative path
+    pdbpath = new_method_for_alphafold(matching_isoforms[0])
 else:
-    pdbpath = download_pdb(identifier[0:4], current_dir)
+    pdbpath = download_pdb(identifier[0:4])
@@ -1,6 +1,5 @@
 import requests
 import re
-from requests.adapters import HTTPAdapter, Retry
 from pathlib import Path
 from bioservices import *
 from pypdb import *
@@ -14,10 +13,11 @@ from Bio import SeqIO
 from Bio import ExPASy
 from Bio import SwissProt
 
+from http_client import session
+from structure_cache import structure_path
+from residue_matcher import PackedSequences
+
 re_next_link = re.compile(r'<(.+)>; rel="next"')
-retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
-session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
 
 def get_next_link(headers):
     if "Link" in headers:
@@ -44,36 +44,17 @@ def get_all_isoforms(gene_name): #works!
     return isoforms
 
 
-def search_residue(residue, position, all_isoforms):
-    matching_isoforms = []
-    for isoform, sequence in all_isoforms:
-        #print(isoform, sequence)
-        if len(sequence) > position - 1 and sequence[position - 1] == residue:
-            matching_isoforms.append(isoform)
-    return matching_isoforms
-
-
-
-def download_pdb(pdbcode, datadir, downloadurl="https://files.rcsb.org/download/"):
-    pdbfn = pdbcode + ".pdb"
-    url = downloadurl + pdbfn
-    outfnm = os.path.join(datadir, pdbfn)
+def download_pdb(pdbcode):
     try:
-        urllib.request.urlretrieve(url, outfnm)
-        return outfnm
+        return structure_path("rcsb", pdbcode, format="pdb")
     except Exception as err:
-        return  outfnm
+        return None
 
-def new_method_for_alphafold(pdbcode, datadir):
-    new_url = "https://alphafold.ebi.ac.uk/files/AF-" + pdbcode + "-F1-model_v4.pdb"
-    pdbfn2 = pdbcode + ".pdb"
-    outfnm2 = os.path.join(datadir, pdbfn2)
+def new_method_for_alphafold(pdbcode):
     try:
-        urllib.request.urlretrieve(new_url, outfnm2)
-       
-        return outfnm2
+        return structure_path("alphafold", pdbcode)
     except Exception as err:
-        return outfnm2
+        return None
 
 def retrieve_fasta(matching_isoforms):
     sequences = []
@@ -91,10 +72,22 @@ gene_names = df['gene_name'].tolist()
 residue_names = df['residue_name'].tolist()
 residue_positions = df['residue_position'].astype(int).tolist()
 
+# Fetch each gene's isoforms once and screen all of its rows in one step
+matching_isoforms_by_row = {}
+for gene_name in dict.fromkeys(gene_names):
+    rows = [i for i, name in enumerate(gene_names) if name == gene_name]
+    all_isoforms = get_all_isoforms(gene_name)
+    packed = PackedSequences(
+        [isoform for isoform, _ in all_isoforms],
+        [sequence for _, sequence in all_isoforms],
+    )
+    found = packed.match([(residue_positions[i], residue_names[i]) for i in rows])
+    for column, i in enumerate(rows):
+        matching_isoforms_by_row[i] = packed.matching(found[:, column])
+
 # Iterate over gene_names list and call the listed methods for each gene name
 for (gene_name, residue_name, residue_position, i) in zip(gene_names, residue_names, residue_positions, range(len(residue_names))):
-    all_isoforms = get_all_isoforms(gene_name)
-    matching_isoforms = search_residue(residue_name, residue_position, all_isoforms)
+    matching_isoforms = matching_isoforms_by_row[i]
     u = UniProt()
     sequence = u.retrieve(matching_isoforms[0],"fasta")
     fasta_string = sequence #select only the sequence part
@@ -120,6 +113,6 @@ for (gene_name, residue_name, residue_position, i) in zip(gene_names, residue_na
 
      
     if result is None or result is None:
-        pdbpath = new_method_for_alphafold(matching_isoforms[0], "/Users/asameerpradhan/Desktop")
+        pdbpath = new_method_for_alphafold(matching_isoforms[0])
     else:
-        pdbpath = download_pdb(identifier[0:4], "/Users/asameerpradhan/Desktop")
+        pdbpath = download_pdb(identifier[0:4])
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Where the cache lives; a file on disk so it is shared by every gunicorn
+# worker and survives restarts
+CACHE_DIR = os.environ.get(
+    "MUTANTAUTOMATE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "mutantautomate"),
+)
+HTTP_CACHE_ENABLED = os.environ.get("MUTANTAUTOMATE_HTTP_CACHE", "1") != "0"
+HTTP_CACHE_MAX_BYTES = int(
+    os.environ.get("MUTANTAUTOMATE_HTTP_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+# UniProt only changes at release time (every 8 weeks), so responses are
+# fresh for a week and may be served stale for a further four weeks while
+# they are revalidated in the background
+HTTP_CACHE_TTL = int(os.environ.get("MUTANTAUTOMATE_HTTP_CACHE_TTL", str(7 * 86400)))
+HTTP_CACHE_STALE = int(
+    os.environ.get("MUTANTAUTOMATE_HTTP_CACHE_STALE", str(28 * 86400))
+)
+
+# last_access only orders eviction, so a hit rewrites it only once it is
+# this many seconds old rather than writing to the database on every read
+ACCESS_RESOLUTION = 600
+# Background revalidation doesn't answer any caller, so it gets its own
+# (connect, read) timeout rather than the one of the request it serves
+REVALIDATE_TIMEOUT = (10, 30)
+
+# Headers that describe the wire encoding rather than the stored body
+DROPPED_HEADERS = {
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+    "connection",
+}
+
+
+class HTTPCache:
+    def __init__(self, path, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, "
+                "etag TEXT, last_modified TEXT, stored_at REAL, last_access REAL, "
+                "size INTEGER)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access "
+                "ON responses (last_access)"
+            )
+
+    def _connect(self):
+        # One connection per thread, WAL so readers don't block the writer
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, url):
+        db = self._connect()
+        row = db.execute(
+            "SELECT status, headers, body, etag, last_modified, stored_at, "
+            "last_access FROM responses WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, headers, body, etag, last_modified, stored_at, last_access = row
+        now = time.time()
+        if now - last_access > ACCESS_RESOLUTION:
+            with db:
+                db.execute(
+                    "UPDATE responses SET last_access = ? WHERE url = ?", (now, url)
+                )
+        return {
+            "status": status,
+            "headers": json.loads(headers),
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "stored_at": stored_at,
+        }
+
+    def put(self, url, status, headers, body):
+        now = time.time()
+        # Validators are looked up case-insensitively: httpx and some
+        # servers send lower-case header names
+        validators = CaseInsensitiveDict(headers)
+        headers = {
+            key: value
+            for key, value in headers.items()
+            if key.lower() not in DROPPED_HEADERS
+        }
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    status,
+                    json.dumps(headers),
+                    body,
+                    validators.get("ETag"),
+                    validators.get("Last-Modified"),
+                    now,
+                    now,
+                    len(body),
+                ),
+            )
+        self.evict()
+
+    def touch(self, url):
+        # A 304 means the stored body is still good, so restart its TTL
+        db = self._connect()
+        now = time.time()
+        with db:
+            db.execute(
+                "UPDATE responses SET stored_at = ?, last_access = ? WHERE url = ?",
+                (now, now, url),
+            )
+
+    def evict(self):
+        # Drop least recently used responses until the cache fits
+        db = self._connect()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        with db:
+            for url, size in db.execute(
+                "SELECT url, size FROM responses ORDER BY last_access"
+            ).fetchall():
+                db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    def __init__(self, cache, ttl=HTTP_CACHE_TTL, stale_ttl=HTTP_CACHE_STALE, **kwargs):
+        self.cache = cache
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != "GET" or stream:
+            return super().send(request, stream=stream, **kwargs)
+        entry = self.cache.get(request.url)
+        if entry is None:
+            response = super().send(request, **kwargs)
+            self._store(request, response)
+            return response
+        age = time.time() - entry["stored_at"]
+        if age < self.ttl:
+            return self._build_response(request, entry)
+        if age < self.ttl + self.stale_ttl:
+            # Serve what we have and refresh it for the next caller
+            self._revalidate_in_background(request, entry, kwargs)
+            return self._build_response(request, entry)
+        return self._revalidate(request, entry, kwargs)
+
+    def _store(self, request, response):
+        if response.status_code == 200:
+            self.cache.put(
+                request.url, response.status_code, response.headers, response.content
+            )
+
+    def _revalidate(self, request, entry, kwargs):
+        conditional = request.copy()
+        if entry["etag"]:
+            conditional.headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            conditional.headers["If-Modified-Since"] = entry["last_modified"]
+        response = super().send(conditional, **kwargs)
+        if response.status_code == 304:
+            self.cache.touch(request.url)
+            return self._build_response(request, entry)
+        self._store(request, response)
+        return response
+
+    def _revalidate_in_background(self, request, entry, kwargs):
+        with self._revalidating_lock:
+            if request.url in self._revalidating:
+                return
+            self._revalidating.add(request.url)
+        kwargs = {**kwargs, "timeout": REVALIDATE_TIMEOUT}
+
+        def run():
+            try:
+                self._revalidate(request, entry, kwargs)
+            except requests.RequestException as err:
+                print(f"Revalidating {request.url} failed: {err}")
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(request.url)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _build_response(self, request, entry):
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry["body"]
+        response.url = request.url
+        response.request = request
+        response.reason = "OK"
+        response.connection = self
+        response.from_cache = True
+        return response
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    # Opened lazily so importing this module never touches the disk
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HTTPCache(os.path.join(CACHE_DIR, "http_cache.sqlite"))
+        return _cache
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import Retry
+
+from http_cache import HTTP_CACHE_ENABLED, CachingHTTPAdapter, get_cache
+from rate_limit import RATE_LIMIT_ENABLED, RateLimitedAdapter
+
+# The one outbound HTTP client: a keep-alive session with a tuned connection
+# pool per upstream host, default timeouts, streaming downloads and per-host
+# request/latency counters (served on /stats). Every module imports
+# `session` / `download` from here instead of building its own.
+
+# Connections kept per host; enough for the concurrent fetch workers
+HTTP_POOL_SIZE = int(os.environ.get("MUTANTAUTOMATE_HTTP_POOL_SIZE", "16"))
+# (connect, read) seconds, used whenever a caller doesn't pass a timeout
+HTTP_CONNECT_TIMEOUT = float(
+    os.environ.get("MUTANTAUTOMATE_HTTP_CONNECT_TIMEOUT", "10")
+)
+HTTP_READ_TIMEOUT = float(os.environ.get("MUTANTAUTOMATE_HTTP_READ_TIMEOUT", "60"))
+
+# Upstream hosts grouped by service; counters are kept per host
+HOSTS = {
+    "uniprot": ["rest.uniprot.org", "www.uniprot.org"],
+    "rcsb": ["files.rcsb.org", "search.rcsb.org", "data.rcsb.org"],
+    "alphafold": ["alphafold.ebi.ac.uk"],
+}
+
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# 429 and 503 are left to the rate limiter, which honours Retry-After; with
+# the limiter off, 503 is retried here like the other server errors
+RETRY_STATUSES = [500, 502, 504] if RATE_LIMIT_ENABLED else [500, 502, 503, 504]
+retries = Retry(total=5, backoff_factor=0.25, status_forcelist=RETRY_STATUSES)
+
+
+# Recent network latencies kept per host for percentiles
+LATENCY_WINDOW = 200
+
+
+class HostStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._latencies = {}
+
+    def record(self, host, seconds, status=None, from_cache=False):
+        with self._lock:
+            counters = self._hosts.setdefault(
+                host,
+                {
+                    "requests": 0,
+                    "errors": 0,
+                    "from_cache": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                },
+            )
+            counters["requests"] += 1
+            if status is None or status >= 400:
+                counters["errors"] += 1
+            if from_cache:
+                counters["from_cache"] += 1
+            counters["total_seconds"] += seconds
+            counters["max_seconds"] = max(counters["max_seconds"], seconds)
+            if status is not None and status < 400 and not from_cache:
+                self._latencies.setdefault(host, deque(maxlen=LATENCY_WINDOW)).append(
+                    seconds
+                )
+
+    def percentile(self, host, q, min_samples=1):
+        # q-th percentile of the host's recent latencies, None if too few
+        with self._lock:
+            return self._percentile(host, q, min_samples)
+
+    def _percentile(self, host, q, min_samples=1):
+        latencies = sorted(self._latencies.get(host, ()))
+        if len(latencies) < max(1, min_samples):
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: {
+                    **counters,
+                    "mean_seconds": counters["total_seconds"] / counters["requests"],
+                    "p95_seconds": self._percentile(host, 95),
+                }
+                for host, counters in self._hosts.items()
+            }
+
+
+class CachingRateLimitedAdapter(CachingHTTPAdapter, RateLimitedAdapter):
+    # Cache hits are served without touching the host's rate limit
+    pass
+
+
+# Shared by the requests session and the asyncio client in async_process.py
+host_stats = HostStats()
+
+
+class Client(requests.Session):
+    def __init__(self, pool_size=HTTP_POOL_SIZE):
+        super().__init__()
+        self.host_stats = host_stats
+        self.timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.mount(
+            "https://",
+            RateLimitedAdapter(max_retries=retries, pool_maxsize=pool_size),
+        )
+        for service, hosts in HOSTS.items():
+            if service == "uniprot" and HTTP_CACHE_ENABLED:
+                # UniProt responses go through the persistent on-disk cache
+                adapter = CachingRateLimitedAdapter(
+                    get_cache(), max_retries=retries, pool_maxsize=pool_size
+                )
+            else:
+                adapter = RateLimitedAdapter(
+                    max_retries=retries, pool_maxsize=pool_size
+                )
+            for host in hosts:
+                self.mount(f"https://{host}/", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).hostname
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException:
+            self.host_stats.record(host, time.perf_counter() - start)
+            raise
+        self.host_stats.record(
+            host,
+            time.perf_counter() - start,
+            response.status_code,
+            getattr(response, "from_cache", False),
+        )
+        return response
+
+
+session = Client()
+
+
+def download(url, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # Stream url to path without holding the body in memory; the file only
+    # appears once it is complete
+    partial = path + ".part"
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        try:
+            with open(partial, "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(partial)
+            raise
+    os.replace(partial, path)
+    return path
+
+
+def stats():
+    return host_stats.snapshot()
@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextlib
+
+from http_cache import CACHE_DIR
+from process import process
+
+# Background jobs for the /process pipeline. Jobs and every event they yield
+# are kept in SQLite, so the request thread only tails a job's event log,
+# a job keeps running after its client disconnects, and every gunicorn worker
+# process can run and serve jobs from the same queue.
+
+JOB_WORKERS = int(os.environ.get("MUTANTAUTOMATE_JOB_WORKERS", "4"))
+# A running job whose worker hasn't checked in for this long is requeued
+JOB_STALE_SECONDS = int(os.environ.get("MUTANTAUTOMATE_JOB_STALE_SECONDS", "120"))
+# Finished jobs are kept this long before they are pruned
+JOB_RETENTION_SECONDS = int(
+    os.environ.get("MUTANTAUTOMATE_JOB_RETENTION_SECONDS", str(7 * 86400))
+)
+# Attempts before a job that keeps losing its worker is marked failed
+JOB_MAX_ATTEMPTS = 3
+
+HEARTBEAT_SECONDS = 15
+POLL_SECONDS = 1.0
+PRUNE_EVERY_SECONDS = 3600
+
+# Job kind -> generator function called with the job's params
+JOB_KINDS = {"process": process}
+
+FINISHED = ("done", "failed")
+
+
+class JobStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT, params TEXT, status TEXT, "
+                "attempts INTEGER, error TEXT, created_at REAL, started_at REAL, "
+                "finished_at REAL, heartbeat REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "job_id TEXT, seq INTEGER, data TEXT, PRIMARY KEY (job_id, seq))"
+            )
+
+    def _connect(self):
+        # One connection per thread, WAL so tailing readers never block the
+        # job writing its events. Autocommit, with explicit transactions.
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes
+        # can't claim the same job
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def submit(self, kind, params):
+        job_id = uuid.uuid4().hex
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs (id, kind, params, status, attempts, created_at) "
+                "VALUES (?, ?, ?, 'queued', 0, ?)",
+                (job_id, kind, json.dumps(params), time.time()),
+            )
+        return job_id
+
+    def claim(self):
+        # The oldest queued job, marked running; None when the queue is empty
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id, kind, params, attempts FROM jobs "
+                "WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, kind, params, attempts = row
+            db.execute(
+                "UPDATE jobs SET status = 'running', attempts = ?, started_at = ?, "
+                "heartbeat = ? WHERE id = ?",
+                (attempts + 1, now, now, job_id),
+            )
+            next_seq = db.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM events WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()[0]
+            if attempts:
+                # A rerun starts from scratch, so the lost attempt's events
+                # go; numbering carries on, so clients resuming with
+                # Last-Event-ID get the rerun from its start
+                db.execute("DELETE FROM events WHERE job_id = ?", (job_id,))
+        return {
+            "id": job_id,
+            "kind": kind,
+            "params": json.loads(params),
+            "attempts": attempts + 1,
+            "next_seq": next_seq,
+        }
+
+    def append(self, job_id, seq, data):
+        db = self._connect()
+        db.execute(
+            "INSERT INTO events VALUES (?, ?, ?)", (job_id, seq, json.dumps(data))
+        )
+
+    def finish(self, job_id, error=None):
+        db = self._connect()
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            ("failed" if error else "done", error, time.time(), job_id),
+        )
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        db = self._connect()
+        db.executemany(
+            "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+            [(time.time(), job_id) for job_id in job_ids],
+        )
+
+    def requeue_stale(self):
+        # Jobs whose worker process died mid-run go back on the queue, to be
+        # run again from the start (see claim)
+        cutoff = time.time() - JOB_STALE_SECONDS
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                "error = 'worker lost too many times' "
+                "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (time.time(), cutoff, JOB_MAX_ATTEMPTS),
+            )
+            db.execute(
+                "UPDATE jobs SET status = 'queued' "
+                "WHERE status = 'running' AND heartbeat < ?",
+                (cutoff,),
+            )
+
+    def prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._transaction() as db:
+            db.execute(
+                "DELETE FROM events WHERE job_id IN "
+                "(SELECT id FROM jobs WHERE status IN ('done', 'failed') "
+                "AND finished_at < ?)",
+                (cutoff,),
+            )
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') "
+                "AND finished_at < ?",
+                (cutoff,),
+            )
+
+    def get(self, job_id):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT kind, params, status, attempts, error, created_at, "
+                "started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        kind, params, status, attempts, error, created, started, finished = row
+        return {
+            "id": job_id,
+            "kind": kind,
+            "params": json.loads(params),
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+            "created_at": created,
+            "started_at": started,
+            "finished_at": finished,
+        }
+
+    def events(self, job_id, after=0):
+        return [
+            (seq, json.loads(data))
+            for seq, data in self._connect().execute(
+                "SELECT seq, data FROM events WHERE job_id = ? AND seq > ? "
+                "ORDER BY seq",
+                (job_id, after),
+            )
+        ]
+
+
+class JobQueue:
+    # Local worker threads claiming jobs from the shared store
+    def __init__(self, store, workers=JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._running = set()
+        self._running_lock = threading.Lock()
+        # Wakes local workers on submit and local tails on new events;
+        # other processes' events are picked up by polling
+        self._changed = threading.Condition()
+        self._last_prune = 0
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        threading.Thread(target=self._maintain, daemon=True).start()
+
+    def submit(self, kind, params):
+        job_id = self.store.submit(kind, params)
+        with self._changed:
+            self._changed.notify_all()
+        return job_id
+
+    def _work(self):
+        while True:
+            try:
+                job = self.store.claim()
+            except sqlite3.Error as err:
+                print(f"Claiming a job failed: {err}")
+                job = None
+            if job is None:
+                with self._changed:
+                    self._changed.wait(POLL_SECONDS)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        job_id = job["id"]
+        seq = job["next_seq"]
+        with self._running_lock:
+            self._running.add(job_id)
+
+        def append(data):
+            nonlocal seq
+            self.store.append(job_id, seq, data)
+            seq += 1
+            with self._changed:
+                self._changed.notify_all()
+
+        error = None
+        try:
+            if job["attempts"] > 1:
+                # Tells clients to drop the events of the lost attempt
+                append(
+                    {
+                        "type": "restart",
+                        "message": f"restarting job (attempt {job['attempts']})",
+                    }
+                )
+            for data in JOB_KINDS[job["kind"]](**job["params"]):
+                append(data)
+            append({"type": "done", "message": "Done processing."})
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+            print(f"Job {job_id} failed: {error}")
+            append({"type": "done", "message": f"Failed: {error}", "error": error})
+        finally:
+            self.store.finish(job_id, error)
+            with self._running_lock:
+                self._running.discard(job_id)
+            with self._changed:
+                self._changed.notify_all()
+
+    def _maintain(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            try:
+                with self._running_lock:
+                    running = list(self._running)
+                self.store.heartbeat(running)
+                self.store.requeue_stale()
+                if time.time() - self._last_prune > PRUNE_EVERY_SECONDS:
+                    self.store.prune()
+                    self._last_prune = time.time()
+            except sqlite3.Error as err:
+                print(f"Job maintenance failed: {err}")
+
+    def tail(self, job_id, after=0):
+        # Yield (seq, event) from the job's log, following it until the job
+        # has finished and every event has been sent
+        while True:
+            # Status before events: a job's last events are written before it
+            # is marked finished, so a finished job has nothing left to read
+            job = self.store.get(job_id)
+            if job is None:
+                return
+            for seq, data in self.store.events(job_id, after):
+                after = seq
+                yield seq, data
+            if job["status"] in FINISHED:
+                return
+            with self._changed:
+                self._changed.wait(POLL_SECONDS)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    # Started lazily so importing this module doesn't spawn threads
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(JobStore(os.path.join(CACHE_DIR, "jobs.sqlite")))
+        return _queue
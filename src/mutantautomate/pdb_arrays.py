@@ -0,0 +1,226 @@
+import numpy as np
+
+# Columnar (structure-of-arrays) PDB reading and writing. The ATOM/HETATM
+# records of a file become one NumPy array per fixed-width field, so a trim
+# is a boolean mask and nothing builds a Python object per atom. Each atom
+# also keeps its original 80-column record; the writer emits those as they
+# are and only formats records for atoms that have none (e.g. the side chain
+# a mutation added).
+
+RECORD_WIDTH = 80
+SPACE = ord(" ")
+
+# (name, start, end, dtype, default when blank). Text fields keep their
+# padding, so "name" is the 4-column field as written (" CA ", "FE  ").
+FIELDS = [
+    ("record", 0, 6, "S6", None),
+    ("name", 12, 16, "S4", None),
+    ("altloc", 16, 17, "S1", None),
+    ("resname", 17, 20, "S3", None),
+    ("chain", 21, 22, "S1", None),
+    ("resseq", 22, 26, np.int32, 0),
+    ("icode", 26, 27, "S1", None),
+    ("occupancy", 54, 60, np.float32, 1.0),
+    ("bfactor", 60, 66, np.float32, 0.0),
+    ("element", 76, 78, "S2", None),
+    ("charge", 78, 80, "S2", None),
+]
+FIELD_NAMES = [name for name, *_ in FIELDS]
+COORD_COLUMNS = [(30, 38), (38, 46), (46, 54)]
+
+
+def column(records, start, end):
+    # Fixed-width column of an (n, 80) uint8 array as an array of bytes
+    return np.ascontiguousarray(records[:, start:end]).view(f"S{end - start}").ravel()
+
+
+def parse_numbers(records, start, end, dtype, default):
+    values = np.full(len(records), default, dtype=dtype)
+    filled = ~(records[:, start:end] == SPACE).all(axis=1)
+    if filled.any():
+        values[filled] = column(records[filled], start, end).astype(dtype)
+    return values
+
+
+class PDBArrays:
+    def __init__(self, fields, coords, model, lines=None):
+        for name in FIELD_NAMES:
+            setattr(self, name, fields[name])
+        self.coords = coords
+        self.model = model
+        # Original records, b"" where the writer has to format one
+        if lines is None:
+            lines = np.zeros(len(coords), dtype=f"S{RECORD_WIDTH}")
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.coords)
+
+    def fields(self):
+        return {name: getattr(self, name) for name in FIELD_NAMES}
+
+    def nbytes(self):
+        arrays = [*self.fields().values(), self.coords, self.model, self.lines]
+        return sum(array.nbytes for array in arrays)
+
+    def select(self, mask):
+        # Atoms where mask (a boolean mask or indices) is set
+        fields = {name: values[mask] for name, values in self.fields().items()}
+        return PDBArrays(fields, self.coords[mask], self.model[mask], self.lines[mask])
+
+    @classmethod
+    def concatenate(cls, parts):
+        fields = {
+            name: np.concatenate([getattr(part, name) for part in parts])
+            for name in FIELD_NAMES
+        }
+        return cls(
+            fields,
+            np.concatenate([part.coords for part in parts]),
+            np.concatenate([part.model for part in parts]),
+            np.concatenate([part.lines for part in parts]),
+        )
+
+    def residues(self):
+        # Residue number per atom, counting up in file order
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        changed = (
+            (self.model[1:] != self.model[:-1])
+            | (self.chain[1:] != self.chain[:-1])
+            | (self.resseq[1:] != self.resseq[:-1])
+            | (self.icode[1:] != self.icode[:-1])
+        )
+        return np.concatenate([[0], np.cumsum(changed)])
+
+    def trim(self, chains_to_keep):
+        chains = np.array([chain.encode() for chain in chains_to_keep], dtype="S4")
+        return self.select(np.isin(self.chain, chains))
+
+    def write(self):
+        if self.chain.dtype.itemsize > 1 and (np.char.str_len(self.chain) > 1).any():
+            # Large assemblies from mmCIF can have chain IDs like "AA"
+            raise ValueError("Chain IDs longer than one character need mmCIF output")
+        lines = self.lines.copy()
+        missing = lines == b""
+        if missing.any():
+            lines[missing] = format_records(self.select(missing))
+        out = []
+        multiple_models = len(self) and self.model.max() > 0
+        # Segments of one chain within one model, each closed with TER
+        breaks = np.flatnonzero(
+            (self.model[1:] != self.model[:-1]) | (self.chain[1:] != self.chain[:-1])
+        )
+        starts = np.concatenate([[0], breaks + 1]) if len(self) else []
+        ends = np.concatenate([breaks + 1, [len(self)]]) if len(self) else []
+        model = None
+        for start, end in zip(starts, ends):
+            if multiple_models and self.model[start] != model:
+                if model is not None:
+                    out.append(b"ENDMDL")
+                model = self.model[start]
+                out.append(b"MODEL     %4d" % (model + 1))
+            out.extend(lines[start:end].tolist())
+            out.append(b"TER")
+        if multiple_models:
+            out.append(b"ENDMDL")
+        out.append(b"END")
+        return b"\n".join(out).decode() + "\n"
+
+
+def format_records(arrays):
+    # 80-column ATOM/HETATM records for atoms without one
+    records = []
+    for i in range(len(arrays)):
+        x, y, z = arrays.coords[i]
+        records.append(
+            b"%-6s%5d %4s%1s%3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f          %2s%2s"
+            % (
+                arrays.record[i],
+                (i + 1) % 100000,
+                arrays.name[i],
+                arrays.altloc[i] or b" ",
+                arrays.resname[i],
+                arrays.chain[i] or b" ",
+                arrays.resseq[i],
+                arrays.icode[i] or b" ",
+                x,
+                y,
+                z,
+                arrays.occupancy[i],
+                arrays.bfactor[i],
+                arrays.element[i],
+                arrays.charge[i],
+            )
+        )
+    return np.array(records, dtype=f"S{RECORD_WIDTH}")
+
+
+def read_pdb(pdb_string):
+    records = []
+    models = []
+    model = 0
+    for line in pdb_string.encode().splitlines():
+        head = line[:6]
+        if head == b"ATOM  " or head == b"HETATM":
+            records.append(line)
+            models.append(model)
+        elif head == b"ENDMDL":
+            model += 1
+    lines = np.array(records, dtype=f"S{RECORD_WIDTH}")
+    # Short records come back NUL-padded; columns past their end are blank
+    raw = np.frombuffer(lines.tobytes(), dtype=np.uint8).reshape(
+        len(records), RECORD_WIDTH
+    )
+    raw = np.where(raw == 0, np.uint8(SPACE), raw)
+    lines = raw.copy().view(f"S{RECORD_WIDTH}").ravel()
+    fields = {}
+    for name, start, end, dtype, default in FIELDS:
+        if default is None:
+            fields[name] = column(raw, start, end)
+        else:
+            fields[name] = parse_numbers(raw, start, end, dtype, default)
+    coords = np.empty((len(records), 3), dtype=np.float32)
+    for axis, (start, end) in enumerate(COORD_COLUMNS):
+        coords[:, axis] = column(raw, start, end).astype(np.float32)
+    return PDBArrays(fields, coords, np.array(models, dtype=np.int32), lines)
+
+
+def pad_name(name, element):
+    # The 4-column atom name as Bio.PDB's PDBIO writes it: one-letter
+    # elements start in the second column (" CB "), others in the first
+    if len(name) < 4 and name[:1].isalpha() and len(element.strip()) < 2:
+        name = " " + name
+    return name.ljust(4).encode()
+
+
+def name_field(atom):
+    return pad_name(atom.get_name(), atom.element)
+
+
+def from_atoms(atoms, model=0):
+    # PDBArrays for Bio.PDB atoms, e.g. a residue rebuilt by a mutation;
+    # their records are formatted when written
+    fields = {name: [] for name in FIELD_NAMES}
+    coords = []
+    for atom in atoms:
+        residue = atom.get_parent()
+        hetero, resseq, icode = residue.get_id()
+        fields["record"].append(b"HETATM" if hetero.strip() else b"ATOM  ")
+        fields["name"].append(name_field(atom))
+        fields["altloc"].append(atom.get_altloc().encode())
+        fields["resname"].append(residue.get_resname().encode())
+        fields["chain"].append(residue.get_parent().get_id().encode())
+        fields["resseq"].append(resseq)
+        fields["icode"].append(icode.encode())
+        fields["occupancy"].append(atom.get_occupancy() or 0.0)
+        fields["bfactor"].append(atom.get_bfactor() or 0.0)
+        fields["element"].append(atom.element.rjust(2).encode())
+        fields["charge"].append(b"  ")
+        coords.append(atom.coord)
+    fields = {
+        name: np.array(values, dtype=dtype)
+        for (name, _, _, dtype, _), values in zip(FIELDS, fields.values())
+    }
+    coords = np.array(coords, dtype=np.float32).reshape(-1, 3)
+    return PDBArrays(fields, coords, np.full(len(coords), model, dtype=np.int32))
@@ -2,8 +2,20 @@ from io import StringIO
 from Bio import PDB
 from Bio.PDB import PDBParser
 from Bio.PDB.PDBIO import PDBIO
-from pymut import mutate
+from pymut import mutate, load_rotamers
 import mdtraj
+import numpy as np
+import tempfile
+import threading
+from pdb_arrays import from_atoms, PDBArrays
+from pdb_stream import trim_text
+from structure_formats import (
+    convert_structure,
+    read_structure,
+    single_letter_chains,
+    structure_format,
+    write_structure,
+)
 
 # Convert one-letter code to three-letter code
 amino_acid_mapping = {
@@ -29,13 +41,38 @@ amino_acid_mapping = {
     "V": "VAL",
 }
 
-def mutate_residue(pdb_string, chain_id, position, to_residue_one_letter):
+# The rotamer library is read once per process, not on every mutation
+_rotamers = None
+_rotamers_lock = threading.Lock()
+
+def get_rotamers():
+    global _rotamers
+    with _rotamers_lock:
+        if _rotamers is None:
+            _rotamers = load_rotamers()
+        return _rotamers
+
+
+# The *_structure / *_arrays / *_trajectory functions work on already parsed
+# objects (see structure_sessions.py); the string versions parse their input
+# first. Trimming and mutating go through the columnar reader in
+# pdb_arrays.py; the Bio.PDB versions are kept for callers that hold a
+# Bio.PDB structure. The string versions take PDB, mmCIF or BinaryCIF
+# (structure_formats.py) and answer in the format they were given unless
+# another is asked for.
+
+# A mutation's side chain reaches under 8 A from its backbone, and pymut
+# scores clashes within 5 A of each rotamer atom, so nothing further away
+# than this can change the result
+NEIGHBOURHOOD_RADIUS = 15.0
+
+def parse_pdb(pdb_string):
     input_handle = StringIO(pdb_string)
     parser = PDBParser(QUIET=1)
-    structure = parser.get_structure("my_structure", input_handle)
-    # Mutate the structure
-    to_residue_three_letter = amino_acid_mapping[to_residue_one_letter]
-    mutate(structure, chain_id, position, to_residue_three_letter)
+    return parser.get_structure("my_structure", input_handle)
+
+
+def write_pdb(structure):
     # Create a PDBIO object
     io = PDBIO()
     io.set_structure(structure)
@@ -43,42 +80,128 @@ def mutate_residue(pdb_string, chain_id, position, to_residue_one_letter):
     output_handle = StringIO()
     io.save(output_handle)
     # Retrieve the PDB string from the StringIO object
-    output_pdb_string = output_handle.getvalue()
-    # Return the PDB string
-    return output_pdb_string
+    return output_handle.getvalue()
 
 
-def trim_pdb(pdb_string, chains_to_keep):
-    output_file_handle = StringIO(pdb_string)
-    parser = PDBParser(QUIET=1)
-    structure = parser.get_structure("my_structure", output_file_handle)
+def mutate_structure(structure, chain_id, position, to_residue_one_letter, copy=True):
+    # With copy, the parsed structure is left as it was
+    if copy:
+        structure = structure.copy()
+    to_residue_three_letter = amino_acid_mapping[to_residue_one_letter]
+    # Alanine and glycine need no side-chain rotamers
+    rotamer_lib = None
+    if to_residue_three_letter not in ("ALA", "GLY"):
+        rotamer_lib = get_rotamers()
+    mutate(structure, chain_id, position, to_residue_three_letter, rotamer_lib=rotamer_lib)
+    return structure
 
+
+def trim_structure(structure, chains_to_keep, copy=True):
+    # With copy, the parsed structure is left as it was
+    if copy:
+        structure = structure.copy()
     # Iterate through models and chains
     for model in structure:
-        for chain in model:
+        for chain in list(model):
             # Check if the chain ID is in the list of chains to keep
             if chain.id not in chains_to_keep:
                 # Detach the chain from the model
                 model.detach_child(chain.id)
+    return structure
 
-    # Create an output PDB string
-    output_handle = StringIO()
-    io = PDBIO()
-    io.set_structure(structure)
-    io.save(output_handle)
-    out_string = output_handle.getvalue()
-    
-    return out_string
 
-def get_dssp(pdb_string):
+def neighbourhood(arrays, chain_id, position):
+    # (mask of the residue, mask of what pymut needs to mutate it): residues
+    # in the first model with an atom within NEIGHBOURHOOD_RADIUS, plus the
+    # residues either side in file order for its phi/psi angles
+    first_model = arrays.model == 0
+    target = (
+        first_model
+        & (arrays.record == b"ATOM  ")
+        & (arrays.chain == chain_id.encode())
+        & (arrays.resseq == position)
+        & (arrays.icode == b" ")
+    )
+    if not target.any():
+        raise KeyError(f"Residue {position} not found in chain {chain_id}!")
+    residues = arrays.residues()
+    target_residue = residues[target][0]
+    target_coords = arrays.coords[target]
+    near = np.zeros(len(arrays), dtype=bool)
+    lower = target_coords.min(axis=0) - NEIGHBOURHOOD_RADIUS
+    upper = target_coords.max(axis=0) + NEIGHBOURHOOD_RADIUS
+    # Box test first so distances are only computed for nearby atoms
+    boxed = np.flatnonzero(
+        first_model & ((arrays.coords >= lower) & (arrays.coords <= upper)).all(axis=1)
+    )
+    distances = np.linalg.norm(
+        arrays.coords[boxed, None, :] - target_coords[None, :, :], axis=2
+    )
+    near[boxed[(distances <= NEIGHBOURHOOD_RADIUS).any(axis=1)]] = True
+    keep = set(residues[near].tolist())
+    same_chain = first_model & (arrays.chain == chain_id.encode())
+    for neighbour in (target_residue - 1, target_residue + 1):
+        if (same_chain & (residues == neighbour)).any():
+            keep.add(neighbour)
+    return target, np.isin(residues, list(keep))
+
+
+def mutate_arrays(arrays, chain_id, position, to_residue_one_letter):
+    # Mutates only a Bio.PDB structure built from the residue's neighbourhood,
+    # then splices the rebuilt residue back in place of the old one
+    target, needed = neighbourhood(arrays, chain_id, position)
+    # Chain IDs from mmCIF can be too long for Bio.PDB's PDB parser
+    nearby, aliases = single_letter_chains(arrays.select(needed))
+    alias = {chain: alias for alias, chain in aliases.items()}.get(chain_id.encode())
+    alias = alias.decode() if alias else chain_id
+    structure = parse_pdb(nearby.write())
+    structure = mutate_structure(structure, alias, position, to_residue_one_letter, copy=False)
+    residue = structure[0][alias][position]
+    rebuilt = from_atoms(residue.get_unpacked_list())
+    rebuilt.chain = np.full(len(rebuilt), chain_id.encode())
+    index = np.arange(len(arrays))
+    start = index[target][0]
+    return PDBArrays.concatenate([
+        arrays.select(~target & (index < start)),
+        rebuilt,
+        arrays.select(~target & (index >= start)),
+    ])
+
+
+def load_trajectory(pdb_string):
     # Create a temporary file to store the PDB content
-    import tempfile
     with tempfile.NamedTemporaryFile(suffix=".pdb", delete=True) as temp_pdb_file:
         temp_pdb_file.write(pdb_string.encode())
         temp_pdb_file.flush()
         # Load the trajectory from the temporary file
-        traj = mdtraj.load(temp_pdb_file.name)
-        dssp = mdtraj.compute_dssp(traj)
-        # Convert ndarray to list
-        dssp_list = dssp.tolist()
-        return dssp_list
\ No newline at end of file
+        return mdtraj.load(temp_pdb_file.name)
+
+
+def trajectory_text(arrays):
+    # PDB text mdtraj can load, whatever the chain IDs
+    return single_letter_chains(arrays)[0].write()
+
+
+def dssp_for_trajectory(traj):
+    dssp = mdtraj.compute_dssp(traj)
+    # Convert ndarray to list
+    return dssp.tolist()
+
+
+def mutate_residue(pdb_string, chain_id, position, to_residue_one_letter, format=None):
+    arrays = read_structure(pdb_string)
+    mutated = mutate_arrays(arrays, chain_id, position, to_residue_one_letter)
+    return write_structure(mutated, format or structure_format(pdb_string))
+
+
+def trim_pdb(pdb_string, chains_to_keep, format=None):
+    if structure_format(pdb_string) == "pdb" and format in (None, "pdb"):
+        # A line filter: headers, serials and formatting are kept as they are
+        return trim_text(pdb_string, chains_to_keep)
+    # Only the kept chains of a CIF file are read
+    return convert_structure(pdb_string, format or structure_format(pdb_string), chains_to_keep)
+
+def get_dssp(pdb_string):
+    if structure_format(pdb_string) != "pdb":
+        pdb_string = trajectory_text(read_structure(pdb_string))
+    return dssp_for_trajectory(load_trajectory(pdb_string))
\ No newline at end of file
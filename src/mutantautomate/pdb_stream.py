@@ -0,0 +1,187 @@
+import io
+import gzip
+import itertools
+
+from structure_formats import CHAIN_COLUMNS as ATOM_SITE_CHAIN_COLUMNS
+from structure_formats import first_present, re_loop_end, split_row, structure_format
+
+# Chain trimming as a line filter. Records are read one at a time (from a
+# string, a file or a request body, gzip-compressed or not) and passed
+# through unchanged or dropped, so memory stays constant whatever the size
+# of the entry, and the header, serial numbers and formatting of the kept
+# records are exactly as in the input. mmCIF is filtered the same way, by
+# the chain column of its _atom_site rows.
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Columns holding a chain ID, per record type. A record is kept only if
+# every chain it names is kept; records not listed here (HEADER, TITLE,
+# REMARK, CRYST1, MODEL, ENDMDL, ...) always are.
+CHAIN_COLUMNS = {
+    "ATOM  ": (21,),
+    "HETATM": (21,),
+    "ANISOU": (21,),
+    "SIGATM": (21,),
+    "SIGUIJ": (21,),
+    "SEQRES": (11,),
+    "DBREF ": (12,),
+    "DBREF1": (12,),
+    "DBREF2": (12,),
+    "SEQADV": (16,),
+    "MODRES": (16,),
+    "HET   ": (12,),
+    "HELIX ": (19, 31),
+    "SHEET ": (21, 32),
+    "SSBOND": (15, 29),
+    "LINK  ": (21, 51),
+    "CISPEP": (15, 29),
+}
+ATOM_RECORDS = ("ATOM  ", "HETATM")
+# Counts of the input's records, wrong once chains are gone
+DROPPED_RECORDS = ("MASTER",)
+
+CONECT_SERIAL_COLUMNS = [(6, 11), (11, 16), (16, 21), (21, 26), (26, 31)]
+
+
+def record_chains(line, columns):
+    # Short lines are blank past their end, as in the format
+    return [
+        line[column] if len(line) > column and line[column] not in "\r\n" else " "
+        for column in columns
+    ]
+
+
+def parse_serial(field):
+    try:
+        return int(field)
+    except ValueError:
+        # Hybrid-36 serials past 99999 aren't tracked
+        return None
+
+
+class SerialRanges:
+    # Serial numbers of the kept atoms, for filtering CONECT records. Kept
+    # atoms come in runs (one per chain segment), so this stores runs rather
+    # than one entry per atom.
+    def __init__(self):
+        self.ranges = []
+
+    def add(self, serial):
+        if self.ranges and self.ranges[-1][1] + 1 == serial:
+            self.ranges[-1][1] = serial
+        elif not self.ranges or self.ranges[-1][1] != serial:
+            self.ranges.append([serial, serial])
+
+    def __contains__(self, serial):
+        return any(first <= serial <= last for first, last in self.ranges)
+
+
+def trim_lines(lines, chains_to_keep):
+    # The lines (with their line endings) to keep, of PDB or mmCIF text
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip() and not line.lstrip().startswith("#"):
+            break
+    lines = itertools.chain(head, lines)
+    if head and head[-1].lstrip().startswith("data_"):
+        return trim_cif_lines(lines, chains_to_keep)
+    return trim_pdb_lines(lines, chains_to_keep)
+
+
+def trim_pdb_lines(lines, chains_to_keep):
+    chains = set(chains_to_keep)
+    kept_serials = SerialRanges()
+    last_atom_kept = True
+    for line in lines:
+        record = line[:6].rstrip("\r\n").ljust(6)
+        if record in DROPPED_RECORDS:
+            continue
+        if record == "TER   ":
+            # Closes the chain of the atoms just before it
+            keep = last_atom_kept
+        elif record == "CONECT":
+            serials = [
+                parse_serial(line[start:end])
+                for start, end in CONECT_SERIAL_COLUMNS
+                if line[start:end].strip()
+            ]
+            keep = all(
+                serial is not None and serial in kept_serials for serial in serials
+            )
+        elif record in CHAIN_COLUMNS:
+            keep = all(
+                chain in chains for chain in record_chains(line, CHAIN_COLUMNS[record])
+            )
+            if record in ATOM_RECORDS:
+                last_atom_kept = keep
+                serial = parse_serial(line[6:11]) if keep else None
+                if serial is not None:
+                    kept_serials.add(serial)
+        else:
+            keep = True
+        if keep:
+            yield line
+
+
+def trim_cif_lines(lines, chains_to_keep):
+    # Rows of the _atom_site loop are kept by chain ID; all else passes
+    chains = set(chains_to_keep)
+    in_loop = False
+    names = []
+    column = None
+    width = 0
+    row = []
+    tokens = []
+    for line in lines:
+        stripped = line.strip()
+        if names and stripped and not stripped.startswith("_"):
+            # The _atom_site header is over; rows follow
+            chain = first_present(names, ATOM_SITE_CHAIN_COLUMNS)
+            column = names.index(chain) if chain else None
+            width = len(names)
+            names = []
+        if column is not None:
+            if not stripped or not re_loop_end.match(line):
+                if stripped:
+                    # A row can run over several lines
+                    row.append(line)
+                    tokens.extend(split_row(line))
+                    if len(tokens) >= width:
+                        if tokens[column] in chains:
+                            yield from row
+                        row, tokens = [], []
+                else:
+                    yield line
+                continue
+            column = None
+        if stripped == "loop_":
+            in_loop = True
+        elif in_loop and stripped.startswith("_atom_site."):
+            names.append(stripped[len("_atom_site.") :])
+        else:
+            in_loop = False
+        yield line
+
+
+def open_text_stream(stream):
+    # A text reader over a binary stream, decompressing it if it starts
+    # with the gzip magic number
+    stream = io.BufferedReader(stream) if not hasattr(stream, "peek") else stream
+    if stream.peek(2)[:2] == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream)
+    if structure_format(stream.peek(1)[:1]) == "bcif":
+        raise ValueError("BinaryCIF can't be filtered as a stream")
+    return io.TextIOWrapper(stream, encoding="latin-1", newline="")
+
+
+def trim_file(path, chains_to_keep):
+    # Lines of the PDB or mmCIF file at path (gzip-compressed or not)
+    # trimmed to chains
+    with open(path, "rb") as f:
+        yield from trim_lines(open_text_stream(f), chains_to_keep)
+
+
+def trim_text(pdb_string, chains_to_keep):
+    return "".join(trim_lines(pdb_string.splitlines(True), chains_to_keep))
@@ -1,57 +1,85 @@
 import os
 import re
-import ast
+from functools import partial
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import requests
-from requests.adapters import HTTPAdapter, Retry
 
-from Bio.Align import PairwiseAligner
+from http_client import session
+from deadline import (
+    DEADLINE_SECONDS,
+    HEDGE_ENABLED,
+    Deadline,
+    DeadlineExceeded,
+    hedge_delay,
+    hedged,
+    request_timeout,
+)
+from uniprot_mirror import get_mirror
+from singleflight import SingleFlight
+from residue_matcher import PackedSequences
+import substitution
+from substitution import aa_charge_dict, amino_acids
+from similarity import (
+    LONG_SEQUENCE_THRESHOLD,
+    alignment_method,
+    alignment_methods,
+    calculate_similarity,
+    similarity_matrix,
+    similarity_rows,
+)
+
+# Number of concurrent UniProt fetches per request
+FETCH_WORKERS = int(os.environ.get("MUTANTAUTOMATE_FETCH_WORKERS", "8"))
+
+# Identical UniProt GETs from concurrent /process requests share one fetch
+inflight = SingleFlight()
+
+
+# The same UniProt records are served by both hosts
+re_www_uniprot = re.compile(r"^https://www\.uniprot\.org/uniprot/([^/?]+)$")
+re_rest_uniprot = re.compile(r"^https://rest\.uniprot\.org/uniprotkb/([^/?]+)$")
+
+
+def alternate_uniprot_url(url):
+    match = re_www_uniprot.match(url)
+    if match:
+        return f"https://rest.uniprot.org/uniprotkb/{match.group(1)}"
+    match = re_rest_uniprot.match(url)
+    if match:
+        return f"https://www.uniprot.org/uniprot/{match.group(1)}"
+    return None
+
+
+def uniprot_get(url, deadline=None):
+    # deadline caps the time the request may take; with hedging on, a slow
+    # record fetch is duplicated to the other UniProt host
+    def fetch(url):
+        response = session.get(url, timeout=request_timeout(deadline))
+        response.raise_for_status()
+        return response
 
-# Define retry settings for HTTP requests
-# Create a session with retry settings
-retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
-session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
+    alternate_url = alternate_uniprot_url(url) if HEDGE_ENABLED else None
+    if alternate_url:
+        delay = hedge_delay(urlsplit(url).hostname)
+        call = (hedged, fetch, url, alternate_url, delay, deadline)
+    else:
+        call = (fetch, url)
+    # A follower of the same request waits no longer than its own deadline
+    try:
+        return inflight.do(
+            url, *call, timeout=deadline.remaining() if deadline else None
+        )
+    except FuturesTimeoutError:
+        raise DeadlineExceeded(url)
 
 
 def calculate_grantham_score(residue1, residue2):
-    # Get the path of the current file's directory
-    current_directory = os.path.dirname(__file__)
-    # Get the path of "grantham_output.txt" in the current directory
-    grantham_output_path = os.path.join(current_directory, "grantham_output.txt")
-    # Load the Grantham dictionary from the output file
-    with open(grantham_output_path, "r") as f:
-        grantham_dict = ast.literal_eval(f.read())
-    key = (residue1, residue2)
-    if key in grantham_dict:
-        return grantham_dict[key]
-    else:
+    grantham_score = substitution.grantham_score(residue1, residue2)
+    if grantham_score is None:
         print(f"Grantham score not available for ({residue1}, {residue2})")
-        return None
-
-
-# Define the dictionary of amino acid names
-amino_acids = {
-    "A": "Alanine",
-    "C": "Cysteine",
-    "D": "Aspartic Acid",
-    "E": "Glutamic Acid",
-    "F": "Phenylalanine",
-    "G": "Glycine",
-    "H": "Histidine",
-    "I": "Isoleucine",
-    "K": "Lysine",
-    "L": "Leucine",
-    "M": "Methionine",
-    "N": "Asparagine",
-    "P": "Proline",
-    "Q": "Glutamine",
-    "R": "Arginine",
-    "S": "Serine",
-    "T": "Threonine",
-    "V": "Valine",
-    "W": "Tryptophan",
-    "Y": "Tyrosine",
-}
+    return grantham_score
 
 
 def get_grantham_score_with_statement(residue1, residue2):
@@ -75,43 +103,6 @@ def get_grantham_score_with_statement(residue1, residue2):
 
 # Function to determine the charge change between two residues
 def get_charge_statement(residue1, residue2, position):
-    aa_charge_dict = {
-        "A": "non-polar",
-        "C": "polar",
-        "D": "negative",
-        "E": "negative",
-        "F": "bulky",  # "non-polar",
-        "G": "non-polar",
-        "H": "positive",
-        "I": "non-polar",
-        "K": "positive",
-        "L": "non-polar",
-        "M": "non-polar",
-        "N": "polar",
-        "P": "non-polar",
-        "Q": "polar",
-        "R": "positive",
-        "S": "polar",
-        "T": "polar",
-        "V": "non-polar",
-        "W": "bulky",  # "non-polar",
-        "Y": "bulky",  # "polar"
-    }
-
-    aa_charge_categories = {
-        "positive-to-negative": ["K", "R", "H"],
-        "positive-to-hydrophobic": ["K", "R", "H"],
-        "negative-to-positive": ["D", "E"],
-        "negative-to-hydrophobic": ["D", "E"],
-        "hydrophobic-to-positive": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "hydrophobic-to-negative": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "hydrophobic-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-        "polar-to-hydrophobic": ["C", "N", "Q", "S", "T", "Y"],
-        "polar-to-positive": ["C", "N", "Q", "S", "T", "Y"],
-        "polar-to-negative": ["C", "N", "Q", "S", "T", "Y"],
-        "non-polar-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
-    }
-
     residue1_charge = aa_charge_dict[residue1]
     residue2_charge = aa_charge_dict[residue2]
 
@@ -126,43 +117,168 @@ def get_charge_statement(residue1, residue2, position):
     return charge_statement
 
 
-def search_uniprot(url):
+# "remote" talks to UniProt, "mirror" reads the local index built by
+# uniprot_mirror.py (see MUTANTAUTOMATE_MIRROR_PATH) without any network calls
+UNIPROT_BACKEND = os.environ.get("MUTANTAUTOMATE_UNIPROT_BACKEND", "remote")
+
+# Define regular expression pattern for retrieving next link
+re_next_link = re.compile(r'<(.+)>; rel="next"')
+
+# "list" fetches accessions then each FASTA and entry separately,
+# "projected" asks the search endpoint for everything in one pass
+SEARCH_MODE = os.environ.get("MUTANTAUTOMATE_SEARCH_MODE", "list")
+
+# Only the fields the pipeline uses
+PROJECTED_FIELDS = "accession,gene_primary,sequence,xref_pdb"
+# The largest page the search API allows, so broad genes take fewer pages
+SEARCH_PAGE_SIZE = 500
+
+
+def get_next_link(headers):
+    if "Link" in headers:
+        match = re_next_link.match(headers["Link"])
+        if match:
+            return match.group(1)
+    return None
+
+
+def prefetch_pages(search, url, deadline=None):
+    # Yield search(url) and the pages after it, requesting each next page as
+    # soon as the one before arrives so it downloads while the caller works
+    # through the current one
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(search, url, deadline)
+        while future is not None:
+            try:
+                result = future.result(deadline.remaining() if deadline else None)
+            except FuturesTimeoutError:
+                raise DeadlineExceeded(url)
+            next_link = result["next_link"]
+            future = None
+            if next_link:
+                future = executor.submit(search, next_link, deadline)
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def search_uniprot(url, deadline=None):
     print(f"Searching Uniprot: {url}")
-    response = session.get(url)
-    response.raise_for_status()
+    response = uniprot_get(url, deadline)
     isoforms = response.text.strip().split("\n")
-    next_link = None
-    if "Link" in response.headers:
-        # Define regular expression pattern for retrieving next link
-        re_next_link = re.compile(r'<(.+)>; rel="next"')
-        match = re_next_link.match(response.headers["Link"])
-        if match:
-            next_link = match.group(1)
     return {
         "isoforms": isoforms,
-        "next_link": next_link,
+        "next_link": get_next_link(response.headers),
+    }
+
+
+def search_uniprot_generator(gene_name, deadline=None):
+    if UNIPROT_BACKEND == "mirror":
+        yield {"isoforms": get_mirror().search(gene_name), "next_link": None}
+        return
+    url = f"https://rest.uniprot.org/uniprotkb/search?query=(reviewed:true)+AND+(taxonomy_id:9606)+AND+{gene_name}&includeIsoform=true&format=list&size={SEARCH_PAGE_SIZE}"
+    yield from prefetch_pages(search_uniprot, url, deadline)
+
+
+def search_uniprot_projected(url, deadline=None):
+    print(f"Searching Uniprot: {url}")
+    response = uniprot_get(url, deadline)
+    return {
+        "entries": [
+            projected_entry(data) for data in response.json().get("results", [])
+        ],
+        "next_link": get_next_link(response.headers),
     }
 
 
-def search_uniprot_generator(gene_name):
-    url = f"https://rest.uniprot.org/uniprotkb/search?query=(reviewed:true)+AND+(taxonomy_id:9606)+AND+{gene_name}&includeIsoform=true&format=list"
-    while url:
-        result = search_uniprot(url)
-        yield result
-        url = result["next_link"]
+def projected_entry(data):
+    return {
+        "isoform": data["primaryAccession"],
+        "sequence": data.get("sequence", {}).get("value", ""),
+        "gene_name": gene_name_from_entry(data),
+        "pdb_ids": pdb_ids_from_entry(data),
+    }
+
 
+def search_uniprot_projected_generator(gene_name, deadline=None):
+    if UNIPROT_BACKEND == "mirror":
+        mirror = get_mirror()
+        entries = [
+            projected_entry(mirror.get_entry(isoform))
+            for isoform in mirror.search(gene_name)
+        ]
+        yield {"entries": entries, "next_link": None}
+        return
+    url = f"https://rest.uniprot.org/uniprotkb/search?query=(reviewed:true)+AND+(taxonomy_id:9606)+AND+{gene_name}&includeIsoform=true&format=json&fields={PROJECTED_FIELDS}&size={SEARCH_PAGE_SIZE}"
+    yield from prefetch_pages(search_uniprot_projected, url, deadline)
 
-def get_sequence(isoform):
+
+def get_sequence(isoform, deadline=None):
+    if UNIPROT_BACKEND == "mirror":
+        return get_mirror().get_sequence(isoform)
     url = f"https://www.uniprot.org/uniprot/{isoform}.fasta"
-    response = session.get(url)
-    response.raise_for_status()
+    response = uniprot_get(url, deadline)
     sequence = "".join(response.text.strip().split("\n")[1:])
     return sequence
 
 
-def get_sequences_generator(isoforms):
-    for isoform in isoforms:
-        sequence = get_sequence(isoform)
+class ConcurrentFetches:
+    # Run fetch over items on a thread pool, submitting items as they become
+    # known, and yield each (item, result) as it arrives. With a deadline,
+    # stop waiting when it runs out and skip items whose fetch ran out of
+    # time, so the caller carries on with what it has; items whose fetch
+    # failed otherwise are skipped too, and recorded in errors for the
+    # caller to report.
+    def __init__(self, fetch, max_workers=FETCH_WORKERS, deadline=None, errors=None):
+        self.fetch = fetch
+        self.deadline = deadline
+        self.errors = {} if errors is None else errors
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.futures = {}
+
+    def submit(self, items):
+        for item in items:
+            self.futures[self.executor.submit(self.fetch, item)] = item
+
+    def results(self):
+        timeout = self.deadline.remaining() if self.deadline else None
+        try:
+            for future in as_completed(self.futures, timeout=timeout):
+                item = self.futures[future]
+                try:
+                    result = future.result()
+                except (DeadlineExceeded, requests.RequestException) as err:
+                    if self.deadline is None:
+                        raise
+                    if not (
+                        isinstance(err, DeadlineExceeded) or self.deadline.expired()
+                    ):
+                        self.errors[item] = err
+                    continue
+                yield item, result
+        except FuturesTimeoutError:
+            pass
+
+    def close(self):
+        # Don't keep fetching if the client went away
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_concurrently(
+    fetch, items, max_workers=FETCH_WORKERS, deadline=None, errors=None
+):
+    fetches = ConcurrentFetches(fetch, max_workers, deadline, errors)
+    try:
+        fetches.submit(items)
+        yield from fetches.results()
+    finally:
+        fetches.close()
+
+
+def get_sequences_generator(isoforms, max_workers=FETCH_WORKERS, deadline=None):
+    fetch = partial(get_sequence, deadline=deadline)
+    for isoform, sequence in fetch_concurrently(fetch, isoforms, max_workers, deadline):
         yield {"isoform": isoform, "sequence": sequence}
 
 
@@ -172,13 +288,9 @@ def search_residue(sequence, residue, position):
     return False
 
 
-def get_gene_name(uniprot_id):
-    url = f"https://www.uniprot.org/uniprot/{uniprot_id}.json"
-    response = session.get(url)
-    response.raise_for_status()
-    data = response.json()
+def gene_name_from_entry(data):
     gene_name = None
-    if "genes" in data:
+    if data.get("genes"):
         first_gene = data["genes"][0]
         try:
             gene_name = first_gene["geneName"]["value"]
@@ -187,25 +299,172 @@ def get_gene_name(uniprot_id):
     return gene_name
 
 
-def get_gene_names_generator(isoforms):
-    for isoform in isoforms:
-        gene_name = get_gene_name(isoform)
-        yield {"isoform": isoform, "gene_name": gene_name}
+def pdb_ids_from_entry(data):
+    pdb_ids = []
+    for reference in data.get("uniProtKBCrossReferences", []):
+        if reference["database"] == "PDB":
+            pdb_id = reference["id"]
+            chains_specifier = None
+            resolution = None
+            if "properties" in reference:
+                for prop in reference["properties"]:
+                    if prop["key"] == "Chains":
+                        chains_specifier = prop["value"]
+                    if prop["key"] == "Resolution":
+                        resolution = prop["value"]
+            pdb_ids.append([pdb_id, chains_specifier, resolution])
+    return pdb_ids
+
+
+def get_entry(uniprot_id, deadline=None):
+    if UNIPROT_BACKEND == "mirror":
+        return get_mirror().get_entry(uniprot_id)
+    url = f"https://www.uniprot.org/uniprot/{uniprot_id}.json"
+    response = uniprot_get(url, deadline)
+    return response.json()
 
 
-# Function to calculate similarity between two sequences using PairwiseAligner
-def calculate_similarity(sequence1, sequence2):
-    aligner = PairwiseAligner()
-    aligner.mode = "global"
-    aligner.match_score = 1
-    aligner.mismatch_score = -1
-    alignments = aligner.align(sequence1, sequence2)
-    best_alignment = alignments[0]
-    alignment_score = best_alignment.score
-    return alignment_score
+def get_gene_name(uniprot_id):
+    return gene_name_from_entry(get_entry(uniprot_id))
+
+
+class EntryRecords:
+    # UniProt entry records for one request, each fetched at most once and
+    # shared by the gene-name filter and the PDB cross-reference stage.
+    # Fetches that failed under a deadline are left out and kept in errors.
+    def __init__(self, max_workers=FETCH_WORKERS, deadline=None):
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.records = {}
+        self.errors = {}
+
+    def fetch_generator(self, isoforms):
+        # Yield the records already held, then fetch the rest concurrently
+        missing = []
+        for isoform in isoforms:
+            if isoform in self.records:
+                yield isoform, self.records[isoform]
+            else:
+                missing.append(isoform)
+        fetch = partial(get_entry, deadline=self.deadline)
+        for isoform, data in fetch_concurrently(
+            fetch, missing, self.max_workers, self.deadline, self.errors
+        ):
+            self.records[isoform] = data
+            yield isoform, data
+
+    def get(self, isoform):
+        if isoform not in self.records:
+            self.records[isoform] = get_entry(isoform, self.deadline)
+        return self.records[isoform]
+
+
+def get_gene_names_generator(isoforms, entries=None):
+    if entries is None:
+        entries = EntryRecords()
+    for isoform, data in entries.fetch_generator(isoforms):
+        yield {"isoform": isoform, "gene_name": gene_name_from_entry(data)}
+
+
+def collect_isoforms(
+    gene_name,
+    all_isoforms,
+    max_workers=FETCH_WORKERS,
+    search_mode=SEARCH_MODE,
+    deadline=None,
+    errors=None,
+):
+    # Search UniProt for the gene's isoforms and their sequences, filling
+    # all_isoforms and yielding progress events. Sequence fetches that
+    # failed under a deadline are recorded in errors.
+    if search_mode == "projected":
+        # Sequences, gene names and PDB cross-references come with the search
+        for result in search_uniprot_projected_generator(gene_name, deadline):
+            for entry in result["entries"]:
+                all_isoforms[entry["isoform"]] = {
+                    "sequence": entry["sequence"],
+                    "gene_name": entry["gene_name"],
+                    "pdb_ids": entry["pdb_ids"],
+                }
+            yield {"message": f"got {len(all_isoforms)} isoforms"}
+        yield {"all_isoforms": list(all_isoforms.keys())}
+        for sequences_found, isoform in enumerate(all_isoforms, start=1):
+            yield {
+                "message": f"got sequence for {isoform}",
+                "type": "sequence",
+                "isoform": isoform,
+            }
+            yield {"message": f"got {sequences_found} / {len(all_isoforms)} sequences"}
+    else:
+        # Each page's sequences start downloading as soon as the page arrives,
+        # while the next page is still in flight
+        sequences = ConcurrentFetches(
+            partial(get_sequence, deadline=deadline), max_workers, deadline, errors
+        )
+        try:
+            for result in search_uniprot_generator(gene_name, deadline):
+                isoforms = [
+                    isoform
+                    for isoform in result["isoforms"]
+                    if isoform not in all_isoforms
+                ]
+                for isoform in isoforms:
+                    all_isoforms[isoform] = {
+                        "sequence": None,
+                        "gene_name": None,
+                        "pdb_ids": None,
+                    }
+                sequences.submit(isoforms)
+                yield {"message": f"got {len(all_isoforms)} isoforms"}
+            yield {"all_isoforms": list(all_isoforms.keys())}
+
+            # Collect all sequences
+            sequences_found = 0
+            for isoform, sequence in sequences.results():
+                all_isoforms[isoform]["sequence"] = sequence
+                sequences_found += 1
+                yield {
+                    "message": f"got sequence for {isoform}",
+                    "type": "sequence",
+                    "isoform": isoform,
+                }
+                yield {
+                    "message": f"got {sequences_found} / {len(all_isoforms)} sequences"
+                }
+            for isoform, err in sequences.errors.items():
+                yield {"message": f"fetching the sequence of {isoform} failed: {err}"}
+        finally:
+            sequences.close()
+
+
+def collect_gene_names(isoforms, all_isoforms, entries, search_mode=SEARCH_MODE):
+    # Fill in the gene name of each of isoforms, yielding progress events
+    if search_mode == "projected":
+        gene_names = (
+            {"isoform": isoform, "gene_name": all_isoforms[isoform]["gene_name"]}
+            for isoform in isoforms
+        )
+    else:
+        gene_names = get_gene_names_generator(isoforms, entries)
+    for result in gene_names:
+        isoform = result["isoform"]
+        this_gene_name = result["gene_name"]
+        all_isoforms[isoform]["gene_name"] = this_gene_name
+        yield {
+            "message": f"got gene name for {isoform}: {this_gene_name}",
+            "gene_name": this_gene_name,
+        }
 
 
-def process(gene_name, residue1, position, residue2):
+def process(
+    gene_name,
+    residue1,
+    position,
+    residue2,
+    max_workers=FETCH_WORKERS,
+    search_mode=SEARCH_MODE,
+    deadline_seconds=DEADLINE_SECONDS,
+):
     print("Gene Name:", gene_name)
     print("Residue 1:", residue1)
     print("Position:", position)
@@ -229,53 +488,41 @@ def process(gene_name, residue1, position, residue2):
         "message": charge_statement,
     }
 
+    # Every stage shares one time budget; stages cut short by it carry on
+    # with what they got, and the stream ends with partial results
+    deadline = Deadline(deadline_seconds)
+
     # Collect all isoforms
     all_isoforms = {}
-    for result in search_uniprot_generator(gene_name):
-        isoforms = result["isoforms"]
-        for isoform in isoforms:
-            all_isoforms[isoform] = {
-                "sequence": None,
-                "gene_name": None,
-            }
-        yield {"message": f"got {len(all_isoforms)} isoforms"}
-    yield {"all_isoforms": list(all_isoforms.keys())}
-
-    # Collect all sequences
-    sequences_found = 0
-    for result in get_sequences_generator(all_isoforms):
-        isoform = result["isoform"]
-        sequence = result["sequence"]
-        all_isoforms[isoform]["sequence"] = sequence
-        sequences_found += 1
-        yield {
-            "message": f"got sequence for {isoform}",
-            "type": "sequence",
-            "isoform": isoform,
-        }
-        yield {"message": f"got {sequences_found} / {len(all_isoforms)} sequences"}
+    entries = EntryRecords(max_workers, deadline)
+    sequence_errors = {}
+    try:
+        yield from collect_isoforms(
+            gene_name, all_isoforms, max_workers, search_mode, deadline, sequence_errors
+        )
+    except (DeadlineExceeded, requests.RequestException) as err:
+        if isinstance(err, DeadlineExceeded) or deadline.expired():
+            message = f"ran out of time searching UniProt for {gene_name}"
+        else:
+            message = f"searching UniProt for {gene_name} failed: {err}"
+        yield {"message": message, "all_isoforms": list(all_isoforms.keys())}
 
     # Find isoforms with residue1 at position
+    packed = PackedSequences(
+        all_isoforms, [data["sequence"] or "" for data in all_isoforms.values()]
+    )
+    found = packed.match([(position, residue1)])
     matching_isoforms = {}
-    for isoform, data in all_isoforms.items():
-        sequence = data["sequence"]
-        if search_residue(sequence, residue1, position):
-            matching_isoforms[isoform] = data
-            yield {"message": f"found {isoform} with {residue1} at position {position}"}
+    for isoform in packed.matching(found[:, 0]):
+        matching_isoforms[isoform] = all_isoforms[isoform]
+        yield {"message": f"found {isoform} with {residue1} at position {position}"}
     yield {
         "message": f"found {len(matching_isoforms)} matching isoforms",
         "matching_isoforms": list(matching_isoforms.keys()),
     }
 
     # Get gene names for matching isoforms
-    for result in get_gene_names_generator(matching_isoforms.keys()):
-        isoform = result["isoform"]
-        this_gene_name = result["gene_name"]
-        all_isoforms[isoform]["gene_name"] = this_gene_name
-        yield {
-            "message": f"got gene name for {isoform}: {this_gene_name}",
-            "gene_name": this_gene_name,
-        }
+    yield from collect_gene_names(matching_isoforms, all_isoforms, entries, search_mode)
 
     # Filter isforms that match the input gene name
     filtered_isoforms = {}
@@ -289,17 +536,39 @@ def process(gene_name, residue1, position, residue2):
         "filtered_isoforms": list(filtered_isoforms.keys()),
     }
 
-    # Pairwise similary scores
+    # Pairwise similary scores, computed once per unordered pair
+    isoform_names = list(filtered_isoforms)
+    sequences = [filtered_isoforms[isoform]["sequence"] for isoform in isoform_names]
+    # Long isoforms are aligned within a band to bound memory
+    methods = alignment_methods(sequences)
+    methods_message = ", ".join(
+        f"{count} {method}" for method, count in methods.items()
+    )
+    if "banded" in methods:
+        methods_message += f" (banded above {LONG_SEQUENCE_THRESHOLD} residues)"
+    yield {
+        "type": "alignment_method",
+        "message": f"aligning isoform pairs: {methods_message}",
+        "alignment_methods": methods,
+    }
+    scores = {}
+    for i, row in similarity_rows(sequences):
+        if deadline.expired():
+            break
+        isoform1 = isoform_names[i]
+        for k, alignment_score in enumerate(row):
+            isoform2 = isoform_names[i + k]
+            scores[(isoform1, isoform2)] = alignment_score
+            scores[(isoform2, isoform1)] = alignment_score
+            method = alignment_method(sequences[i], sequences[i + k])
+            yield {
+                "message": f"similarity for {isoform1} and {isoform2}: {alignment_score} ({method})"
+            }
     pairwise_scores = {}
     for isoform1 in filtered_isoforms:
         for isoform2 in filtered_isoforms:
-            sequence1 = filtered_isoforms[isoform1]["sequence"]
-            sequence2 = filtered_isoforms[isoform2]["sequence"]
-            alignment_score = calculate_similarity(sequence1, sequence2)
-            pairwise_scores[(isoform1, isoform2)] = alignment_score
-            yield {
-                "message": f"similarity for {isoform1} and {isoform2}: {alignment_score}"
-            }
+            if (isoform1, isoform2) in scores:
+                pairwise_scores[(isoform1, isoform2)] = scores[(isoform1, isoform2)]
     # Convert the dictionary with tuple keys to a list of dictionaries that is JSON serializable
     pairwise_scores_list = []
     for (isoform1, isoform2), score in pairwise_scores.items():
@@ -311,29 +580,202 @@ def process(gene_name, residue1, position, residue2):
     }
 
     # PDB IDs
+    missing = [
+        isoform
+        for isoform in filtered_isoforms
+        if filtered_isoforms[isoform]["pdb_ids"] is None
+    ]
+    for isoform, data in entries.fetch_generator(missing):
+        filtered_isoforms[isoform]["pdb_ids"] = pdb_ids_from_entry(data)
     pdb_ids = {}
     for isoform in filtered_isoforms:
-        pdb_ids[isoform] = []
-        json_url = f"https://www.uniprot.org/uniprot/{isoform}.json"
-        response = session.get(json_url)
-        response.raise_for_status()
-        data = response.json()
-        references = data["uniProtKBCrossReferences"]
-        for reference in references:
-            if reference["database"] == "PDB":
-                pdb_id = reference["id"]
-                chains_specifier = None
-                resolution = None
-                if "properties" in reference:
-                    for prop in reference["properties"]:
-                        if prop["key"] == "Chains":
-                            chains_specifier = prop["value"]
-                        if prop["key"] == "Resolution":
-                            resolution = prop["value"]
-                pdb_ids[isoform].append([pdb_id, chains_specifier, resolution])
+        if filtered_isoforms[isoform]["pdb_ids"] is not None:
+            pdb_ids[isoform] = filtered_isoforms[isoform]["pdb_ids"]
+
+    if deadline.expired():
+        incomplete = {
+            "sequences": sum(
+                data["sequence"] is None for data in all_isoforms.values()
+            ),
+            "gene_names": sum(
+                data["gene_name"] is None for data in matching_isoforms.values()
+            ),
+            "pairwise_scores": len(filtered_isoforms) ** 2 - len(pairwise_scores),
+            "pdb_ids": len(filtered_isoforms) - len(pdb_ids),
+        }
+        yield {
+            "type": "deadline",
+            "message": f"time budget of {deadline.seconds:.0f}s ran out; results are partial",
+            "partial": True,
+            "incomplete": incomplete,
+        }
+    # Fetches that failed for reasons other than the deadline
+    failed = {
+        "sequences": {isoform: str(err) for isoform, err in sequence_errors.items()},
+        "entries": {isoform: str(err) for isoform, err in entries.errors.items()},
+    }
+    if any(failed.values()):
+        count = sum(len(errors) for errors in failed.values())
+        yield {
+            "type": "fetch_errors",
+            "message": f"{count} UniProt requests failed; results are partial",
+            "partial": True,
+            "failed": failed,
+        }
     yield {"type": "pdb_ids", "pdb_ids": pdb_ids}
 
 
+# Genes worked on at once by process_batch
+BATCH_GENE_WORKERS = int(os.environ.get("MUTANTAUTOMATE_BATCH_GENE_WORKERS", "4"))
+
+
+def annotate_variant(gene_name, residue1, position, residue2):
+    # The substitution-specific part of process(), without the event stream
+    result = {}
+    if residue2:
+        result.update(get_grantham_score_with_statement(residue1, residue2))
+        result["charge_statement"] = get_charge_statement(residue1, residue2, position)
+    return result
+
+
+def process_gene_variants(
+    gene_name, variants, max_workers=FETCH_WORKERS, search_mode=SEARCH_MODE
+):
+    # Run process() for many (index, variant) pairs of one gene, sharing the
+    # isoform search, sequences, gene names, alignments and PDB xrefs
+    all_isoforms = {}
+    entries = EntryRecords(max_workers)
+    for _ in collect_isoforms(gene_name, all_isoforms, max_workers, search_mode):
+        pass
+
+    # Match every variant's residue in one step
+    packed = PackedSequences(
+        all_isoforms, [data["sequence"] for data in all_isoforms.values()]
+    )
+    found = packed.match(
+        [(variant["position"], variant["residue1"]) for _, variant in variants]
+    )
+    matching_by_variant = [
+        packed.matching(found[:, column]) for column in range(len(variants))
+    ]
+
+    # Gene names, alignments and PDB xrefs for the union of matching isoforms
+    matching_isoforms = list(
+        dict.fromkeys(
+            isoform for matching in matching_by_variant for isoform in matching
+        )
+    )
+    for _ in collect_gene_names(matching_isoforms, all_isoforms, entries, search_mode):
+        pass
+    gene_isoforms = [
+        isoform
+        for isoform in matching_isoforms
+        if all_isoforms[isoform]["gene_name"] == gene_name
+    ]
+    scores = similarity_matrix(
+        gene_isoforms, [all_isoforms[isoform]["sequence"] for isoform in gene_isoforms]
+    )
+    for isoform, data in entries.fetch_generator(
+        [
+            isoform
+            for isoform in gene_isoforms
+            if all_isoforms[isoform]["pdb_ids"] is None
+        ]
+    ):
+        all_isoforms[isoform]["pdb_ids"] = pdb_ids_from_entry(data)
+
+    results = []
+    for (index, variant), matching in zip(variants, matching_by_variant):
+        filtered = [isoform for isoform in matching if isoform in gene_isoforms]
+        result = {"index": index, "variant": variant}
+        try:
+            result.update(
+                annotate_variant(
+                    gene_name,
+                    variant["residue1"],
+                    variant["position"],
+                    variant.get("residue2"),
+                )
+            )
+        except KeyError as err:
+            result["error"] = f"unknown residue {err}"
+        result.update(
+            {
+                "all_isoforms": list(all_isoforms),
+                "matching_isoforms": matching,
+                "filtered_isoforms": filtered,
+                "pairwise_scores": [
+                    {
+                        "isoform1": isoform1,
+                        "isoform2": isoform2,
+                        "score": scores[(isoform1, isoform2)],
+                    }
+                    for isoform1 in filtered
+                    for isoform2 in filtered
+                ],
+                "pdb_ids": {
+                    isoform: all_isoforms[isoform]["pdb_ids"] for isoform in filtered
+                },
+            }
+        )
+        results.append(result)
+    return results
+
+
+def process_batch(
+    variants,
+    max_workers=FETCH_WORKERS,
+    gene_workers=BATCH_GENE_WORKERS,
+    search_mode=SEARCH_MODE,
+):
+    # Run many variants ({"gene_name", "residue1", "position", "residue2"}),
+    # grouped by gene so upstream work is done once per gene, with genes run
+    # concurrently. Yields one result per variant, carrying its index in
+    # variants, as soon as its gene is finished.
+    variants_by_gene = {}
+    for index, variant in enumerate(variants):
+        try:
+            variant = {
+                "gene_name": str(variant["gene_name"]).strip(),
+                "residue1": str(variant["residue1"]).strip().upper(),
+                "position": int(variant["position"]),
+                "residue2": str(variant.get("residue2") or "").strip().upper() or None,
+            }
+        except (KeyError, TypeError, ValueError) as err:
+            yield {
+                "index": index,
+                "variant": variant,
+                "error": f"invalid variant: {err}",
+            }
+            continue
+        variants_by_gene.setdefault(variant["gene_name"], []).append((index, variant))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, gene_workers))
+    try:
+        futures = {
+            executor.submit(
+                process_gene_variants,
+                gene_name,
+                gene_variants,
+                max_workers,
+                search_mode,
+            ): gene_variants
+            for gene_name, gene_variants in variants_by_gene.items()
+        }
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as err:
+                results = [
+                    {"index": index, "variant": variant, "error": str(err)}
+                    for index, variant in futures[future]
+                ]
+            for result in results:
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 # def example():
 #     results = process("NLGN1", "D", 140, "Y")
 #     for result in results:
@@ -432,8 +432,8 @@ def mutate(pdb_obj, chain, res_num, mutate_to, rotamer_lib=None, mutation_type="
     logging.debug(f"Torsion angles: {phi}, {psi}")
     # GET_ATR IS WRONG
     sample_residue = read_sample_residue(mutate_to)
-    starting_points = np.mat([sample_residue["N"], sample_residue["CA"], sample_residue["C"]])
-    end_points = np.mat([_residue["N"].coord, _residue["CA"].coord, _residue["C"].coord])
+    starting_points = np.asmatrix([sample_residue["N"], sample_residue["CA"], sample_residue["C"]])
+    end_points = np.asmatrix([_residue["N"].coord, _residue["CA"].coord, _residue["C"].coord])
 
     sup = SVDSuperimposer.SVDSuperimposer()
     sup.set(end_points, starting_points)
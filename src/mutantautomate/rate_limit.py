@@ -0,0 +1,277 @@
+import os
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter, Retry
+
+# Per-host adaptive rate limiting, shared by every request in the process.
+# Each host gets a token bucket (requests per second) and a concurrency
+# limit. Both grow additively while responses come back healthy and are
+# halved when the host answers 429 or 503 (AIMD), and a Retry-After header
+# holds all requests to that host until it has passed. Rising latency stops
+# the growth before the host starts refusing requests.
+
+RATE_LIMIT_ENABLED = os.environ.get("MUTANTAUTOMATE_RATE_LIMIT", "1") != "0"
+# Ceilings the limits grow towards, per host
+RATE_LIMIT_MAX_RATE = float(os.environ.get("MUTANTAUTOMATE_RATE_LIMIT_MAX_RATE", "50"))
+RATE_LIMIT_MAX_CONCURRENCY = int(
+    os.environ.get("MUTANTAUTOMATE_RATE_LIMIT_MAX_CONCURRENCY", "32")
+)
+
+INITIAL_RATE = 10.0
+INITIAL_CONCURRENCY = 4.0
+MIN_RATE = 0.5
+MIN_CONCURRENCY = 1.0
+RATE_INCREASE = 0.5
+DECREASE_FACTOR = 0.5
+# Stop growing while the smoothed latency is this many times the best seen
+LATENCY_FACTOR = 3.0
+LATENCY_SMOOTHING = 0.2
+# Throttled responses are retried this many times, waiting for Retry-After
+THROTTLE_RETRIES = 5
+THROTTLE_STATUSES = (429, 503)
+MAX_RETRY_AFTER = 120.0
+# Backoff when a throttled response carries no Retry-After
+THROTTLE_BACKOFF = 0.5
+MAX_THROTTLE_BACKOFF = 30.0
+# urllib3 doesn't retry requests under a deadline: each of its retries would
+# start with the full timeout and back off whatever is left of the budget.
+# RateLimitedAdapter.send retries them instead, within the deadline.
+NO_RETRIES = Retry(0, read=False)
+
+
+def parse_retry_after(value):
+    # Seconds to wait, from either delta-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class HostLimiter:
+    def __init__(
+        self,
+        host,
+        max_rate=RATE_LIMIT_MAX_RATE,
+        max_concurrency=RATE_LIMIT_MAX_CONCURRENCY,
+    ):
+        self.host = host
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.rate = min(INITIAL_RATE, max_rate)
+        self.concurrency = min(INITIAL_CONCURRENCY, max_concurrency)
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.latency = None
+        self.best_latency = None
+        self.consecutive_throttles = 0
+        self.last_decrease = 0.0
+        self.counters = {"requests": 0, "throttled": 0, "decreases": 0}
+        self._updated = time.monotonic()
+        self._changed = threading.Condition()
+
+    def _refill(self, now):
+        # Burst capacity is one second's worth of requests
+        self.tokens = min(
+            max(self.rate, 1.0), self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self):
+        # Take a slot and a token and return 0, or return how long to wait
+        with self._changed:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.in_flight >= int(self.concurrency):
+                # Woken by release(); the timeout is only a fallback
+                return 0.05
+            self._refill(now)
+            if self.tokens < 1.0:
+                return (1.0 - self.tokens) / self.rate
+            self.tokens -= 1.0
+            self.in_flight += 1
+            self.counters["requests"] += 1
+            return 0
+
+    def acquire(self, deadline=None):
+        # With a deadline, stop waiting (DeadlineExceeded) when it runs out
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            if deadline is not None:
+                deadline.check(self.host)
+                delay = min(delay, deadline.remaining())
+            with self._changed:
+                self._changed.wait(delay)
+
+    def release(self, status=None, latency=None, retry_after=None):
+        with self._changed:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if status in THROTTLE_STATUSES:
+                self.counters["throttled"] += 1
+                self.consecutive_throttles += 1
+                wait = retry_after
+                if wait is None:
+                    wait = min(
+                        THROTTLE_BACKOFF * 2 ** (self.consecutive_throttles - 1),
+                        MAX_THROTTLE_BACKOFF,
+                    )
+                self.blocked_until = max(self.blocked_until, now + wait)
+                # Requests already in flight when the host pushed back will
+                # be refused too; count that as one signal, not many
+                if now - self.last_decrease > (self.latency or 0.1):
+                    self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+                    self.concurrency = max(
+                        MIN_CONCURRENCY, self.concurrency * DECREASE_FACTOR
+                    )
+                    self.tokens = min(self.tokens, 1.0)
+                    self.last_decrease = now
+                    self.counters["decreases"] += 1
+            elif status is not None and status < 500:
+                self.consecutive_throttles = 0
+                if latency is not None:
+                    if self.latency is None:
+                        self.latency = latency
+                    else:
+                        self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+                    if self.best_latency is None or latency < self.best_latency:
+                        self.best_latency = latency
+                congested = (
+                    self.latency is not None
+                    and self.latency > LATENCY_FACTOR * self.best_latency
+                )
+                if not congested:
+                    # About +1 concurrent request per round of the window
+                    self.concurrency = min(
+                        self.max_concurrency,
+                        self.concurrency + 1.0 / self.concurrency,
+                    )
+                    self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+            self._changed.notify_all()
+
+    def snapshot(self):
+        with self._changed:
+            return {
+                "rate": round(self.rate, 2),
+                "concurrency": round(self.concurrency, 2),
+                "in_flight": self.in_flight,
+                "blocked_for": round(
+                    max(0.0, self.blocked_until - time.monotonic()), 2
+                ),
+                "latency": self.latency,
+                "best_latency": self.best_latency,
+                "consecutive_throttles": self.consecutive_throttles,
+                **self.counters,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host)
+        return limiter
+
+
+def stats():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {host: limiter.snapshot() for host, limiter in limiters.items()}
+
+
+# The deadline of the request each thread is sending, for max_retries
+_sending = threading.local()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    # Every request that reaches the network waits for its host's limiter,
+    # and throttled responses are retried once Retry-After has passed. A
+    # timeout from deadline.Deadline.timeout() carries its deadline: each
+    # attempt then gets what is left of it, and waits and retries stop when
+    # it runs out.
+    @property
+    def max_retries(self):
+        if getattr(_sending, "deadline", None) is not None:
+            return NO_RETRIES
+        return self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, retries):
+        self._max_retries = retries
+
+    def send(self, request, **kwargs):
+        deadline = getattr(kwargs.get("timeout"), "deadline", None)
+        _sending.deadline = deadline
+        try:
+            return self._send(request, deadline, **kwargs)
+        finally:
+            _sending.deadline = None
+
+    def _send(self, request, deadline, **kwargs):
+        host = urlsplit(request.url).hostname
+        limiter = get_limiter(host) if RATE_LIMIT_ENABLED else None
+        throttles = server_errors = 0
+        while True:
+            if deadline is not None:
+                kwargs["timeout"] = deadline.timeout()
+            if limiter is None:
+                response = super().send(request, **kwargs)
+            else:
+                limiter.acquire(deadline)
+                start = time.monotonic()
+                try:
+                    response = super().send(request, **kwargs)
+                except BaseException:
+                    limiter.release()
+                    raise
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                limiter.release(
+                    response.status_code, time.monotonic() - start, retry_after
+                )
+            if (
+                limiter is not None
+                and response.status_code in THROTTLE_STATUSES
+                and throttles < THROTTLE_RETRIES
+            ):
+                throttles += 1
+                print(
+                    f"{response.status_code} from {host}, retrying "
+                    f"{request.url} in {limiter.snapshot()['blocked_for']}s"
+                )
+                response.close()
+                continue
+            # Server errors urllib3 would have retried, had there been no
+            # deadline; a connection error fails the attempt straight away
+            retries = self._max_retries
+            if (
+                deadline is None
+                or response.status_code not in (retries.status_forcelist or ())
+                or server_errors >= (retries.total or 0)
+            ):
+                return response
+            backoff = retries.backoff_factor * 2**server_errors
+            if backoff >= deadline.remaining():
+                return response
+            server_errors += 1
+            print(
+                f"{response.status_code} from {host}, retrying "
+                f"{request.url} in {backoff:.2f}s"
+            )
+            response.close()
+            time.sleep(backoff)
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def ascii_codes(text, name):
+    # One byte per residue; anything else wouldn't fit the uint8 matrix
+    try:
+        return text.encode("ascii")
+    except UnicodeEncodeError:
+        raise ValueError(f"{name} is not ASCII")
+
+
+class PackedSequences:
+    # A gene's isoform sequences packed into one padded uint8 matrix so a
+    # whole batch of (position, residue) queries is answered in one step.
+    # Padding is 0, which never equals a residue letter, so positions past
+    # the end of a shorter isoform simply don't match.
+    def __init__(self, isoforms, sequences):
+        self.isoforms = list(isoforms)
+        self.lengths = np.array(
+            [len(sequence) for sequence in sequences], dtype=np.int64
+        )
+        width = int(self.lengths.max()) if len(self.lengths) else 0
+        self.matrix = np.zeros((len(self.isoforms), width), dtype=np.uint8)
+        for row, sequence in enumerate(sequences):
+            self.matrix[row, : len(sequence)] = np.frombuffer(
+                ascii_codes(sequence, f"sequence of {self.isoforms[row]}"),
+                dtype=np.uint8,
+            )
+
+    def match(self, queries):
+        # queries: [(position, residue)] with 1-based positions.
+        # Returns a boolean isoform x query matrix.
+        positions = np.array([position for position, _ in queries], dtype=np.int64)
+        residues = np.array(
+            [
+                (
+                    ascii_codes(residue, f"residue {residue!r}")[0]
+                    if len(residue) == 1
+                    else 0
+                )
+                for _, residue in queries
+            ],
+            dtype=np.uint8,
+        )
+        width = self.matrix.shape[1]
+        if width == 0 or len(queries) == 0:
+            return np.zeros((len(self.isoforms), len(queries)), dtype=bool)
+        in_range = (positions >= 1) & (positions <= width) & (residues != 0)
+        columns = np.clip(positions - 1, 0, width - 1)
+        return (self.matrix[:, columns] == residues) & in_range
+
+    def matching(self, column):
+        # Isoform names for one column of match()
+        return [isoform for isoform, found in zip(self.isoforms, column) if found]
@@ -0,0 +1,133 @@
+import sys
+import json
+import argparse
+import contextlib
+
+import numpy as np
+
+from process import (
+    FETCH_WORKERS,
+    SEARCH_MODE,
+    EntryRecords,
+    collect_gene_names,
+    collect_isoforms,
+)
+from residue_matcher import PackedSequences
+from substitution import AMINO_ACID_ORDER, aa_charge_dict, sequence_grantham_scores
+
+# Saturation mutagenesis: every substitution at every position in a range,
+# fetching and filtering the gene's isoforms only once.
+
+
+def reference_isoform(isoforms):
+    # Prefer the canonical entry (no "-N" isoform suffix)
+    for isoform in isoforms:
+        if "-" not in isoform:
+            return isoform
+    return isoforms[0]
+
+
+def scan(gene_name, start, end, max_workers=FETCH_WORKERS, search_mode=SEARCH_MODE):
+    # Fetch isoforms, sequences and gene names once for the whole scan
+    all_isoforms = {}
+    entries = EntryRecords(max_workers)
+    yield from collect_isoforms(gene_name, all_isoforms, max_workers, search_mode)
+    yield from collect_gene_names(all_isoforms, all_isoforms, entries, search_mode)
+    gene_isoforms = [
+        isoform
+        for isoform, data in all_isoforms.items()
+        if data["gene_name"] == gene_name
+    ]
+    yield {
+        "message": f"found {len(gene_isoforms)} isoforms of {gene_name}",
+        "filtered_isoforms": gene_isoforms,
+    }
+    if not gene_isoforms:
+        return
+
+    reference = reference_isoform(gene_isoforms)
+    reference_sequence = all_isoforms[reference]["sequence"]
+    positions = np.arange(max(start, 1), min(end, len(reference_sequence)) + 1)
+    yield {
+        "message": f"scanning positions {start}-{end} of {reference}",
+        "reference_isoform": reference,
+        "positions": len(positions),
+    }
+    if len(positions) == 0:
+        return
+
+    # Substitution-independent work for the whole range in one step each
+    packed = PackedSequences(
+        gene_isoforms, [all_isoforms[isoform]["sequence"] for isoform in gene_isoforms]
+    )
+    residues = [reference_sequence[position - 1] for position in positions]
+    found = packed.match(list(zip(positions.tolist(), residues)))
+    grantham = sequence_grantham_scores(reference_sequence)[positions - 1]
+
+    for row, position in enumerate(positions.tolist()):
+        residue1 = residues[row]
+        substitutions = []
+        for column, residue2 in enumerate(AMINO_ACID_ORDER):
+            if residue2 == residue1:
+                continue
+            score = grantham[row, column]
+            substitutions.append(
+                {
+                    "residue2": residue2,
+                    "grantham_score": None if np.isnan(score) else int(score),
+                    "charge_from": aa_charge_dict.get(residue1),
+                    "charge_to": aa_charge_dict[residue2],
+                }
+            )
+        yield {
+            "type": "scan_position",
+            "message": f"scanned {residue1}{position}",
+            "position": position,
+            "residue1": residue1,
+            "matching_isoforms": packed.matching(found[:, row]),
+            "substitutions": substitutions,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score every substitution over a range of positions in a gene"
+    )
+    parser.add_argument("--gene-name", type=str, required=True, help="Gene name")
+    parser.add_argument("--start", type=int, required=True, help="First position")
+    parser.add_argument("--end", type=int, required=True, help="Last position")
+    parser.add_argument(
+        "--format",
+        choices=["tsv", "jsonl"],
+        default="tsv",
+        help="tsv: one line per substitution; jsonl: one line per position",
+    )
+    args = parser.parse_args()
+
+    # Progress goes to stderr so the table can be piped
+    output = sys.stdout
+    if args.format == "tsv":
+        print(
+            "position\tresidue1\tresidue2\tgrantham_score\tcharge_from\tcharge_to\tmatching_isoforms",
+            file=output,
+        )
+    with contextlib.redirect_stdout(sys.stderr):
+        for event in scan(args.gene_name, args.start, args.end):
+            if event.get("type") != "scan_position":
+                if event.get("message"):
+                    print(event["message"])
+                continue
+            if args.format == "jsonl":
+                print(json.dumps(event), file=output)
+                continue
+            for substitution in event["substitutions"]:
+                row = (
+                    event["position"],
+                    event["residue1"],
+                    substitution["residue2"],
+                    substitution["grantham_score"],
+                    substitution["charge_from"],
+                    substitution["charge_to"],
+                    ",".join(event["matching_isoforms"]),
+                )
+                print("\t".join(str(value) for value in row), file=output)
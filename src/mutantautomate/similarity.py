@@ -0,0 +1,213 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from Bio.Align import PairwiseAligner
+
+from alignment_cache import cached_score
+
+# Below this many pairs, handing work to the process pool costs more than it saves
+POOL_MIN_PAIRS = int(os.environ.get("MUTANTAUTOMATE_SIMILARITY_POOL_MIN_PAIRS", "16"))
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+SIMILARITY_WORKERS = int(
+    os.environ.get("MUTANTAUTOMATE_SIMILARITY_WORKERS", str(available_cpus()))
+)
+
+
+# Scoring of the original calculate_similarity (match 1, mismatch -1, and
+# PairwiseAligner's default gap score), which the banded alignment reproduces
+# so long pairs score on the same scale as the rest
+MATCH_SCORE = 1
+MISMATCH_SCORE = -1
+GAP_SCORE = -1
+# Part of every cached score's key
+SCORING = f"match={MATCH_SCORE},mismatch={MISMATCH_SCORE},gap={GAP_SCORE}"
+
+# Pairs where either sequence is longer than this (titin-class proteins) use
+# a banded alignment, whose memory is bounded by the band width
+LONG_SEQUENCE_THRESHOLD = int(
+    os.environ.get("MUTANTAUTOMATE_LONG_SEQUENCE_THRESHOLD", "10000")
+)
+# Extra diagonals kept on each side of the band, and the k-mer size used to
+# find where the sequences line up
+BAND_MARGIN = int(os.environ.get("MUTANTAUTOMATE_BAND_MARGIN", "128"))
+SEED_KMER = 12
+
+
+def make_aligner():
+    aligner = PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = MATCH_SCORE
+    aligner.mismatch_score = MISMATCH_SCORE
+    return aligner
+
+
+# One aligner per process, reused for every score
+_aligner = None
+
+
+def get_aligner():
+    global _aligner
+    if _aligner is None:
+        _aligner = make_aligner()
+    return _aligner
+
+
+# Function to calculate similarity between two sequences using PairwiseAligner
+def calculate_similarity(sequence1, sequence2):
+    # Score-only: the score is all we use, so never build the alignments
+    method = alignment_method(sequence1, sequence2)
+    compute = banded_score if method == "banded" else align_score
+    return cached_score(
+        sequence1,
+        sequence2,
+        compute,
+        method=method,
+        scoring=SCORING,
+        self_score=self_score,
+    )
+
+
+def alignment_method(sequence1, sequence2):
+    if max(len(sequence1), len(sequence2)) > LONG_SEQUENCE_THRESHOLD:
+        return "banded"
+    return "global"
+
+
+def align_score(sequence1, sequence2):
+    return get_aligner().score(sequence1, sequence2)
+
+
+def seed_diagonals(sequence1, sequence2, k=SEED_KMER):
+    # Diagonals (j - i) of k-mers that occur exactly once in each sequence
+    positions1 = {}
+    for i in range(len(sequence1) - k + 1):
+        kmer = sequence1[i : i + k]
+        positions1[kmer] = -1 if kmer in positions1 else i
+    positions2 = {}
+    for j in range(len(sequence2) - k + 1):
+        kmer = sequence2[j : j + k]
+        positions2[kmer] = -1 if kmer in positions2 else j
+    return [
+        j - positions1[kmer]
+        for kmer, j in positions2.items()
+        if j >= 0 and positions1.get(kmer, -1) >= 0
+    ]
+
+
+def banded_score(sequence1, sequence2, margin=BAND_MARGIN):
+    # Global alignment score restricted to a band of diagonals. The band
+    # always spans the start and end corners and is widened to cover every
+    # shared k-mer anchor, so skipped exons stay inside it. Only one row of
+    # the band is kept at a time, so memory is O(band width).
+    n, m = len(sequence1), len(sequence2)
+    anchors = seed_diagonals(sequence1, sequence2)
+    low = max(min([0, m - n] + anchors) - margin, -n)
+    high = min(max([0, m - n] + anchors) + margin, m)
+    diagonals = np.arange(low, high + 1)
+    codes1 = np.frombuffer(sequence1.encode("ascii"), dtype=np.uint8)
+    codes2 = np.frombuffer(sequence2.encode("ascii"), dtype=np.uint8)
+    gap_offsets = diagonals * GAP_SCORE
+
+    # Row 0: only gaps in sequence1
+    row = np.where(diagonals >= 0, diagonals * GAP_SCORE, -np.inf).astype(float)
+    for i in range(1, n + 1):
+        columns = i + diagonals
+        valid = (columns >= 0) & (columns <= m)
+        # Match or mismatch from (i - 1, j - 1), on the same diagonal
+        residues = codes2[np.clip(columns - 1, 0, m - 1)]
+        diagonal = row + np.where(
+            residues == codes1[i - 1], MATCH_SCORE, MISMATCH_SCORE
+        )
+        diagonal[columns < 1] = -np.inf
+        # Gap from (i - 1, j), one diagonal to the right
+        up = np.full_like(row, -np.inf)
+        up[:-1] = row[1:] + GAP_SCORE
+        best = np.maximum(diagonal, up)
+        best[~valid] = -np.inf
+        # Gap from (i, j - 1) runs along the row: a running maximum
+        row = np.maximum.accumulate(best - gap_offsets) + gap_offsets
+        row[~valid] = -np.inf
+    return float(row[m - n - low])
+
+
+def self_score(sequence):
+    # A sequence aligned to itself matches at every position
+    return float(len(sequence) * get_aligner().match_score)
+
+
+def score_row(sequences):
+    # Scores of sequences[0] against itself and every sequence after it
+    first = sequences[0]
+    return [calculate_similarity(first, other) for other in sequences]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # Shared by every request in this process; forkserver children don't
+    # inherit the web server's threads and locks
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else None
+            )
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, SIMILARITY_WORKERS), mp_context=context
+            )
+        return _pool
+
+
+def similarity_rows(sequences):
+    # Yield (i, row) for the upper triangle of the similarity matrix, where
+    # row[k] is the score of sequences[i] against sequences[i + k]. Scores are
+    # symmetric, so the lower triangle is never computed. Rows are yielded as
+    # they finish, not in order.
+    pairs = len(sequences) * (len(sequences) + 1) // 2
+    if SIMILARITY_WORKERS <= 1 or pairs < POOL_MIN_PAIRS:
+        for i in range(len(sequences)):
+            yield i, score_row(sequences[i:])
+        return
+    pool = get_pool()
+    futures = {pool.submit(score_row, sequences[i:]): i for i in range(len(sequences))}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # Don't keep the pool busy if the client went away
+        for future in futures:
+            future.cancel()
+
+
+def alignment_methods(sequences):
+    # How many pairs of the upper triangle each method will score
+    counts = {}
+    for i in range(len(sequences)):
+        for j in range(i, len(sequences)):
+            method = alignment_method(sequences[i], sequences[j])
+            counts[method] = counts.get(method, 0) + 1
+    return counts
+
+
+def similarity_matrix(names, sequences):
+    # Full {(name1, name2): score} map from the upper triangle
+    scores = {}
+    for i, row in similarity_rows(sequences):
+        for k, score in enumerate(row):
+            scores[(names[i], names[i + k])] = score
+            scores[(names[i + k], names[i])] = score
+    return scores
@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    # Coalesce identical work that is in flight at the same time: the first
+    # caller for a key runs the function, everyone who arrives before it
+    # finishes waits for and shares that result (or exception). Followers
+    # wait at most timeout seconds (concurrent.futures.TimeoutError).
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._counters = {"calls": 0, "executed": 0, "shared": 0, "errors": 0}
+
+    def do(self, key, fn, *args, timeout=None, **kwargs):
+        with self._lock:
+            self._counters["calls"] += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self._counters["executed"] += 1
+            else:
+                self._counters["shared"] += 1
+        if not leader:
+            return future.result(timeout)
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as err:
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._in_flight[key]
+            future.set_exception(err)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "in_flight": len(self._in_flight)}
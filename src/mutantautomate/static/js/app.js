@@ -80,6 +80,11 @@ const charge_statement_signal = computed(() => {
 });
 
 function addEvent(event) {
+  // A restarted job sends all of its events again
+  if (event.type === "restart") {
+    events_signal.value = [event];
+    return;
+  }
   events_signal.value = [...events_signal.value, event];
 }
 
@@ -103,6 +108,13 @@ function startProcessing() {
   url.searchParams.append("position", position_signal);
   url.searchParams.append("residue2", residue2_signal);
 
+  listenToJob(url);
+}
+
+// The pipeline runs as a background job, so a dropped connection reattaches
+// to the same job and resumes after the last event received
+function listenToJob(url, retries = 5, last_event_id = null) {
+  let job_id = null;
   const eventSource = new EventSource(url);
 
   eventSource.onmessage = (event) => {
@@ -114,6 +126,15 @@ function startProcessing() {
       console.error(e);
       return;
     }
+    if (parsed.job_id) {
+      job_id = parsed.job_id;
+      if (url.searchParams.has("job_id")) {
+        return;
+      }
+    }
+    if (event.lastEventId) {
+      last_event_id = event.lastEventId;
+    }
     addEvent(parsed);
     if (parsed.type === "done") {
       is_running_signal.value = false;
@@ -125,6 +146,16 @@ function startProcessing() {
   eventSource.onerror = (error) => {
     console.error("EventSource failed:", error);
     eventSource.close();
+    if (job_id && retries > 0) {
+      const resume_url = new URL("/process", window.location.origin);
+      resume_url.searchParams.append("job_id", job_id);
+      if (last_event_id) {
+        resume_url.searchParams.append("after", last_event_id);
+      }
+      setTimeout(() => listenToJob(resume_url, retries - 1, last_event_id), 1000);
+    } else {
+      is_running_signal.value = false;
+    }
   };
 }
 
@@ -136,20 +167,34 @@ async function fetchSequence(isoform) {
   sequence_signal.value = response.split("\n").slice(1).join("\n");
 }
 
-async function getDSSP({ pdb_string }) {
+// Fetch a structure through the server, which caches and parses it once.
+// The returned `structure` ({ handle }) names it in /dssp and /mutate, so the
+// PDB text isn't sent back.
+async function fetchStructure(url) {
+  const response = await fetch(url);
+  const pdb_string = await response.text();
+  if (!response.ok) {
+    // The body is the server's error message, not a structure
+    const message = `Fetching structure failed (${response.status}): ${pdb_string}`;
+    addEvent({ type: "error", message });
+    throw new Error(message);
+  }
+  const structure = { handle: response.headers.get(`X-Structure-Handle`) };
+  return { pdb_string, structure };
+}
+
+async function getDSSP({ structure }) {
   const dssp_data = await fetch(`/dssp`, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
     },
-    body: JSON.stringify({
-      pdb_string,
-    }),
+    body: JSON.stringify(structure),
   }).then((res) => res.json());
   dssp_signal.value = dssp_data;
 }
 
-async function getMutated({ pdb_string, chain_id, position, to_residue }) {
+async function getMutated({ structure, chain_id, position, to_residue }) {
   loading_mutated_signal.value = true;
   const mutated_pdb_data = await fetch(`/mutate`, {
     method: "POST",
@@ -157,7 +202,7 @@ async function getMutated({ pdb_string, chain_id, position, to_residue }) {
       "Content-Type": "application/json",
     },
     body: JSON.stringify({
-      pdb_string,
+      ...structure,
       chain_id,
       position,
       to_residue,
@@ -175,27 +220,20 @@ async function fetchPDB({ isoform, pdb_id, chains }) {
   pdb_data_mutated_signal.value = null;
   dssp_signal.value = null;
   await fetchSequence(isoform);
-  const pdb_string_raw = await fetch(
-    `https://files.rcsb.org/download/${pdb_id}.pdb`
-  ).then((res) => res.text());
   // NOTE: Just trim to the first chain
   const trim_to_chain = chains?.[0];
   if (!trim_to_chain) {
     throw new Error(`No chains found for ${isoform}`);
     return;
   }
-  console.log(`Trimming PDB to chain: ${trim_to_chain}`);
-  const trimmed = await fetch(`/trim_pdb`, {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-    },
-    body: JSON.stringify({ pdb_data: pdb_string_raw, chains: [trim_to_chain] }),
-  }).then((res) => res.text());
+  console.log(`Fetching PDB trimmed to chain: ${trim_to_chain}`);
+  const { pdb_string: trimmed, structure } = await fetchStructure(
+    `/structure/rcsb/${pdb_id}?chains=${trim_to_chain}`
+  );
   pdb_data_trimmed_signal.value = trimmed;
-  await getDSSP({ pdb_string: trimmed });
+  await getDSSP({ structure });
   await getMutated({
-    pdb_string: trimmed,
+    structure,
     chain_id: trim_to_chain,
     position: position_signal.value,
     to_residue: residue2_signal.value
@@ -211,17 +249,16 @@ async function fetchPDBFromAlphaFold(isoform) {
   dssp_signal.value = null;
   if (!isoform) return;
   await fetchSequence(isoform);
+  // The server looks up the model for the canonical accession
   const fixed_isoform = isoform.split("-")[0];
-  const url = `https://alphafold.ebi.ac.uk/api/prediction/${fixed_isoform}`;
-  const response = await fetch(url).then((res) => res.json());
-  const [first] = response;
-  const pdb_url = first?.pdbUrl;
-  const pdb_string_raw = await fetch(pdb_url).then((res) => res.text());
+  const { pdb_string: pdb_string_raw, structure } = await fetchStructure(
+    `/structure/alphafold/${fixed_isoform}`
+  );
   // We do not need to trim
   pdb_data_trimmed_signal.value = pdb_string_raw;
-  await getDSSP({ pdb_string: pdb_string_raw });
+  await getDSSP({ structure });
   await getMutated({
-    pdb_string: pdb_string_raw,
+    structure,
     chain_id: null,
     position: position_signal.value,
     to_residue: residue2_signal.value
@@ -0,0 +1,355 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+import requests
+
+from http_cache import CACHE_DIR
+from http_client import download, session
+from pdb_stream import trim_file
+from singleflight import SingleFlight
+from structure_formats import (
+    FORMATS,
+    convert_structure,
+    decode_structure,
+    structure_format,
+)
+
+# Structures fetched from RCSB or AlphaFold on the server and kept on disk,
+# each file named by the SHA-256 of its contents. A SQLite index maps
+# "<source>/<id>" (and "<source>/<id>?chains=A,B" for trimmed copies) to a
+# digest, so identical files share one blob and later requests can refer to
+# a structure by its ID instead of sending the text back. The least recently
+# used blobs are evicted once the cache is over its size bound.
+#
+# RCSB entries too large for the PDB format (most cryo-EM assemblies) are
+# fetched as mmCIF instead; "&format=pdb|mmcif|bcif" keys hold converted
+# copies for callers that need one format.
+
+STRUCTURE_CACHE_MAX_BYTES = int(
+    os.environ.get("MUTANTAUTOMATE_STRUCTURE_CACHE_MAX_BYTES", str(2 * 1024**3))
+)
+
+SOURCES = ("rcsb", "alphafold")
+re_structure_id = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+re_chain_id = re.compile(r"^[A-Za-z0-9]{1,4}$")
+
+DIGEST_CHUNK_SIZE = 1 << 16
+
+# Blobs are named by their format, so tools that go by the file extension
+# can open structure_path() directly
+BLOB_EXTENSIONS = {"pdb": ".pdb", "mmcif": ".cif", "bcif": ".bcif"}
+
+
+def normalize_format(format):
+    if format is not None and format not in FORMATS:
+        raise ValueError(f"Unknown structure format: {format}")
+    return format
+
+
+def normalize(source, structure_id, chains=None):
+    # Validate before the ID goes into a URL or cache key
+    if source not in SOURCES:
+        raise ValueError(f"Unknown structure source: {source}")
+    if not structure_id or not re_structure_id.match(structure_id):
+        raise ValueError(f"Invalid structure ID: {structure_id}")
+    chains = sorted(set(chains or ()))
+    for chain in chains:
+        if not re_chain_id.match(chain):
+            raise ValueError(f"Invalid chain ID: {chain}")
+    return source, structure_id.upper(), tuple(chains)
+
+
+def structure_key(source, structure_id, chains=(), format=None):
+    params = []
+    if chains:
+        params.append("chains=" + ",".join(chains))
+    if format:
+        params.append(f"format={format}")
+    key = f"{source}/{structure_id}"
+    if params:
+        key += "?" + "&".join(params)
+    return key
+
+
+def structure_urls(source, structure_id):
+    # Where to fetch the structure from, tried in order while they 404
+    if source == "rcsb":
+        return [
+            f"https://files.rcsb.org/download/{structure_id}.pdb",
+            f"https://files.rcsb.org/download/{structure_id}.cif",
+        ]
+    # AlphaFold predicts the canonical sequence only; ask its API for the
+    # current model file rather than hard-coding a model version
+    accession = structure_id.split("-")[0]
+    response = session.get(f"https://alphafold.ebi.ac.uk/api/prediction/{accession}")
+    response.raise_for_status()
+    return [response.json()[0]["pdbUrl"]]
+
+
+def is_not_found(err):
+    return err.response is not None and err.response.status_code == 404
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StructureCache:
+    def __init__(self, root, max_bytes=STRUCTURE_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._inflight = SingleFlight()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs "
+                "(digest TEXT PRIMARY KEY, size INTEGER, last_access REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS refs "
+                "(key TEXT PRIMARY KEY, digest TEXT, stored_at REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest)")
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _blob_name(self, digest, format):
+        return os.path.join(
+            self.root, "objects", digest[:2], digest + BLOB_EXTENSIONS[format]
+        )
+
+    def find_blob(self, digest):
+        # Path of the stored blob, or None if there is none
+        for format in FORMATS:
+            path = self._blob_name(digest, format)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def blob_path(self, digest):
+        path = self.find_blob(digest)
+        if path is None:
+            raise FileNotFoundError(digest)
+        return path
+
+    def lookup(self, key):
+        # The digest stored under key, or None if it was never fetched or
+        # its blob has been evicted
+        db = self._connect()
+        row = db.execute("SELECT digest FROM refs WHERE key = ?", (key,)).fetchone()
+        if row is None or self.find_blob(row[0]) is None:
+            return None
+        with db:
+            db.execute(
+                "UPDATE blobs SET last_access = ? WHERE digest = ?",
+                (time.time(), row[0]),
+            )
+        return row[0]
+
+    def store(self, key, path):
+        # Move the file at path into the cache (unless an identical blob is
+        # already there) and point key at it
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        if self.find_blob(digest) is None:
+            target = self._blob_name(digest, self.blob_format(path))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        now = time.time()
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                (digest, size, now),
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", (key, digest, now)
+            )
+        self.evict(keep=digest)
+        return digest
+
+    def _temp_path(self):
+        fd, path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        os.close(fd)
+        return path
+
+    def store_text(self, key, text):
+        # text is bytes for BinaryCIF
+        path = self._temp_path()
+        try:
+            with open(path, "wb" if isinstance(text, bytes) else "w") as f:
+                f.write(text)
+            return self.store(key, path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self, keep=None):
+        # Drop least recently used blobs, and the keys pointing at them,
+        # until the cache fits
+        db = self._connect()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        with db:
+            for digest, size in db.execute(
+                "SELECT digest, size FROM blobs ORDER BY last_access"
+            ).fetchall():
+                if digest == keep:
+                    continue
+                db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                db.execute("DELETE FROM refs WHERE digest = ?", (digest,))
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def digest(self, source, structure_id, chains=None, format=None):
+        # Digest of the structure (trimmed to chains, converted to format),
+        # fetching it first if needed; concurrent requests for the same
+        # structure fetch it once
+        source, structure_id, chains = normalize(source, structure_id, chains)
+        format = normalize_format(format)
+        key = structure_key(source, structure_id, chains, format)
+        return self._inflight.do(
+            key, self._get, key, source, structure_id, chains, format
+        )
+
+    def _get(self, key, source, structure_id, chains, format):
+        digest = self.lookup(key)
+        if digest is not None:
+            return digest
+        if format:
+            digest = self.digest(source, structure_id, chains)
+            data = self.read_blob(digest)
+            if structure_format(data) == format:
+                return self.link(key, digest)
+            return self.store_text(key, convert_structure(data, format))
+        path = self._temp_path()
+        try:
+            if chains:
+                source_digest = self.digest(source, structure_id)
+                source_path = self.blob_path(source_digest)
+                if self.blob_format(source_path) == "pdb":
+                    # Filtered line by line from the full structure's blob
+                    with open(path, "w", newline="") as out:
+                        out.writelines(trim_file(source_path, chains))
+                else:
+                    # Only the kept chains of a CIF file are read
+                    data = self.read_blob(source_digest)
+                    return self.store_text(
+                        key, convert_structure(data, structure_format(data), chains)
+                    )
+            else:
+                print(f"Fetching structure {key}")
+                self._fetch(source, structure_id, path)
+            return self.store(key, path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fetch(self, source, structure_id, path):
+        urls = structure_urls(source, structure_id)
+        for url in urls:
+            try:
+                return download(url, path)
+            except requests.HTTPError as err:
+                if url == urls[-1] or not is_not_found(err):
+                    raise
+
+    def link(self, key, digest):
+        # Point key at a blob that is already stored
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO refs VALUES (?, ?, ?)",
+                (key, digest, time.time()),
+            )
+        return digest
+
+    def open_blob(self, digest):
+        # An open blob stays readable until it is closed, even if it is
+        # evicted in the meantime
+        return open(self.blob_path(digest), "rb")
+
+    def read_blob(self, digest):
+        with self.open_blob(digest) as f:
+            return decode_structure(f.read())
+
+    def blob_format(self, path):
+        with open(path, "rb") as f:
+            return structure_format(f.read(4096))
+
+    def path(self, source, structure_id, chains=None, format=None):
+        return self.blob_path(self.digest(source, structure_id, chains, format))
+
+    def open(self, source, structure_id, chains=None, format=None):
+        # (digest, open blob file). A blob evicted by another worker between
+        # lookup and open is fetched again.
+        for attempt in range(2):
+            digest = self.digest(source, structure_id, chains, format)
+            try:
+                return digest, self.open_blob(digest)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def read(self, source, structure_id, chains=None, format=None):
+        digest, f = self.open(source, structure_id, chains, format)
+        with f:
+            return decode_structure(f.read())
+
+    def stats(self):
+        db = self._connect()
+        blobs, size = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        refs = db.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+        return {
+            "blobs": blobs,
+            "refs": refs,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "singleflight": self._inflight.stats(),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    # Opened lazily so importing this module never touches the disk
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StructureCache(os.path.join(CACHE_DIR, "structures"))
+        return _cache
+
+
+def structure_path(source, structure_id, chains=None, format=None):
+    # Path to the cached structure file, for tools that want a filename
+    return get_cache().path(source, structure_id, chains, format)
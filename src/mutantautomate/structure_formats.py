@@ -0,0 +1,545 @@
+import re
+import string
+
+import numpy as np
+
+from pdb_arrays import PDBArrays, read_pdb
+
+# mmCIF and BinaryCIF alongside legacy PDB. Structures in either CIF format
+# are read into the same PDBArrays as PDB files (pdb_arrays.py), so trimming,
+# mutating and DSSP work on all three, and any of them can be written out as
+# any other.
+#
+# Large cryo-EM assemblies (hundreds of chains, often no PDB file at all)
+# are why this exists, so reading is per chain: the _atom_site loop of an
+# mmCIF file is indexed by chain once, as runs of rows, and only the rows of
+# the chains asked for are tokenised into arrays. A BinaryCIF file is already
+# columnar; its chain column is decoded for the index and the other columns
+# are only selected down to the chains asked for.
+#
+# BinaryCIF needs msgpack, which is imported only when a BinaryCIF file is
+# read or written.
+
+FORMATS = ("pdb", "mmcif", "bcif")
+MIMETYPES = {
+    "pdb": "text/plain",
+    "mmcif": "chemical/x-mmcif",
+    "bcif": "application/x-bcif",
+}
+
+MISSING = ("?", ".")
+
+re_mmcif = re.compile(r"\s*(?:#[^\n]*\n\s*)*data_")
+re_atom_site_loop = re.compile(
+    r"^loop_[ \t]*\r?\n((?:[ \t]*_atom_site\.\S+[ \t]*\r?\n)+)", re.M
+)
+# A CIF token: quoted (a quote only closes before whitespace) or bare
+re_token = re.compile(
+    r"""'(?:[^']|'(?=\S))*'(?=\s|$)|"(?:[^"]|"(?=\S))*"(?=\s|$)|\S+"""
+)
+# A line that ends the loop's rows
+re_loop_end = re.compile(r"\s*(?:#|_|loop_|data_|save_|global_|stop_)")
+
+# _atom_site columns for each PDBArrays field, preferred first
+CHAIN_COLUMNS = ("auth_asym_id", "label_asym_id")
+ATOM_NAME_COLUMNS = ("auth_atom_id", "label_atom_id")
+RESNAME_COLUMNS = ("auth_comp_id", "label_comp_id")
+RESSEQ_COLUMNS = ("auth_seq_id", "label_seq_id")
+MODEL_COLUMN = "pdbx_PDB_model_num"
+
+# Chain IDs for writing a selection as PDB, for Bio.PDB and mdtraj
+ALIAS_CHAINS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+
+
+def structure_format(data):
+    # "bcif" for MessagePack (a map is its first byte), "mmcif" for text
+    # starting with a data_ block, "pdb" otherwise
+    if isinstance(data, bytes):
+        if data[:1] and (0x80 <= data[0] <= 0x8F or data[0] in (0xDE, 0xDF)):
+            return "bcif"
+        data = data[:4096].decode("latin-1")
+    return "mmcif" if re_mmcif.match(data[:4096]) else "pdb"
+
+
+def decode_structure(raw):
+    # Uploaded or cached bytes as the structure: bytes for BinaryCIF,
+    # text otherwise
+    if structure_format(raw) == "bcif":
+        # Without msgpack, refuse it here rather than at its first use
+        get_msgpack()
+        return raw
+    try:
+        return raw.decode()
+    except UnicodeDecodeError:
+        raise ValueError("Structure is neither text nor BinaryCIF")
+
+
+def get_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError("BinaryCIF needs the msgpack package")
+    return msgpack
+
+
+def split_row(line):
+    if "'" not in line and '"' not in line:
+        return line.split()
+    tokens = []
+    for token in re_token.findall(line):
+        if token[0] in "'\"" and len(token) > 1 and token[-1] == token[0]:
+            token = token[1:-1]
+        tokens.append(token)
+    return tokens
+
+
+def first_present(names, candidates):
+    for name in candidates:
+        if name in names:
+            return name
+    return None
+
+
+class CifAtomSite:
+    # The _atom_site loop of an mmCIF file, indexed by chain
+    def __init__(self, text):
+        match = re_atom_site_loop.search(text)
+        if match is None:
+            raise ValueError("No _atom_site loop in the mmCIF data")
+        self.text = text
+        self.names = [
+            line.strip()[len("_atom_site.") :] for line in match.group(1).splitlines()
+        ]
+        chain_name = first_present(self.names, CHAIN_COLUMNS)
+        if chain_name is None:
+            raise ValueError("No chain IDs in the mmCIF _atom_site loop")
+        chain_column = self.names.index(chain_name)
+        model_column = (
+            self.names.index(MODEL_COLUMN) if MODEL_COLUMN in self.names else None
+        )
+        # [chain, start, end, rows]: character offsets and row count of
+        # consecutive rows of one chain, in file order
+        self.runs = []
+        models = set()
+        last_model = None
+        for start, end, row in self._rows(match.end(), len(text)):
+            chain = row[chain_column]
+            if model_column is not None and row[model_column] != last_model:
+                last_model = row[model_column]
+                models.add(int(last_model))
+            if self.runs and self.runs[-1][0] == chain and self.runs[-1][2] == start:
+                self.runs[-1][2] = end
+                self.runs[-1][3] += 1
+            else:
+                self.runs.append([chain, start, end, 1])
+        self.chains = list(dict.fromkeys(run[0] for run in self.runs))
+        self.models = sorted(models) or [1]
+
+    def _rows(self, pos, stop):
+        # (start, end, tokens) per row between pos and stop; a row can run
+        # over several lines
+        text = self.text
+        width = len(self.names)
+        tokens = []
+        row_start = pos
+        while pos < stop:
+            end = text.find("\n", pos, stop)
+            end = stop if end < 0 else end + 1
+            line = text[pos:end]
+            if not tokens:
+                if not line.strip():
+                    pos = end
+                    continue
+                if re_loop_end.match(line):
+                    return
+                row_start = pos
+            tokens.extend(split_row(line))
+            pos = end
+            if len(tokens) >= width:
+                yield row_start, pos, tokens[:width]
+                tokens = []
+
+    def _tokens(self, start, end, rows):
+        # (rows, columns) array of the tokens of one run
+        block = self.text[start:end]
+        width = len(self.names)
+        if "'" not in block and '"' not in block:
+            # One row per line and nothing quoted, as wwPDB writes them
+            tokens = block.split()
+            if len(tokens) == rows * width:
+                return np.array(tokens, dtype=object).reshape(rows, width)
+        tokens = [row for _, _, row in self._rows(start, end)]
+        return np.array(tokens, dtype=object).reshape(rows, width)
+
+    def columns(self, chains=None):
+        # {column name: (values, missing)} for the rows of chains
+        blocks = [
+            self._tokens(start, end, rows)
+            for chain, start, end, rows in self.runs
+            if chains is None or chain in chains
+        ]
+        if blocks:
+            tokens = np.concatenate(blocks)
+        else:
+            tokens = np.empty((0, len(self.names)), dtype=object)
+        missing = np.isin(tokens, MISSING)
+        columns = {
+            name: (tokens[:, index], missing[:, index])
+            for index, name in enumerate(self.names)
+        }
+        return columns, len(tokens)
+
+    def arrays(self, chains=None):
+        columns, count = self.columns(chains)
+        return build_arrays(columns, count, self.models)
+
+
+# BinaryCIF ByteArray type codes
+BYTE_ARRAY_TYPES = {
+    1: "<i1",
+    2: "<i2",
+    3: "<i4",
+    4: "<u1",
+    5: "<u2",
+    6: "<u4",
+    32: "<f4",
+    33: "<f8",
+}
+
+
+def unpack_integers(data, encoding):
+    # IntegerPacking: values too large for byteCount bytes are stored as
+    # runs of the type's limit followed by the remainder
+    bits = 8 * encoding["byteCount"]
+    values = np.asarray(data, dtype=np.int64)
+    if encoding["isUnsigned"]:
+        limit = values == (1 << bits) - 1
+    else:
+        limit = (values == (1 << (bits - 1)) - 1) | (values == -(1 << (bits - 1)))
+    ends = np.flatnonzero(~limit)
+    sums = np.cumsum(values)[ends]
+    return np.diff(np.concatenate([[0], sums]))
+
+
+def decode_strings(data, encoding):
+    indices = decode(data, encoding["dataEncoding"])
+    offsets = decode(encoding["offsets"], encoding["offsetEncoding"])
+    text = encoding["stringData"]
+    table = [text[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+    # Index -1 is a missing value
+    return np.array(table + [""], dtype=object)[np.asarray(indices, dtype=np.int64)]
+
+
+def decode(data, encodings):
+    # Undo a BinaryCIF encoding chain, last encoding first
+    for encoding in reversed(encodings):
+        kind = encoding["kind"]
+        if kind == "ByteArray":
+            data = np.frombuffer(data, dtype=BYTE_ARRAY_TYPES[encoding["type"]])
+        elif kind == "FixedPoint":
+            data = np.asarray(data, dtype=np.float64) / encoding["factor"]
+        elif kind == "IntervalQuantization":
+            step = (encoding["max"] - encoding["min"]) / (encoding["numSteps"] - 1)
+            data = encoding["min"] + step * np.asarray(data, dtype=np.float64)
+        elif kind == "RunLength":
+            data = np.repeat(data[0::2], data[1::2])
+        elif kind == "Delta":
+            data = np.cumsum(data, dtype=np.int64) + encoding["origin"]
+        elif kind == "IntegerPacking":
+            data = unpack_integers(data, encoding)
+        elif kind == "StringArray":
+            data = decode_strings(data, encoding)
+        else:
+            raise ValueError(f"Unsupported BinaryCIF encoding: {kind}")
+    return data
+
+
+def decode_column(column):
+    values = decode(column["data"]["data"], column["data"]["encoding"])
+    if column.get("mask"):
+        missing = decode(column["mask"]["data"], column["mask"]["encoding"]) != 0
+    else:
+        missing = np.zeros(len(values), dtype=bool)
+    if values.dtype == object:
+        missing |= values == ""
+    return values, missing
+
+
+class BcifAtomSite:
+    # The _atom_site category of an unpacked BinaryCIF file, indexed by chain
+    def __init__(self, bcif):
+        categories = bcif["dataBlocks"][0]["categories"]
+        category = next(
+            (c for c in categories if c["name"].lstrip("_") == "atom_site"), None
+        )
+        if category is None:
+            raise ValueError("No _atom_site category in the BinaryCIF data")
+        self.count = category["rowCount"]
+        self.encoded = {column["name"]: column for column in category["columns"]}
+        chain_name = first_present(self.encoded, CHAIN_COLUMNS)
+        if chain_name is None:
+            raise ValueError("No chain IDs in the BinaryCIF _atom_site category")
+        self.chain_ids = decode_column(self.encoded[chain_name])[0]
+        self.chains = list(dict.fromkeys(self.chain_ids.tolist()))
+        self.models = [1]
+        if MODEL_COLUMN in self.encoded:
+            models = decode_column(self.encoded[MODEL_COLUMN])[0]
+            self.models = np.unique(models).astype(int).tolist() or [1]
+
+    def columns(self, chains=None):
+        if chains is None:
+            selected = slice(None)
+            count = self.count
+        else:
+            selected = np.isin(self.chain_ids, list(chains))
+            count = int(selected.sum())
+        columns = {}
+        for name, column in self.encoded.items():
+            values, missing = decode_column(column)
+            columns[name] = (values[selected], missing[selected])
+        return columns, count
+
+    def arrays(self, chains=None):
+        columns, count = self.columns(chains)
+        return build_arrays(columns, count, self.models)
+
+
+def atom_site(data):
+    # The per-chain index of an mmCIF or BinaryCIF structure
+    format = structure_format(data)
+    if format == "mmcif":
+        return CifAtomSite(data)
+    if format == "bcif":
+        return BcifAtomSite(get_msgpack().unpackb(data, raw=False))
+    raise ValueError("Not an mmCIF or BinaryCIF structure")
+
+
+def strings(column, count, default=""):
+    # Object array of the column's values, default where missing
+    if column is None:
+        return np.full(count, default, dtype=object)
+    values, missing = column
+    return np.where(missing, default, values.astype(str).astype(object))
+
+
+def numbers(column, count, dtype, default):
+    out = np.full(count, default, dtype=dtype)
+    if column is not None:
+        values, missing = column
+        out[~missing] = values[~missing].astype(np.float64).astype(dtype)
+    return out
+
+
+def charge_fields(charges):
+    # mmCIF's formal charges (-1, 2, ...) as PDB's "1-", "2+"
+    signs = np.where(charges > 0, "+", "-")
+    fields = np.char.add(np.abs(charges).astype(str), signs)
+    return np.where(charges == 0, "  ", fields).astype("S2")
+
+
+def build_arrays(columns, count, models):
+    def column(candidates):
+        name = first_present(columns, candidates)
+        return columns[name] if name else None
+
+    elements = np.char.upper(strings(columns.get("type_symbol"), count).astype("U2"))
+    names = strings(column(ATOM_NAME_COLUMNS), count).astype("U4")
+    # Names are aligned as in PDB files: one-letter elements from the second
+    # column (see pdb_arrays.pad_name)
+    shifted = (
+        (np.char.str_len(names) < 4)
+        & np.char.isalpha(names.astype("U1"))
+        & (np.char.str_len(elements) < 2)
+    )
+    names = np.char.ljust(np.where(shifted, np.char.add(" ", names), names), 4)
+    records = strings(columns.get("group_PDB"), count, "ATOM").astype("U6")
+    fields = {
+        "record": np.char.ljust(records, 6).astype("S6"),
+        "name": names.astype("S4"),
+        "altloc": strings(columns.get("label_alt_id"), count, " ").astype("S1"),
+        "resname": strings(column(RESNAME_COLUMNS), count).astype("S3"),
+        # As wide as the longest chain ID
+        "chain": strings(column(CHAIN_COLUMNS), count, " ").astype("S"),
+        "resseq": numbers(column(RESSEQ_COLUMNS), count, np.int32, 0),
+        "icode": strings(columns.get("pdbx_PDB_ins_code"), count, " ").astype("S1"),
+        "occupancy": numbers(columns.get("occupancy"), count, np.float32, 1.0),
+        "bfactor": numbers(columns.get("B_iso_or_equiv"), count, np.float32, 0.0),
+        "element": np.char.rjust(elements, 2).astype("S2"),
+        "charge": charge_fields(
+            numbers(columns.get("pdbx_formal_charge"), count, np.int64, 0)
+        ),
+    }
+    coords = np.zeros((count, 3), dtype=np.float32)
+    for axis, name in enumerate(("Cartn_x", "Cartn_y", "Cartn_z")):
+        coords[:, axis] = numbers(columns.get(name), count, np.float32, 0.0)
+    model_numbers = numbers(columns.get(MODEL_COLUMN), count, np.int64, models[0])
+    model = np.searchsorted(models, model_numbers).astype(np.int32)
+    return PDBArrays(fields, coords, model)
+
+
+def text_values(values):
+    return [value.decode().strip() for value in values.tolist()]
+
+
+def atom_site_columns(arrays):
+    # (name, values, kind) for each _atom_site column written
+    records = text_values(arrays.record)
+    elements = text_values(arrays.element)
+    names = text_values(arrays.name)
+    resnames = text_values(arrays.resname)
+    chains = text_values(arrays.chain)
+    charges = [
+        int(c[:-1]) * (1 if c.endswith("+") else -1) if c[:-1].isdigit() else 0
+        for c in text_values(arrays.charge)
+    ]
+    _, model_numbers = np.unique(arrays.model, return_inverse=True)
+    return [
+        ("group_PDB", records, "str"),
+        ("id", np.arange(1, len(arrays) + 1), "int"),
+        ("type_symbol", elements, "str"),
+        ("label_atom_id", names, "str"),
+        ("label_alt_id", text_values(arrays.altloc), "str"),
+        ("label_comp_id", resnames, "str"),
+        ("label_asym_id", chains, "str"),
+        ("label_seq_id", arrays.resseq, "int"),
+        ("pdbx_PDB_ins_code", text_values(arrays.icode), "str"),
+        ("Cartn_x", arrays.coords[:, 0], "coord"),
+        ("Cartn_y", arrays.coords[:, 1], "coord"),
+        ("Cartn_z", arrays.coords[:, 2], "coord"),
+        ("occupancy", arrays.occupancy, "float"),
+        ("B_iso_or_equiv", arrays.bfactor, "float"),
+        ("pdbx_formal_charge", np.array(charges), "int"),
+        ("auth_seq_id", arrays.resseq, "int"),
+        ("auth_comp_id", resnames, "str"),
+        ("auth_asym_id", chains, "str"),
+        ("auth_atom_id", names, "str"),
+        (MODEL_COLUMN, model_numbers + 1, "int"),
+    ]
+
+
+def cif_value(value):
+    if not value:
+        return "."
+    if value in MISSING or value[0] in "_#$'\"[];" or any(c.isspace() for c in value):
+        return f'"{value}"' if "'" in value else f"'{value}'"
+    # Quoted like wwPDB files do, e.g. "O5'"
+    if "'" in value:
+        return f'"{value}"'
+    return value
+
+
+def cif_column(values, kind):
+    if kind == "str":
+        return [cif_value(value) for value in values]
+    if kind == "int":
+        return [str(value) for value in values.tolist()]
+    format = "%.3f" if kind == "coord" else "%.2f"
+    return np.char.mod(format, values).tolist()
+
+
+def write_mmcif(arrays, name="structure"):
+    columns = atom_site_columns(arrays)
+    out = [f"data_{name}", "#", "loop_"]
+    out.extend(f"_atom_site.{column}" for column, _, _ in columns)
+    values = [cif_column(values, kind) for _, values, kind in columns]
+    out.extend(" ".join(row) for row in zip(*values))
+    out.append("#")
+    return "\n".join(out) + "\n"
+
+
+def byte_array(values, type_code):
+    return {
+        "data": np.asarray(values, dtype=BYTE_ARRAY_TYPES[type_code]).tobytes(),
+        "encoding": [{"kind": "ByteArray", "type": type_code}],
+    }
+
+
+def encode_column(name, values, kind):
+    mask = None
+    if kind == "str":
+        table = {}
+        indices = [table.setdefault(value, len(table)) for value in values]
+        offsets = np.cumsum([0] + [len(value) for value in table])
+        data = byte_array(indices, 3)
+        data["encoding"] = [
+            {
+                "kind": "StringArray",
+                "dataEncoding": data["encoding"],
+                "stringData": "".join(table),
+                "offsetEncoding": [{"kind": "ByteArray", "type": 3}],
+                "offsets": np.asarray(offsets, dtype="<i4").tobytes(),
+            }
+        ]
+        missing = np.array([not value for value in values], dtype=np.uint8)
+        if missing.any():
+            # 1 is "." in a BinaryCIF mask
+            mask = byte_array(missing, 4)
+    elif kind == "int":
+        data = byte_array(values, 3)
+    else:
+        data = byte_array(values, 32)
+    return {"name": name, "data": data, "mask": mask}
+
+
+def bcif_file(arrays, name="structure"):
+    # The BinaryCIF document for arrays, before MessagePack
+    columns = [
+        encode_column(column, values, kind)
+        for column, values, kind in atom_site_columns(arrays)
+    ]
+    return {
+        "version": "0.3.0",
+        "encoder": "mutantautomate",
+        "dataBlocks": [
+            {
+                "header": name,
+                "categories": [
+                    {"name": "_atom_site", "rowCount": len(arrays), "columns": columns}
+                ],
+            }
+        ],
+    }
+
+
+def write_bcif(arrays, name="structure"):
+    return get_msgpack().packb(bcif_file(arrays, name), use_bin_type=True)
+
+
+def read_structure(data, chains=None):
+    # PDBArrays for a structure in any format, only of chains if given
+    if structure_format(data) == "pdb":
+        arrays = read_pdb(data)
+        return arrays if chains is None else arrays.trim(chains)
+    return atom_site(data).arrays(None if chains is None else set(chains))
+
+
+def write_structure(arrays, format):
+    if format == "pdb":
+        return arrays.write()
+    if format == "mmcif":
+        return write_mmcif(arrays)
+    if format == "bcif":
+        return write_bcif(arrays)
+    raise ValueError(f"Unknown structure format: {format}")
+
+
+def convert_structure(data, format, chains=None):
+    if chains is None and structure_format(data) == format:
+        return data
+    return write_structure(read_structure(data, chains), format)
+
+
+def single_letter_chains(arrays):
+    # arrays with chain IDs that fit a PDB file, for Bio.PDB and mdtraj, and
+    # {alias: original chain ID}
+    chains = list(dict.fromkeys(arrays.chain.tolist()))
+    if all(len(chain) <= 1 for chain in chains):
+        return arrays, {}
+    if len(chains) > len(ALIAS_CHAINS):
+        raise ValueError("Too many chains to write as PDB")
+    aliases = {chain: alias.encode() for chain, alias in zip(chains, ALIAS_CHAINS)}
+    aliased = arrays.select(slice(None))
+    aliased.chain = np.array(
+        [aliases[chain] for chain in arrays.chain.tolist()], dtype="S1"
+    )
+    return aliased, {alias: chain for chain, alias in aliases.items()}
@@ -0,0 +1,221 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+import structure_cache
+from pdb_arrays import read_pdb
+from pdb_helpers import (
+    dssp_for_trajectory,
+    load_trajectory,
+    mutate_arrays,
+    trajectory_text,
+    trim_pdb,
+)
+from structure_formats import (
+    atom_site,
+    decode_structure,
+    structure_format,
+    write_structure,
+)
+
+# Parsed structures kept in memory between requests. A structure is opened
+# once, from uploaded text or from the structure cache, and gets a handle:
+# the SHA-256 of its PDB text. /trim_pdb, /dssp and /mutate then run against
+# the parsed arrays (pdb_arrays.py) and mdtraj trajectory instead of parsing
+# the text again. Sessions share a memory budget, least recently used out
+# first. A handle is also the structure's digest in the disk cache, so one
+# evicted here (or opened by another worker process) is reloaded from disk.
+#
+# A session's text can be PDB, mmCIF or BinaryCIF (bytes). CIF structures
+# are indexed by chain, so a trim reads only the chains it keeps.
+
+STRUCTURE_SESSION_MAX_BYTES = int(
+    os.environ.get("MUTANTAUTOMATE_STRUCTURE_SESSION_MAX_BYTES", str(512 * 1024**2))
+)
+
+# Rough memory cost per atom of an mdtraj trajectory: float32 coordinates
+# plus its topology objects
+MDTRAJ_BYTES_PER_ATOM = 100
+
+re_handle = re.compile(r"^[0-9a-f]{64}$")
+
+
+def text_digest(text):
+    if isinstance(text, str):
+        text = text.encode()
+    return hashlib.sha256(text).hexdigest()
+
+
+class StructureSession:
+    def __init__(self, sessions, handle, text):
+        self.sessions = sessions
+        self.handle = handle
+        self.text = text
+        self.format = structure_format(text)
+        self._lock = threading.RLock()
+        self._index = None
+        self._arrays = None
+        self._trajectory = None
+        self._dssp = None
+        self._trims = {}
+
+    def size(self):
+        size = len(self.text)
+        if self._arrays is not None:
+            size += self._arrays.nbytes()
+        if self._trajectory is not None:
+            size += self._trajectory.n_atoms * MDTRAJ_BYTES_PER_ATOM
+        return size
+
+    def index(self):
+        # Per-chain index of a CIF structure
+        with self._lock:
+            if self._index is None:
+                self._index = atom_site(self.text)
+            return self._index
+
+    def arrays(self):
+        # Treat as read-only; trims and mutations build new arrays
+        with self._lock:
+            parsed = self._arrays is None
+            if parsed:
+                if self.format == "pdb":
+                    self._arrays = read_pdb(self.text)
+                else:
+                    self._arrays = self.index().arrays()
+        if parsed:
+            self.sessions.resized()
+        return self._arrays
+
+    def export(self, format=None):
+        # The structure in format, by default the one it was opened in
+        if format in (None, self.format):
+            return self.text
+        return write_structure(self.arrays(), format)
+
+    def trajectory(self):
+        with self._lock:
+            loaded = self._trajectory is None
+            if loaded:
+                text = self.text
+                if self.format != "pdb":
+                    text = trajectory_text(self.arrays())
+                self._trajectory = load_trajectory(text)
+        if loaded:
+            self.sessions.resized()
+        return self._trajectory
+
+    def dssp(self):
+        with self._lock:
+            if self._dssp is None:
+                self._dssp = dssp_for_trajectory(self.trajectory())
+            return self._dssp
+
+    def trim(self, chains):
+        # The trimmed structure is a session of its own
+        chains = tuple(sorted(set(chains or ())))
+        handle = self._trims.get(chains)
+        if handle is not None:
+            try:
+                return self.sessions.get(handle)
+            except KeyError:
+                pass
+        if self.format == "pdb":
+            text = trim_pdb(self.text, chains)
+        else:
+            text = write_structure(self.index().arrays(set(chains)), self.format)
+        trimmed = self.sessions.open_text(text)
+        self._trims[chains] = trimmed.handle
+        return trimmed
+
+    def mutate(self, chain_id, position, to_residue, format=None):
+        mutated = mutate_arrays(self.arrays(), chain_id, position, to_residue)
+        return write_structure(mutated, format or self.format)
+
+
+class StructureSessions:
+    def __init__(self, max_bytes=STRUCTURE_SESSION_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._counters = {"opened": 0, "hits": 0, "reloaded": 0, "evicted": 0}
+
+    def _lookup(self, handle):
+        with self._lock:
+            session = self._sessions.get(handle)
+            if session is not None:
+                self._sessions.move_to_end(handle)
+                self._counters["hits"] += 1
+            return session
+
+    def _add(self, handle, text):
+        with self._lock:
+            session = self._sessions.get(handle)
+            if session is None:
+                session = self._sessions[handle] = StructureSession(self, handle, text)
+                self._counters["opened"] += 1
+        self.resized()
+        return session
+
+    def open_text(self, text):
+        if not text:
+            raise ValueError("No structure given")
+        handle = text_digest(text)
+        session = self._lookup(handle)
+        if session is None:
+            # Kept on disk too, so the handle outlives this process's memory
+            structure_cache.get_cache().store_text(f"upload/{handle}", text)
+            session = self._add(handle, text)
+        return session
+
+    def open_cached(self, source, structure_id, chains=None):
+        handle = structure_cache.get_cache().digest(source, structure_id, chains)
+        return self.get(handle)
+
+    def get(self, handle):
+        session = self._lookup(handle)
+        if session is not None:
+            return session
+        if not re_handle.match(handle or ""):
+            raise KeyError(handle)
+        try:
+            with open(structure_cache.get_cache().blob_path(handle), "rb") as f:
+                text = decode_structure(f.read())
+        except FileNotFoundError:
+            raise KeyError(handle)
+        with self._lock:
+            self._counters["reloaded"] += 1
+        return self._add(handle, text)
+
+    def resized(self):
+        # Evict least recently used sessions until the budget fits; the most
+        # recent one always stays
+        with self._lock:
+            total = sum(session.size() for session in self._sessions.values())
+            while total > self.max_bytes and len(self._sessions) > 1:
+                _, session = self._sessions.popitem(last=False)
+                total -= session.size()
+                self._counters["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": sum(session.size() for session in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+                **self._counters,
+            }
+
+
+_sessions = None
+_sessions_lock = threading.Lock()
+
+
+def get_sessions():
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            _sessions = StructureSessions()
+        return _sessions
@@ -0,0 +1,150 @@
+import os
+import ast
+import threading
+
+import numpy as np
+
+# Shared substitution scoring: the Grantham table and charge classes, loaded
+# once into arrays indexed by amino acid so batches score in one step
+
+AMINO_ACID_ORDER = "ACDEFGHIKLMNPQRSTVWY"
+
+# Define the dictionary of amino acid names
+amino_acids = {
+    "A": "Alanine",
+    "C": "Cysteine",
+    "D": "Aspartic Acid",
+    "E": "Glutamic Acid",
+    "F": "Phenylalanine",
+    "G": "Glycine",
+    "H": "Histidine",
+    "I": "Isoleucine",
+    "K": "Lysine",
+    "L": "Leucine",
+    "M": "Methionine",
+    "N": "Asparagine",
+    "P": "Proline",
+    "Q": "Glutamine",
+    "R": "Arginine",
+    "S": "Serine",
+    "T": "Threonine",
+    "V": "Valine",
+    "W": "Tryptophan",
+    "Y": "Tyrosine",
+}
+
+aa_charge_dict = {
+    "A": "non-polar",
+    "C": "polar",
+    "D": "negative",
+    "E": "negative",
+    "F": "bulky",  # "non-polar",
+    "G": "non-polar",
+    "H": "positive",
+    "I": "non-polar",
+    "K": "positive",
+    "L": "non-polar",
+    "M": "non-polar",
+    "N": "polar",
+    "P": "non-polar",
+    "Q": "polar",
+    "R": "positive",
+    "S": "polar",
+    "T": "polar",
+    "V": "non-polar",
+    "W": "bulky",  # "non-polar",
+    "Y": "bulky",  # "polar"
+}
+
+aa_charge_categories = {
+    "positive-to-negative": ["K", "R", "H"],
+    "positive-to-hydrophobic": ["K", "R", "H"],
+    "negative-to-positive": ["D", "E"],
+    "negative-to-hydrophobic": ["D", "E"],
+    "hydrophobic-to-positive": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
+    "hydrophobic-to-negative": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
+    "hydrophobic-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
+    "polar-to-hydrophobic": ["C", "N", "Q", "S", "T", "Y"],
+    "polar-to-positive": ["C", "N", "Q", "S", "T", "Y"],
+    "polar-to-negative": ["C", "N", "Q", "S", "T", "Y"],
+    "non-polar-to-polar": ["A", "F", "G", "I", "L", "M", "P", "V", "W", "Y"],
+}
+
+# ASCII code -> row/column in the 20 x 20 tables, -1 for anything else
+AMINO_ACID_INDEX = np.full(256, -1, dtype=np.int64)
+for _index, _residue in enumerate(AMINO_ACID_ORDER):
+    AMINO_ACID_INDEX[ord(_residue)] = _index
+
+CHARGE_CLASSES = np.array([aa_charge_dict[residue] for residue in AMINO_ACID_ORDER])
+
+GRANTHAM_PATH = os.path.join(os.path.dirname(__file__), "grantham_output.txt")
+
+_grantham_matrix = None
+_grantham_lock = threading.Lock()
+
+
+def load_grantham_matrix(path=GRANTHAM_PATH):
+    # 20 x 20 float array, NaN where the table has no score
+    with open(path, "r") as f:
+        grantham_dict = ast.literal_eval(f.read())
+    matrix = np.full((len(AMINO_ACID_ORDER), len(AMINO_ACID_ORDER)), np.nan)
+    for (residue1, residue2), score in grantham_dict.items():
+        # The file spells the Alanine column as ". A"
+        residue1 = residue1.strip(". ")
+        residue2 = residue2.strip(". ")
+        if residue1 in amino_acids and residue2 in amino_acids:
+            matrix[
+                AMINO_ACID_ORDER.index(residue1), AMINO_ACID_ORDER.index(residue2)
+            ] = score
+    matrix.setflags(write=False)
+    return matrix
+
+
+def get_grantham_matrix():
+    global _grantham_matrix
+    with _grantham_lock:
+        if _grantham_matrix is None:
+            _grantham_matrix = load_grantham_matrix()
+        return _grantham_matrix
+
+
+def residue_indices(residues):
+    # Residues as a string or a list of one-letter codes -> table indices
+    if not isinstance(residues, str):
+        residues = "".join(
+            residue if len(residue) == 1 else "?" for residue in residues
+        )
+    codes = np.frombuffer(residues.upper().encode("ascii", "replace"), dtype=np.uint8)
+    return AMINO_ACID_INDEX[codes]
+
+
+def grantham_scores(from_residues, to_residues):
+    # Score every (from, to) pair in one call; NaN where either is unknown
+    matrix = get_grantham_matrix()
+    rows = residue_indices(from_residues)
+    columns = residue_indices(to_residues)
+    known = (rows >= 0) & (columns >= 0)
+    return np.where(known, matrix[rows.clip(0), columns.clip(0)], np.nan)
+
+
+def grantham_score(residue1, residue2):
+    score = grantham_scores([residue1], [residue2])[0]
+    if np.isnan(score):
+        return None
+    return int(score)
+
+
+def sequence_grantham_scores(sequence):
+    # Score of every possible substitution along the sequence: a
+    # len(sequence) x 20 array whose columns follow AMINO_ACID_ORDER
+    matrix = get_grantham_matrix()
+    rows = residue_indices(sequence)
+    scores = matrix[rows.clip(0)].copy()
+    scores[rows < 0] = np.nan
+    return scores
+
+
+def charge_classes(residues):
+    # Charge class for each residue, None where unknown
+    indices = residue_indices(residues)
+    return np.where(indices >= 0, CHARGE_CLASSES[indices.clip(0)], None)
@@ -0,0 +1,303 @@
+import os
+import re
+import gzip
+import mmap
+import sqlite3
+import argparse
+import threading
+
+# Build a local, read-only UniProt mirror from a human Swiss-Prot dump so the
+# /process pipeline can run without calling rest.uniprot.org:
+#
+#   python uniprot_mirror.py \
+#       --swissprot uniprot_sprot_human.dat.gz \
+#       --varsplic uniprot_sprot_varsplic.fasta.gz \
+#       --output /data/uniprot_mirror
+#
+# The mirror directory holds sequences.dat (every sequence back to back) and
+# index.sqlite (accession -> sequence offset, gene -> accessions, accession ->
+# PDB cross-references). Both are opened read-only and memory-mapped, so
+# every gunicorn worker shares the same pages through the OS page cache.
+
+MIRROR_PATH = os.environ.get("MUTANTAUTOMATE_MIRROR_PATH", "")
+
+HUMAN_TAXONOMY_ID = "9606"
+
+re_gene_name = re.compile(r"Name=([^;{]+)")
+re_gene_synonyms = re.compile(r"Synonyms=([^;]+)")
+re_evidence = re.compile(r"\{[^}]*\}")
+re_fasta_taxonomy = re.compile(r"OX=(\d+)")
+re_fasta_gene = re.compile(r"GN=(\S+)")
+
+
+def open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def parse_gene_names(gn_text):
+    # "Name=NRXN1 {ECO:...}; Synonyms=KIAA0578;" -> ["NRXN1", "KIAA0578"]
+    gn_text = re_evidence.sub("", gn_text)
+    names = []
+    match = re_gene_name.search(gn_text)
+    if match:
+        names.append(match.group(1).strip())
+    for synonyms in re_gene_synonyms.findall(gn_text):
+        names.extend(name.strip() for name in synonyms.split(",") if name.strip())
+    return names
+
+
+def parse_swissprot(handle):
+    # Stream records out of a Swiss-Prot flat file
+    record = None
+    for line in handle:
+        code = line[:2]
+        value = line[5:].rstrip("\n")
+        if code == "ID":
+            record = {
+                "accessions": [],
+                "taxonomy_id": None,
+                "gn": "",
+                "pdb": [],
+                "sequence": [],
+            }
+        elif record is None:
+            continue
+        elif code == "AC":
+            record["accessions"].extend(
+                accession.strip() for accession in value.split(";") if accession.strip()
+            )
+        elif code == "OX":
+            match = re.search(r"NCBI_TaxID=(\d+)", value)
+            if match:
+                record["taxonomy_id"] = match.group(1)
+        elif code == "GN":
+            record["gn"] += value + " "
+        elif code == "DR" and value.startswith("PDB;"):
+            # DR   PDB; 3BIW; X-ray; 3.50 A; A/B=46-835.
+            parts = [part.strip() for part in value.rstrip(".").split(";")]
+            if len(parts) >= 5:
+                record["pdb"].append([parts[1], parts[4], parts[3]])
+        elif code == "  ":
+            record["sequence"].append(line.replace(" ", "").strip())
+        elif code == "//":
+            yield {
+                "accession": record["accessions"][0],
+                "taxonomy_id": record["taxonomy_id"],
+                "gene_names": parse_gene_names(record["gn"]),
+                "pdb_ids": record["pdb"],
+                "sequence": "".join(record["sequence"]),
+            }
+            record = None
+
+
+def parse_fasta(handle):
+    header = None
+    sequence = []
+    for line in handle:
+        line = line.strip()
+        if line.startswith(">"):
+            if header is not None:
+                yield header, "".join(sequence)
+            header = line[1:]
+            sequence = []
+        elif line:
+            sequence.append(line)
+    if header is not None:
+        yield header, "".join(sequence)
+
+
+def build_mirror(swissprot_path, varsplic_path, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, "index.sqlite")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    db = sqlite3.connect(index_path)
+    db.execute(
+        "CREATE TABLE entries (accession TEXT PRIMARY KEY, parent TEXT, "
+        "gene TEXT, offset INTEGER, length INTEGER)"
+    )
+    db.execute("CREATE TABLE genes (gene TEXT, accession TEXT)")
+    db.execute(
+        "CREATE TABLE pdb (accession TEXT, pdb_id TEXT, chains TEXT, resolution TEXT)"
+    )
+    offset = 0
+    entry_count = 0
+    with open(os.path.join(output_dir, "sequences.dat"), "wb") as sequences:
+        with open_text(swissprot_path) as handle:
+            for record in parse_swissprot(handle):
+                if record["taxonomy_id"] != HUMAN_TAXONOMY_ID:
+                    continue
+                accession = record["accession"]
+                gene = record["gene_names"][0] if record["gene_names"] else None
+                data = record["sequence"].encode("ascii")
+                sequences.write(data)
+                db.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (accession, accession, gene, offset, len(data)),
+                )
+                offset += len(data)
+                entry_count += 1
+                db.executemany(
+                    "INSERT INTO genes VALUES (?, ?)",
+                    [(name.upper(), accession) for name in set(record["gene_names"])],
+                )
+                db.executemany(
+                    "INSERT INTO pdb VALUES (?, ?, ?, ?)",
+                    [(accession, *pdb) for pdb in record["pdb_ids"]],
+                )
+        if varsplic_path:
+            with open_text(varsplic_path) as handle:
+                for header, sequence in parse_fasta(handle):
+                    # sp|P55196-2|NRXN1_HUMAN Isoform 2 of ... OX=9606 GN=NRXN1
+                    taxonomy = re_fasta_taxonomy.search(header)
+                    if not taxonomy or taxonomy.group(1) != HUMAN_TAXONOMY_ID:
+                        continue
+                    accession = header.split("|")[1]
+                    parent = accession.split("-")[0]
+                    row = db.execute(
+                        "SELECT gene FROM entries WHERE accession = ?", (parent,)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    gene_match = re_fasta_gene.search(header)
+                    gene = gene_match.group(1) if gene_match else row[0]
+                    data = sequence.encode("ascii")
+                    sequences.write(data)
+                    db.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                        (accession, parent, gene, offset, len(data)),
+                    )
+                    offset += len(data)
+                    entry_count += 1
+    db.execute("CREATE INDEX genes_gene ON genes (gene)")
+    db.execute("CREATE INDEX entries_parent ON entries (parent)")
+    db.execute("CREATE INDEX pdb_accession ON pdb (accession)")
+    db.commit()
+    db.execute("VACUUM")
+    db.close()
+    print(f"Wrote {entry_count} entries to {output_dir}")
+
+
+class UniProtMirror:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with open(os.path.join(path, "sequences.dat"), "rb") as f:
+            # An empty file can't be mapped
+            self.sequences = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(f.fileno()).st_size
+                else b""
+            )
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            uri = (
+                "file:"
+                + os.path.join(self.path, "index.sqlite")
+                + "?mode=ro&immutable=1"
+            )
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            db.execute("PRAGMA mmap_size=1073741824")
+            self._local.db = db
+        return db
+
+    def search(self, gene_name):
+        # Entries carrying the gene name or synonym, followed by their isoforms
+        db = self._connect()
+        parents = [
+            row[0]
+            for row in db.execute(
+                "SELECT accession FROM genes WHERE gene = ?", (gene_name.upper(),)
+            )
+        ]
+        accessions = list(parents)
+        for parent in parents:
+            accessions.extend(
+                row[0]
+                for row in db.execute(
+                    "SELECT accession FROM entries "
+                    "WHERE parent = ? AND accession != parent ORDER BY rowid",
+                    (parent,),
+                )
+            )
+        return accessions
+
+    def get_sequence(self, accession):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT offset, length FROM entries WHERE accession = ?", (accession,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(f"{accession} is not in the UniProt mirror")
+        offset, length = row
+        return self.sequences[offset : offset + length].decode("ascii")
+
+    def get_entry(self, accession):
+        # Shaped like the UniProt JSON entry so the same parsers read it
+        db = self._connect()
+        row = db.execute(
+            "SELECT parent, gene FROM entries WHERE accession = ?", (accession,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"{accession} is not in the UniProt mirror")
+        parent, gene = row
+        references = []
+        for pdb_id, chains, resolution in db.execute(
+            "SELECT pdb_id, chains, resolution FROM pdb WHERE accession = ?",
+            (parent,),
+        ):
+            references.append(
+                {
+                    "database": "PDB",
+                    "id": pdb_id,
+                    "properties": [
+                        {"key": "Resolution", "value": resolution},
+                        {"key": "Chains", "value": chains},
+                    ],
+                }
+            )
+        return {
+            "primaryAccession": accession,
+            "genes": [{"geneName": {"value": gene}}] if gene else [],
+            "sequence": {"value": self.get_sequence(accession)},
+            "uniProtKBCrossReferences": references,
+        }
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror(path=None):
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            path = path or MIRROR_PATH
+            if not path:
+                raise RuntimeError(
+                    "MUTANTAUTOMATE_MIRROR_PATH must point at a mirror built by uniprot_mirror.py"
+                )
+            _mirror = UniProtMirror(path)
+        return _mirror
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a local UniProt mirror from a human Swiss-Prot dump"
+    )
+    parser.add_argument(
+        "--swissprot", required=True, help="Swiss-Prot flat file (.dat or .dat.gz)"
+    )
+    parser.add_argument(
+        "--varsplic", help="Swiss-Prot varsplic isoform FASTA (.fasta or .fasta.gz)"
+    )
+    parser.add_argument("--output", required=True, help="Mirror directory to write")
+    args = parser.parse_args()
+    build_mirror(args.swissprot, args.varsplic, args.output)